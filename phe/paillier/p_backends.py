@@ -0,0 +1,334 @@
+"""Encryption backends behind one interface, and a micro-benchmark to pick
+between them.
+
+A backend holds a key pair and encrypts, adds, sums the entries of an
+encrypted vector at given positions (the intersection of a bloom filter
+with an encrypted query) and decrypts. Backends:
+
+    phe      phe Paillier, with CRT encryption and decryption (p_obfuscation,
+             p_decryptor) and raw ciphertext products (p_sparse_dot)
+    gmpy     the gmpy2 Paillier port of code/paillier.py (p_gmpy_paillier)
+    seal     PySEAL (SEAL 2.x) BFV, if the seal module is installed
+    plain    no encryption, as a baseline
+
+Running this file benchmarks every available backend at each key size and
+prints operations per second, so the fastest backend meeting a security
+requirement can be chosen (select_backend). SECURITY_BITS gives the
+symmetric-equivalent strength of Paillier moduli (NIST SP 800-57).
+"""
+
+import sys
+import time
+import random
+from phe import paillier
+from p_gmpy_paillier import Paillier
+from p_obfuscation import CRTEncryptor
+from p_decryptor import CRTKey
+from p_sparse_dot import EncryptedQuery
+
+try:
+    from seal import ChooserEvaluator,     \
+                     Decryptor,            \
+                     Encryptor,            \
+                     EncryptionParameters, \
+                     Evaluator,            \
+                     IntegerEncoder,       \
+                     KeyGenerator,         \
+                     MemoryPoolHandle
+except ImportError:
+    KeyGenerator = None
+
+KEY_SIZES = (1024, 2048, 3072)
+SECURITY_BITS = {1024: 80, 2048: 112, 3072: 128, 7680: 192, 15360: 256}
+FILTER_SIZE = 500   # Entries of the benchmarked bloom filters
+SET_BITS = 40       # Set bits of the benchmarked database filters
+REPEATS = 50        # Operations timed per measurement
+
+####################
+# The interface of a backend
+####################
+class Backend(object):
+    """A key pair of an encryption scheme and its operations.
+
+    Args:
+        key_size: The bits of the key (the Paillier modulus, or the
+            polynomial modulus degree for SEAL).
+
+    Attributes:
+        name: The name of the backend, a key of BACKENDS.
+        security_bits: The symmetric-equivalent strength of the key.
+    """
+    name = None
+
+    def __init__(self, key_size):
+        self.key_size = key_size
+        self.security_bits = SECURITY_BITS.get(key_size, 0)
+
+    def encrypt(self, m):
+        """Encrypts a non-negative integer."""
+        raise NotImplementedError
+
+    def encrypt_batch(self, ms):
+        """Encrypts a list of non-negative integers, e.g. a bloom filter."""
+        return [self.encrypt(m) for m in ms]
+
+    def add(self, a, b):
+        """Adds two encrypted numbers."""
+        raise NotImplementedError
+
+    def sparse_sum(self, enc_vector, positions):
+        """Adds the entries of an encrypted vector at the given positions,
+        the intersection of the vector with a binary one. An encryption of
+        0 if there are none.
+        """
+        if len(positions) == 0:
+            return self.encrypt(0)
+        total = enc_vector[positions[0]]
+        for i in positions[1:]:
+            total = self.add(total, enc_vector[i])
+        return total
+
+    def decrypt_batch(self, cs):
+        """Decrypts a list of encrypted numbers to integers."""
+        raise NotImplementedError
+
+
+####################
+# phe Paillier
+####################
+class PheBackend(Backend):
+    """phe Paillier, encrypting with CRTEncryptor and decrypting with
+    CRTKey, summing raw ciphertexts as p_sparse_dot does.
+    """
+    name = 'phe'
+
+    def __init__(self, key_size):
+        Backend.__init__(self, key_size)
+        self.public_key, self.private_key = paillier.generate_paillier_keypair(n_length=key_size)
+        self.encryptor = CRTEncryptor(self.private_key)
+        self.key = CRTKey(self.private_key.p, self.private_key.q)
+
+    def encrypt(self, m):
+        return self.encryptor.encrypt(m)
+
+    def encrypt_batch(self, ms):
+        # The raw ciphertexts are extracted once, as the Database does.
+        return EncryptedQuery([self.encrypt(m) for m in ms])
+
+    def add(self, a, b):
+        return a + b
+
+    def sparse_sum(self, enc_vector, positions):
+        if not isinstance(enc_vector, EncryptedQuery):
+            enc_vector = EncryptedQuery(enc_vector)
+        return paillier.EncryptedNumber(self.public_key, int(enc_vector.product(positions)),
+                                        enc_vector.exponent)
+
+    def decrypt_batch(self, cs):
+        return [self.key.raw_decrypt(c.ciphertext(be_secure=False)) for c in cs]
+
+
+####################
+# gmpy2 Paillier, ported from code/paillier.py
+####################
+class GmpyBackend(Backend):
+    """The Paillier of p_gmpy_paillier, on raw integer ciphertexts."""
+    name = 'gmpy'
+
+    def __init__(self, key_size):
+        Backend.__init__(self, key_size)
+        self.paillier = Paillier(key_size)
+
+    def encrypt(self, m):
+        return self.paillier.Enc(m)
+
+    def add(self, a, b):
+        return self.paillier.Add(a, b)
+
+    def sparse_sum(self, enc_vector, positions):
+        if len(positions) == 0:
+            # 1 is the trivial encryption of 0, as in p_sparse_dot.
+            return 1
+        nsq = self.paillier.nsq
+        total = enc_vector[positions[0]]
+        for i in positions[1:]:
+            total = total * enc_vector[i] % nsq
+        return total
+
+    def decrypt_batch(self, cs):
+        return [int(self.paillier.Dec(c)) for c in cs]
+
+
+####################
+# SEAL BFV
+####################
+class SealBackend(Backend):
+    """PySEAL (SEAL 2.x), set up as Parameters does for the FHE scheme. The
+    key size is the degree of the polynomial modulus. SEAL chooses its
+    default coefficient moduli for 128 bit security.
+    """
+    name = 'seal'
+
+    def __init__(self, key_size):
+        if KeyGenerator is None:
+            raise ImportError('the seal module (PySEAL) is not installed')
+        Backend.__init__(self, key_size)
+        self.security_bits = 128
+        self.params = EncryptionParameters()
+        self.params.set_poly_modulus('1x^%d + 1' % key_size)
+        self.params.set_coeff_modulus(ChooserEvaluator.default_parameter_options()[key_size])
+        self.params.set_plain_modulus(1 << 8)
+        self.params.validate()
+        self.memorypool = MemoryPoolHandle.acquire_global()
+        self.encoder = IntegerEncoder(self.params.plain_modulus(), 2, self.memorypool)
+
+        generator = KeyGenerator(self.params, self.memorypool)
+        generator.generate(0)
+        self.encryptor = Encryptor(self.params, generator.public_key(), self.memorypool)
+        self.decryptor = Decryptor(self.params, generator.secret_key(), self.memorypool)
+        self.evaluator = Evaluator(self.params, self.memorypool)
+
+    def encrypt(self, m):
+        return self.encryptor.encrypt(self.encoder.encode(m))
+
+    def add(self, a, b):
+        return self.evaluator.add(a, b)
+
+    def decrypt_batch(self, cs):
+        return [self.encoder.decode_int32(self.decryptor.decrypt(c)) for c in cs]
+
+
+####################
+# No encryption
+####################
+class PlainBackend(Backend):
+    """Plain integers, the cost of the search without encryption."""
+    name = 'plain'
+
+    def __init__(self, key_size):
+        Backend.__init__(self, key_size)
+        self.security_bits = 0
+
+    def encrypt(self, m):
+        return m
+
+    def add(self, a, b):
+        return a + b
+
+    def sparse_sum(self, enc_vector, positions):
+        return sum(enc_vector[i] for i in positions)
+
+    def decrypt_batch(self, cs):
+        return list(cs)
+
+
+BACKENDS = {backend.name: backend for backend in (PheBackend, GmpyBackend, SealBackend, PlainBackend)}
+
+####################
+# Measure the throughput of a backend
+####################
+def benchmark(backend, repeats=REPEATS, filter_size=FILTER_SIZE, set_bits=SET_BITS):
+    """Times the operations of a backend.
+
+    Args:
+        backend: A Backend instance.
+        repeats: The number of each operation timed.
+        filter_size: The entries of the encrypted query.
+        set_bits: The set bits of each database filter.
+
+    Returns:
+        A dict of operations per second for encrypt, add, sparse_sum (one
+        filter intersection each) and decrypt.
+    """
+    rate = lambda count, seconds: count / max(seconds, 1e-9)
+    rng = random.Random(0)
+
+    start = time.time()
+    query = backend.encrypt_batch([rng.randint(0, 1) for _ in range(filter_size)])
+    rates = {'encrypt': rate(filter_size, time.time() - start)}
+
+    start = time.time()
+    total = query[0]
+    for i in range(repeats):
+        total = backend.add(total, query[i % filter_size])
+    rates['add'] = rate(repeats, time.time() - start)
+
+    filters = [sorted(rng.sample(range(filter_size), set_bits)) for _ in range(repeats)]
+    start = time.time()
+    sums = [backend.sparse_sum(query, positions) for positions in filters]
+    rates['sparse_sum'] = rate(repeats, time.time() - start)
+
+    start = time.time()
+    backend.decrypt_batch(sums)
+    rates['decrypt'] = rate(repeats, time.time() - start)
+
+    return rates
+
+
+def run_benchmarks(names=None, key_sizes=KEY_SIZES, out=sys.stdout, **kwargs):
+    """Benchmarks backends at each key size, printing a table. Backends
+    that are not installed are skipped.
+
+    Args:
+        names: The backends (keys of BACKENDS), all if None.
+        key_sizes: The key sizes of the Paillier backends.
+        out: The stream written to.
+        kwargs: Passed to benchmark.
+
+    Returns:
+        A list of (name, key size, security bits, rates) rows.
+    """
+    rows = []
+    out.write('backend  key bits  security   encrypt/s       add/s  sparse_sum/s   decrypt/s\n')
+    for name in names or BACKENDS:
+        # SEAL keys are sized by polynomial degree, plain has no key.
+        sizes = {'seal': (2048, 4096), 'plain': (0,)}.get(name, key_sizes)
+        for key_size in sizes:
+            try:
+                backend = BACKENDS[name](key_size)
+            except ImportError as e:
+                out.write('%-7s  skipped: %s\n' % (name, e))
+                break
+            rates = benchmark(backend, **kwargs)
+            rows.append((name, key_size, backend.security_bits, rates))
+            out.write('%-7s  %8d  %8d  %10.1f  %10.1f  %12.1f  %10.1f\n'
+                      % (name, key_size, backend.security_bits, rates['encrypt'], rates['add'],
+                         rates['sparse_sum'], rates['decrypt']))
+    return rows
+
+
+####################
+# Pick the fastest backend for a security requirement
+####################
+def select_backend(rows, min_security=112, filter_size=FILTER_SIZE, n_entries=1000):
+    """Picks the fastest backend meeting a security requirement, for a
+    search that encrypts one query, intersects it with n_entries database
+    filters and decrypts n_entries results.
+
+    Args:
+        rows: Benchmark results from run_benchmarks.
+        min_security: The least symmetric-equivalent bits accepted.
+
+    Returns:
+        The (name, key size) of the fastest backend, None if none qualifies.
+    """
+    def seconds(rates):
+        return filter_size / rates['encrypt'] \
+            + n_entries / rates['sparse_sum'] + n_entries / rates['decrypt']
+
+    qualifying = [row for row in rows if row[2] >= min_security]
+    if not qualifying:
+        return None
+    name, key_size, _, _ = min(qualifying, key=lambda row: seconds(row[3]))
+    return name, key_size
+
+
+####################
+# Main
+####################
+if __name__ == '__main__':
+    # python p_backends.py [min_security] [key_size ...]
+    min_security = int(sys.argv[1]) if len(sys.argv) > 1 else 112
+    key_sizes = tuple(int(x) for x in sys.argv[2:]) or KEY_SIZES
+    rows = run_benchmarks(key_sizes=key_sizes)
+    print('\nFastest backend with at least %d bit security: %s' % (min_security, select_backend(rows, min_security)))
@@ -1,17 +1,179 @@
 """Bloom filter for genetic sequences. Stored as unsigned character array."""
 
+import math
 import sys
 from array import array
 from collections import defaultdict
 
+import numpy as np
+
 #BLOOM FILTER DEFAULTS
 # Information calculated from https://krisives.github.io/bloom-calculator/
 K = 8
-H = hash
 #HASH_MAX = sys.maxsize + 1
 SIZE = 500
+NUM_HASHES = 1
+
+# b-bit MinHash sketches (see minhash_encode): low bits kept of each MinHash.
+MINHASH_BITS = 2
+
+# Seed of the k-mer hash. Every process hashing with the same seed builds the
+# same filter, unlike the builtin hash which is salted per interpreter.
+SEED = 0
+
+# 2-bit code of each nucleotide. Every other character maps to INVALID_BASE.
+INVALID_BASE = 4
+BASE_CODES = np.full(256, INVALID_BASE, dtype=np.uint8)
+for _code, _bases in enumerate(('Aa', 'Cc', 'Gg', 'Tt')):
+    for _base in _bases:
+        BASE_CODES[ord(_base)] = _code
+
+MASK_64 = (1 << 64) - 1
+MAX_HASHED_K = 32           # A k-mer must fit in 64 bits at 2 bits per base.
+
+
+def _mix64(x):
+    """ Murmur3 finalizer. Scrambles a 64-bit integer (python int or uint64
+    numpy array) so nearby k-mer codes land far apart in the filter.
+    """
+    if isinstance(x, np.ndarray):
+        x = x ^ (x >> np.uint64(33))
+        x = x * np.uint64(0xff51afd7ed558ccd)
+        x = x ^ (x >> np.uint64(33))
+        x = x * np.uint64(0xc4ceb9fe1a85ec53)
+        return x ^ (x >> np.uint64(33))
+
+    x ^= x >> 33
+    x = (x * 0xff51afd7ed558ccd) & MASK_64
+    x ^= x >> 33
+    x = (x * 0xc4ceb9fe1a85ec53) & MASK_64
+    return x ^ (x >> 33)
+
+
+def kmer_hash(k_mer, seed=SEED):
+    """ Seeded, process-independent hash of a k-mer.
+
+    Matches the signature of the builtin hash, returning a signed 64-bit
+    value, so it drops into encode's 'h' argument. encode recognises it and
+    hashes every k-mer of the gene at once with numpy instead of calling it
+    per position.
+
+    Args:
+        k_mer: A string of at most MAX_HASHED_K nucleotides.
+        seed: The seed of the hash.
+
+    Returns:
+        The hash of the k-mer, or None if the k-mer holds a character other
+        than A, C, G or T (such as 'N'). Those k-mers are left out of filters.
+    """
+    code = 0
+    for base in k_mer.encode('ascii', 'replace'):
+        base_code = BASE_CODES[base]
+        if base_code == INVALID_BASE:
+            return None
+        code = (code << 2) | int(base_code)
+
+    return _mix64((code ^ seed) & MASK_64) - (1 << 63)
+
+H = kmer_hash
+
+
+def kmer_codes(gene, k=K, with_starts=False):
+    """ Packs every k-mer of a gene into a 2-bit per base integer code.
+
+    Args:
+        gene: A string holding all or part of a DNA sequence.
+        k: The size of the k-mer.
+        with_starts: Also return where each k-mer starts in the gene.
+
+    Returns:
+        A uint64 array with the code of every k-mer that is made only of
+        A, C, G and T, in order of position.
+
+        If with_starts, an int64 array of the start of each of those k-mers.
+    """
+    if k > MAX_HASHED_K:
+        raise ValueError('k-mers longer than %d cannot be hashed' % MAX_HASHED_K)
+
+    bases = BASE_CODES[np.frombuffer(gene.encode('ascii', 'replace'), dtype=np.uint8)]
+    n_kmers = len(bases) - k + 1
+    if n_kmers <= 0:
+        codes = np.zeros(0, dtype=np.uint64)
+        return (codes, np.zeros(0, dtype=np.int64)) if with_starts else codes
+
+    # Shift in one base of every k-mer at a time.
+    codes = np.zeros(n_kmers, dtype=np.uint64)
+    for j in range(k):
+        codes <<= np.uint64(2)
+        codes |= bases[j:j + n_kmers].astype(np.uint64)
+
+    # Drop k-mers covering an invalid base.
+    invalid = np.concatenate(([0], np.cumsum(bases == INVALID_BASE)))
+    valid = invalid[k:] == invalid[:n_kmers]
+    if with_starts:
+        return codes[valid], np.flatnonzero(valid)
+    return codes[valid]
+
+
+def kmer_positions(gene, size=SIZE, k=K, HASH_MAX=sys.maxsize + 1, seed=SEED,
+                   num_hashes=NUM_HASHES, with_starts=False):
+    """ Filter positions of every k-mer in a gene under kmer_hash.
+
+    Args:
+        gene: A string holding all or part of a DNA sequence.
+        size: The size of the bloom filter.
+        k: The size of the k-mer.
+        HASH_MAX: Offset making hashes positive, as in encode.
+        seed: The seed of the hash.
+        num_hashes: The number of filter positions set per k-mer.
+        with_starts: Return the positions per k-mer, with the k-mer starts.
+
+    Returns:
+        A uint64 array holding, for every valid k-mer and every i below
+        num_hashes, the index hash_position(kmer_hash(k_mer), i, size, HASH_MAX).
 
-def encode(gene, size=SIZE, k=K, h=H, HASH_MAX=sys.maxsize + 1):
+        If with_starts, instead the int64 array of k-mer starts and a
+        (num_hashes, number of k-mers) array of their positions.
+    """
+    codes, starts = kmer_codes(gene, k, with_starts=True)
+    hashes = _mix64(codes ^ np.uint64(seed & MASK_64))
+
+    # kmer_hash subtracts 2**63 to be signed; fold that and HASH_MAX into
+    # one offset so the unsigned numpy hash can be reduced directly.
+    offset = np.uint64((HASH_MAX - (1 << 63)) % size)
+    base = (hashes % np.uint64(size) + offset) % np.uint64(size)
+    if num_hashes == 1:
+        return (starts, base[np.newaxis]) if with_starts else base
+
+    step = ((hashes >> np.uint64(32)) | np.uint64(1)) % np.uint64(size)
+    positions = np.stack([(base + step * np.uint64(i)) % np.uint64(size)
+                          for i in range(num_hashes)])
+    return (starts, positions) if with_starts else positions.ravel()
+
+
+def hash_position(k_hash, i, size=SIZE, HASH_MAX=sys.maxsize + 1):
+    """ Filter position of the i-th hash function for a hashed k-mer.
+
+    The hash functions are derived from the one k-mer hash by double hashing,
+    (h + i * step) % size with the step taken from the high 32 bits of h. The
+    first (i = 0) is (h + HASH_MAX) % size, the single position of a filter
+    with one hash.
+
+    Args:
+        k_hash: The signed 64-bit hash of the k-mer.
+        i: The index of the hash function.
+        size: The size of the bloom filter.
+        HASH_MAX: Offset making hashes positive.
+    """
+    base = (k_hash + HASH_MAX) % size
+    if i == 0:
+        return base
+    step = ((((k_hash + (1 << 63)) & MASK_64) >> 32) | 1) % size
+    return (base + step * i) % size
+
+
+def encode(gene, size=SIZE, k=K, h=H, HASH_MAX=sys.maxsize + 1, vectorized=True,
+           packed=False, num_hashes=NUM_HASHES):
     """Creates a bloom filter. Used to encode a genetic sequence.
 
     Args:
@@ -23,6 +185,11 @@ def encode(gene, size=SIZE, k=K, h=H, HASH_MAX=sys.maxsize + 1):
             k is given.
         h: The hash used to encode each k-mer entered in the bloom filter.
             Set to the default hash if no hash is given.
+        vectorized: If h is kmer_hash, hash all k-mers at once with numpy.
+            Set to False to run the per k-mer loop, which any other h uses.
+        packed: Return a PackedBloomFilter instead of an array.
+        num_hashes: The number of filter entries set per k-mer. Each is a
+            separate hash function derived from h (see hash_position).
 
     Returns:
         The corresponding bloom filter. An array where each each entry a hashed
@@ -30,22 +197,497 @@ def encode(gene, size=SIZE, k=K, h=H, HASH_MAX=sys.maxsize + 1):
 
         The number of of unique k-mers in the gene.
     """
+    if vectorized and h is kmer_hash:
+        positions = kmer_positions(gene, size, k, HASH_MAX,
+                                   num_hashes=num_hashes)
+        if packed:
+            return PackedBloomFilter.from_positions(positions, size)
+        bf = np.zeros(size, dtype=np.int8)
+        bf[positions] = 1
+        return array('b', bf.tobytes())
+
     bf = initialize_bloom_filter(size)
     gene = gene.upper()                         # Make gene all uppercase.
 
     # Loop through all k-mers for gene.
     for n in range(0, len(gene)-k + 1):
         # Get k-mer of length k and hash it.
-        k_mer = gene[n:n + k]                   # TODO: ignore case, 'N's?
-        k_hash = (h(k_mer) + HASH_MAX) % size   # Make hash positive and within
-                                                # size of filter.
+        k_mer = gene[n:n + k]
+        k_hash = h(k_mer)
+        if k_hash is None:                      # k-mer holds an 'N' or other
+            continue                            # base the hash skips.
 
-        # Set entry in the bloom filter corresponding to the hashed k-mer to one.
-        bf[k_hash] = 1
+        # Set the entries in the bloom filter corresponding to the hashed k-mer
+        # to one. Positions are made positive and within size of filter.
+        for i in range(num_hashes):
+            bf[hash_position(k_hash, i, size, HASH_MAX)] = 1
 
+    if packed:
+        return PackedBloomFilter.from_array(bf)
     return bf
 
 
+def minhash_values(gene, num_minhashes, k=K, seed=SEED):
+    """ MinHash values of the set of k-mers of a gene.
+
+    Each of the num_minhashes hash functions is kmer_hash with its own seed,
+    derived from seed. A k-mer holding a character other than A, C, G or T
+    is left out, as in encode.
+
+    Args:
+        gene: A string holding all or part of a DNA sequence.
+        num_minhashes: The number of hash functions.
+        k: The size of the k-mer.
+        seed: The seed the hash functions are derived from.
+
+    Returns:
+        A uint64 array of the smallest hash of any k-mer under each hash
+        function, or None if the gene has no k-mer.
+    """
+    codes = kmer_codes(gene, k)
+    if not len(codes):
+        return None
+
+    seeds = _mix64(np.arange(1, num_minhashes + 1, dtype=np.uint64) + np.uint64(seed & MASK_64))
+    # A block of hash functions at a time bounds the memory to 64 hashes per k-mer.
+    return np.concatenate([_mix64(codes[np.newaxis] ^ seeds[start:start + 64, np.newaxis]).min(axis=1)
+                           for start in range(0, num_minhashes, 64)])
+
+
+def minhash_encode(gene, size=SIZE, k=K, bits=MINHASH_BITS, seed=SEED, packed=False):
+    """ Creates a b-bit MinHash sketch, an alternative to the bloom filter of
+    encode with the same format.
+
+    The sketch holds size // 2**bits MinHash values of the k-mer set, each
+    one-hot encoded by its low bits in its own block of 2**bits entries
+    (the last size % 2**bits entries are unused). The dot product of two
+    sketches counts the MinHashes whose low bits match, so it works with
+    dotproduct and the encrypted search as a bloom filter does, and every
+    sketch has a magnitude of size // 2**bits. See minhash_jaccard for the
+    Jaccard similarity of the k-mer sets it estimates.
+
+    Args:
+        gene: A string holding all or part of a DNA sequence.
+        size: The number of entries of the sketch.
+        k: The size of the k-mer.
+        bits: The low bits kept of each MinHash.
+        seed: The seed of the hash functions, see minhash_values.
+        packed: Return a PackedBloomFilter instead of an array.
+
+    Returns:
+        The sketch, an array where the entry of each MinHash is a one and
+        all other entries are zero. All zeros if the gene has no k-mer.
+    """
+    width = 1 << bits
+    num_minhashes = size // width
+    if not num_minhashes:
+        raise ValueError('size must be at least 2**bits')
+
+    values = minhash_values(gene, num_minhashes, k, seed)
+    if values is None:
+        positions = np.zeros(0, dtype=np.int64)
+    else:
+        low = (values & np.uint64(width - 1)).astype(np.int64)
+        positions = np.arange(num_minhashes, dtype=np.int64) * width + low
+
+    if packed:
+        return PackedBloomFilter.from_positions(positions, size)
+    bf = np.zeros(size, dtype=np.int8)
+    bf[positions] = 1
+    return array('b', bf.tobytes())
+
+
+def minhash_jaccard(intersection, size=SIZE, bits=MINHASH_BITS):
+    """ Estimates the Jaccard similarity of the k-mer sets of two sequences
+    from the intersection (dot product) of their sketches.
+
+    MinHashes are equal with probability the Jaccard similarity J, and
+    otherwise their low bits match by chance with probability 2**-bits, so
+    a fraction J + (1 - J) * 2**-bits of them match.
+
+    Args:
+        intersection: The dot product of the two sketches.
+        size, bits: As in minhash_encode.
+
+    Returns:
+        The estimated Jaccard similarity, between 0 and 1.
+    """
+    chance = 2.0 ** -bits
+    matches = intersection / (size >> bits)
+    return min(max((matches - chance) / (1 - chance), 0.0), 1.0)
+
+
+def _kmer_table(gene, size, k, h, HASH_MAX, num_hashes):
+    """ Starts and filter positions of the k-mers of a gene under any hash.
+
+    Returns:
+        The int64 array of k-mer starts and the (num_hashes, number of
+        k-mers) int64 array of their filter positions.
+    """
+    if h is kmer_hash:
+        starts, positions = kmer_positions(gene, size, k, HASH_MAX,
+                                           num_hashes=num_hashes, with_starts=True)
+        return starts, positions.astype(np.int64)
+
+    gene = gene.upper()
+    starts = []
+    positions = []
+    for n in range(0, len(gene) - k + 1):
+        k_hash = h(gene[n:n + k])
+        if k_hash is None:
+            continue
+        starts.append(n)
+        positions.append([hash_position(k_hash, i, size, HASH_MAX)
+                          for i in range(num_hashes)])
+    positions = np.array(positions, dtype=np.int64).reshape(-1, num_hashes).T
+    return np.array(starts, dtype=np.int64), positions
+
+
+class StreamEncoder(object):
+    """ Builds the bloom filter of a sequence fed in consecutive chunks.
+
+    Gives the same filter as encode on the concatenated chunks. Only the
+    last k - 1 bases are kept between chunks, so a sequence can be encoded
+    while it is read without holding all of it in memory.
+
+    Attributes:
+        length: The number of bases fed so far.
+    """
+    def __init__(self, size=SIZE, k=K, h=H, HASH_MAX=sys.maxsize + 1,
+                 num_hashes=NUM_HASHES):
+        """
+        Args:
+            size, k, h, HASH_MAX, num_hashes: As in encode.
+        """
+        self.size = size
+        self.k = k
+        self.h = h
+        self.HASH_MAX = HASH_MAX
+        self.num_hashes = num_hashes
+        self.bits = np.zeros(size, dtype=np.int8)
+        self.tail = ''
+        self.length = 0
+
+    def update(self, chunk):
+        """ Adds the k-mers completed by the next chunk of the sequence. """
+        self.length += len(chunk)
+        gene = self.tail + chunk
+        _, positions = _kmer_table(gene, self.size, self.k, self.h,
+                                   self.HASH_MAX, self.num_hashes)
+        self.bits[positions.ravel()] = 1
+        self.tail = gene[max(len(gene) - self.k + 1, 0):] if self.k > 1 else ''
+
+    def filter(self, packed=False):
+        """ The bloom filter of the sequence fed so far.
+
+        Args:
+            packed: Return a PackedBloomFilter instead of an array.
+        """
+        if packed:
+            return PackedBloomFilter.from_positions(np.flatnonzero(self.bits), self.size)
+        return array('b', self.bits.tobytes())
+
+
+class WindowEncoder(object):
+    """ Builds the bloom filters of overlapping windows of a sequence fed in
+    consecutive chunks.
+
+    Windows of `window` bases start every `stride` bases, and a last window
+    is aligned with the end of the sequence so that every k-mer is covered.
+    A sequence shorter than one window gives a single window of all of it.
+
+    Each k-mer is hashed once. The filter entries are kept as counts of the
+    k-mers in the current window: sliding the window adds the k-mers that
+    enter it and removes the ones that leave, and the window's filter is
+    the entries with a count above zero. Only the bases of the current
+    window are held in memory.
+    """
+    def __init__(self, window, stride=None, size=SIZE, k=K, h=H,
+                 HASH_MAX=sys.maxsize + 1, num_hashes=NUM_HASHES, packed=False):
+        """
+        Args:
+            window: The number of bases in a window.
+            stride: The number of bases between window starts. Half a
+                window if None.
+            size, k, h, HASH_MAX, num_hashes, packed: As in encode.
+        """
+        if window < k:
+            raise ValueError('window must hold at least one k-mer')
+        self.window = window
+        self.stride = stride or max(window // 2, 1)
+        self.size = size
+        self.k = k
+        self.h = h
+        self.HASH_MAX = HASH_MAX
+        self.num_hashes = num_hashes
+        self.packed = packed
+
+        self.counts = np.zeros(size, dtype=np.int32)
+        self.starts = np.zeros(0, dtype=np.int64)     # k-mers from offset on
+        self.positions = np.zeros((num_hashes, 0), dtype=np.int64)
+        self.counted = 0        # k-mers starting before this are counted
+        self.offset = 0         # Start of the current window
+        self.next_offset = 0    # Start of the next window to emit
+        self.length = 0
+        self.seq = ''           # Bases from offset on
+        self.tail = ''
+        self.emitted = False
+
+    def update(self, chunk):
+        """ Adds the next chunk of the sequence.
+
+        Returns:
+            A list of (offset, bloom filter, window sequence) for the windows
+            completed by the chunk.
+        """
+        gene = self.tail + chunk
+        starts, positions = _kmer_table(gene, self.size, self.k, self.h,
+                                        self.HASH_MAX, self.num_hashes)
+        self.starts = np.concatenate((self.starts, starts + self.length - len(self.tail)))
+        self.positions = np.concatenate((self.positions, positions), axis=1)
+        self.tail = gene[max(len(gene) - self.k + 1, 0):] if self.k > 1 else ''
+        self.length += len(chunk)
+        self.seq += chunk
+
+        windows = []
+        while self.length >= self.next_offset + self.window:
+            windows.append(self._emit(self.next_offset))
+            self.next_offset += self.stride
+        return windows
+
+    def finish(self):
+        """ Ends the sequence.
+
+        Returns:
+            A list holding the last window, aligned with the end of the
+            sequence, if it is not covered by the windows already returned.
+        """
+        last_end = self.offset + self.window
+        if self.emitted and last_end >= self.length:
+            return []
+        return [self._emit(max(self.length - self.window, 0))]
+
+    def _emit(self, offset):
+        """ Slides the window to start at offset and returns its filter. """
+        # Remove the k-mers leaving the window.
+        leaving = np.searchsorted(self.starts, offset)
+        counted = np.searchsorted(self.starts, self.counted)
+        np.subtract.at(self.counts, self.positions[:, :min(leaving, counted)].ravel(), 1)
+        self.starts = self.starts[leaving:]
+        self.positions = self.positions[:, leaving:]
+        self.seq = self.seq[offset - self.offset:]
+        self.offset = offset
+        self.counted = max(self.counted, offset)
+
+        # Add the k-mers entering it.
+        end = min(offset + self.window, self.length)
+        first = np.searchsorted(self.starts, self.counted)
+        last = np.searchsorted(self.starts, end - self.k + 1)
+        np.add.at(self.counts, self.positions[:, first:last].ravel(), 1)
+        self.counted = max(self.counted, end - self.k + 1)
+        self.emitted = True
+
+        if self.packed:
+            bf = PackedBloomFilter.from_positions(np.flatnonzero(self.counts), self.size)
+        else:
+            bf = array('b', (self.counts > 0).astype(np.int8).tobytes())
+        return offset, bf, self.seq[:end - offset]
+
+
+def _popcount(words):
+    """ Number of set bits in a uint64 array. """
+    if hasattr(np, 'bitwise_count'):
+        return int(np.bitwise_count(words).sum())
+    return int(np.unpackbits(words.view(np.uint8)).sum())
+
+
+class PackedBloomFilter(object):
+    """ Bloom filter stored as bits packed into uint64 words.
+
+    Takes one bit per filter entry instead of the one byte of the array from
+    initialize_bloom_filter, and counts bits a word at a time. Indexing,
+    len() and iteration behave like that array, so the packed filter can be
+    passed wherever an unpacked one is expected.
+
+    Attributes:
+        size: The number of entries (bits) in the filter.
+        words: uint64 array holding entry i at bit i % 64 of word i // 64.
+    """
+    def __init__(self, size=SIZE, words=None):
+        self.size = size
+        if words is None:
+            words = np.zeros((size + 63) // 64, dtype='<u8')
+        self.words = words
+
+    @classmethod
+    def from_positions(cls, positions, size=SIZE):
+        """ Creates a filter with the given entries set to one.
+
+        Args:
+            positions: Iterable or array of entry indices, may repeat.
+            size: The size of the bloom filter.
+        """
+        bits = np.zeros(((size + 63) // 64) * 64, dtype=np.uint8)
+        bits[np.asarray(positions, dtype=np.int64)] = 1
+        return cls(size, np.packbits(bits, bitorder='little').view('<u8'))
+
+    @classmethod
+    def from_array(cls, bf):
+        """ Packs an unpacked (one entry per element) bloom filter. """
+        return cls.from_positions(np.flatnonzero(np.asarray(bf)), len(bf))
+
+    def positions(self):
+        """ Sorted int64 array of the entries set to one. """
+        bits = np.unpackbits(self.words.view(np.uint8), bitorder='little')
+        return np.flatnonzero(bits[:self.size])
+
+    def iter_set_bits(self):
+        """ Iterates over the indices of entries set to one, in order. """
+        for i in self.positions():
+            yield int(i)
+
+    def magnitude(self):
+        """ Number of entries set to one. """
+        return _popcount(self.words)
+
+    def intersection(self, other):
+        """ Number of entries set to one in both this and another packed
+        filter of the same size.
+        """
+        if self.size != other.size:
+            raise ValueError('Bloom filters have different sizes (%d, %d)'
+                             % (self.size, other.size))
+        return _popcount(self.words & other.words)
+
+    def to_array(self):
+        """ Unpacks the filter into the array format of initialize_bloom_filter. """
+        bits = np.unpackbits(self.words.view(np.uint8), bitorder='little')
+        return array('b', bits[:self.size].astype(np.int8).tobytes())
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.size
+        if not 0 <= i < self.size:
+            raise IndexError('bloom filter index out of range')
+        return int(self.words[i >> 6] >> np.uint64(i & 63)) & 1
+
+    def __setitem__(self, i, value):
+        if i < 0:
+            i += self.size
+        if not 0 <= i < self.size:
+            raise IndexError('bloom filter index out of range')
+        bit = np.uint64(1 << (i & 63))
+        if value:
+            self.words[i >> 6] |= bit
+        else:
+            self.words[i >> 6] &= ~bit
+
+    def __iter__(self):
+        return iter(self.to_array())
+
+    def __eq__(self, other):
+        if isinstance(other, PackedBloomFilter):
+            return self.size == other.size and np.array_equal(self.words, other.words)
+        return NotImplemented
+
+    def __getstate__(self):
+        return {'size': self.size, 'words': self.words.tobytes()}
+
+    def __setstate__(self, state):
+        self.size = state['size']
+        self.words = np.frombuffer(state['words'], dtype='<u8').copy()
+
+
+def filter_parameters(seq_len, error=0.01, target='fpr', max_hashes=8):
+    """ Smallest bloom filter meeting an error budget for a sequence length.
+
+    Every filter entry costs one encryption and one ciphertext in the
+    encrypted search, so the size is minimised. The sequence is modelled as
+    seq_len - k + 1 distinct k-mers hashed uniformly.
+
+    Args:
+        seq_len: The expected length of the encoded sequences.
+        error: The error budget, between 0 and 1.
+        target: 'fpr' bounds the false-positive rate of a k-mer lookup,
+            (1 - exp(-h * n / size)) ** h. 'iou' bounds the IOU that two
+            filters of unrelated sequences reach through hash collisions
+            alone, p / (2 - p) for a filter with a fraction p of entries set.
+        max_hashes: The largest number of hashes per k-mer considered.
+
+    Returns:
+        The tuple (size, k, num_hashes). k is the smallest k-mer size for which
+        a k-mer matches by chance somewhere in a random sequence of seq_len
+        bases with probability at most error. Among filters of equal size the
+        one with fewer hashes is returned.
+    """
+    if not 0 < error < 1:
+        raise ValueError('error must be between 0 and 1')
+    if target not in ('fpr', 'iou'):
+        raise ValueError("target must be 'fpr' or 'iou'")
+
+    k = int(math.ceil(math.log(seq_len / error, 4)))
+    k = min(max(k, 1), MAX_HASHED_K)
+    n_kmers = max(seq_len - k + 1, 1)
+
+    best = None
+    for num_hashes in range(1, max_hashes + 1):
+        # Largest fraction of set entries meeting the budget.
+        if target == 'fpr':
+            fill = error ** (1 / num_hashes)
+        else:
+            fill = 2 * error / (1 + error)
+        size = int(math.ceil(-num_hashes * n_kmers / math.log(1 - fill)))
+        if best is None or size < best[0]:
+            best = (size, k, num_hashes)
+
+    return best
+
+
+def compare_encoders(pairs, sizes, k=K, bits=(1, 2, 4)):
+    """ Error of the Jaccard similarity of the k-mer sets of sequence pairs
+    as estimated by bloom filters (their IOU) and by b-bit MinHash sketches
+    (minhash_jaccard) with the same number of entries, each of which costs
+    one encryption and one ciphertext in the encrypted search.
+
+    Args:
+        pairs: Pairs of sequences (strings).
+        sizes: The numbers of entries compared.
+        k: The size of the k-mer.
+        bits: The low bits kept of each MinHash, one sketch per value.
+
+    Returns:
+        A list with, for each size, a tuple of the size, the mean absolute
+        error of the bloom filter and the mean absolute error of the sketch
+        for each value of bits.
+    """
+    truth = []
+    for a, b in pairs:
+        set_a, set_b = set(kmer_codes(a, k).tolist()), set(kmer_codes(b, k).tolist())
+        truth.append(len(set_a & set_b) / max(len(set_a | set_b), 1))
+
+    rows = []
+    for size in sizes:
+        errors = np.zeros(1 + len(bits))
+        for (a, b), jaccard in zip(pairs, truth):
+            bf_a, bf_b = encode(a, size, k, packed=True), encode(b, size, k, packed=True)
+            intersection = bf_a.intersection(bf_b)
+            union = bf_a.magnitude() + bf_b.magnitude() - intersection
+            errors[0] += abs(intersection / max(union, 1) - jaccard)
+            for i, b_bits in enumerate(bits, 1):
+                if size >> b_bits:
+                    sketch = minhash_encode(a, size, k, b_bits, packed=True)
+                    estimate = minhash_jaccard(sketch.intersection(minhash_encode(b, size, k, b_bits, packed=True)),
+                                               size, b_bits)
+                    errors[i] += abs(estimate - jaccard)
+                else:
+                    errors[i] = np.nan
+        rows.append((size,) + tuple((errors / max(len(pairs), 1)).tolist()))
+    return rows
+
+
 def initialize_bloom_filter(size=SIZE):
     """ Creates empty bloom filter.
 
@@ -70,3 +712,29 @@ def tostring(bf):
     for x in bf:
         print(x, end='')
     print()
+
+
+####################
+# Main
+####################
+if __name__ == '__main__':
+    # python p_bloom_filter.py [seq_len] [pairs]
+    # Compares bloom filters and MinHash sketches on random sequences and
+    # copies of them with up to a quarter of the bases substituted.
+    seq_len = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    n_pairs = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    rng = np.random.RandomState(0)
+    pairs = []
+    for i in range(n_pairs):
+        a = rng.randint(4, size=seq_len)
+        b = a.copy()
+        changed = rng.rand(seq_len) < 0.25 * i / max(n_pairs - 1, 1)
+        b[changed] = (b[changed] + rng.randint(1, 4, size=changed.sum())) % 4
+        pairs.append((''.join('ACGT'[x] for x in a), ''.join('ACGT'[x] for x in b)))
+
+    bits = (1, 2, 4)
+    sizes = [s for s in (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768) if s <= 32 * seq_len]
+    print('mean absolute error of the Jaccard similarity, %d pairs of %d bases' % (n_pairs, seq_len))
+    print('entries   bloom  ' + '  '.join('%d-bit' % b for b in bits))
+    for row in compare_encoders(pairs, sizes, bits=bits):
+        print('%7d  %6.3f  ' % row[:2] + '  '.join('%5.3f' % e for e in row[2:]))
@@ -0,0 +1,296 @@
+"""Coarse-to-fine search. The query is encoded twice: a small coarse filter,
+scored against the whole database, and a large fine filter, scored only
+against the n_candidates entries (or windows) with the best coarse IoU. The
+modular multiplications of the fine filter are then paid for n_candidates
+entries instead of the whole database.
+
+The Querier sends the Database the (id, offset) of the candidates, so the
+Database learns which entries are the closest to the query by the coarse
+comparison. With sparse_fine, the Database also sends back the union of the
+set bits of the candidates' fine filters, and only those bits of the fine
+query are encrypted (the other bits cannot change an intersection). This
+cuts the fine encryptions from fine_size to at most n_candidates times the
+k-mers of a sequence, but tells the Querier which bits the candidates set.
+
+recall_report measures, without encryption (decrypted intersections are
+the plain ones), how many of the k best matches of an exhaustive fine search
+the cascade finds, for several coarse sizes and numbers of candidates, and
+what the cascade costs relative to the exhaustive search.
+"""
+
+import os
+import sys
+import time
+import numpy as np
+from joblib import Parallel, delayed
+import p_database
+from p_bloom_filter import encode, PackedBloomFilter, SIZE
+from p_database import dotproduct, magnitude
+from p_fasta import read_fasta, encode_fasta, encode_fasta_windows
+from p_sparse_dot import as_query, nonzero_blocks, BLOCK_BITS
+from p_packing import PackedScores, slot_size
+from p_shared_query import share
+from p_obfuscation import ObfuscatorPool
+from p_decryptor import DecryptionService
+from p_topk import TopK, METRICS
+from p_querier import iou
+
+COARSE_SIZE = SIZE      # Bits of the coarse filter
+FINE_SIZE = 4096        # Bits of the fine filter
+N_CANDIDATES = 50       # Entries (windows) compared with the fine filter
+CHUNK = 64              # Entries scored per task
+num_cores = 48 # Number of cores for parellel processing
+
+####################
+# Encode database entries at a filter size
+####################
+def entry_filters(data_dir, id_, size, seq_len, stride=None):
+    """Encodes an entry, or each of its windows, at a filter size.
+
+    Returns:
+        A list of (offset, filter) pairs, filters as PackedBloomFilter.
+    """
+    path = os.path.join(data_dir, id_)
+    if stride:
+        return [(offset, bloom) for offset, bloom, _
+                in encode_fasta_windows(path, seq_len, stride, size=size, packed=True)]
+    return [(0, encode_fasta(path, seq_len, size=size, packed=True)[0])]
+
+
+def candidate_positions(data_dir, candidates, size, seq_len):
+    """The set bits of the filters of the seq_len bases at offset in each
+    (id, offset) candidate.
+    """
+    return [encode(read_fasta(os.path.join(data_dir, id_), offset + seq_len)[offset:], size,
+                   packed=True).positions()
+            for id_, offset in candidates]
+
+
+####################
+# Score with an encrypted filter
+####################
+def _score_entries(query, size, data_dir, ids, seq_len, stride):
+    query = as_query(query, BLOCK_BITS)
+    scores = [(dotproduct(bloom, query), magnitude(bloom), id_, offset)
+              for id_ in ids for offset, bloom in entry_filters(data_dir, id_, size, seq_len, stride)]
+    return scores, query.multiplications
+
+
+def _score_positions(query, candidates, positions):
+    query = as_query(query, BLOCK_BITS)
+    scores = [(dotproduct(PackedBloomFilter.from_positions(p, len(query)), query), len(p), id_, offset)
+              for (id_, offset), p in zip(candidates, positions)]
+    return scores, query.multiplications
+
+
+def _gather(chunks, slot_bits, decryptor):
+    """Decrypted results of scored chunks, and the multiplications they cost."""
+    scores = PackedScores.from_scores([s for chunk, _ in chunks for s in chunk], slot_bits)
+    return scores.unpack(decryptor), sum(m for _, m in chunks)
+
+
+def _chunks(items):
+    return [items[i:i + CHUNK] for i in range(0, len(items), CHUNK)]
+
+
+def _rank(scores, query_mag, k, metric):
+    """The k best of decrypted results, as (IoU, IoLquery, IoLresult, id,
+    offset, magnitude). Entries with no k-mers (magnitude 0) cannot match
+    and are left out.
+    """
+    key = METRICS[metric]
+    best = TopK(k)
+    for intersection, mag, id_, offset in scores:
+        if not mag:
+            continue
+        score_set = iou(intersection, mag, query_mag) + (id_, offset, mag)
+        best.push(score_set[key], score_set)
+    return best.items()
+
+
+####################
+# Coarse-to-fine encrypted search
+####################
+def cascade_search(seq, data_dir, public_key, private_key, stride=None, k=5, metric='iou',
+                   coarse_size=COARSE_SIZE, fine_size=FINE_SIZE, n_candidates=N_CANDIDATES,
+                   sparse_fine=False, pool=None, n_jobs=num_cores, limit=None):
+    """Searches for a sequence with a coarse filter over the whole database,
+    then a fine filter over the best n_candidates entries (or windows).
+
+    Args:
+        seq: The query sequence (string).
+        data_dir: A path to a directory with FASTA files to act as the database.
+        public_key, private_key: The paillier key pair.
+        stride: If given, windows of seq_len bases starting every stride
+            bases are candidates, as in p_database.search.
+        k: The number of best matches returned.
+        metric: The comparison ranked on, a key of p_topk.METRICS.
+        coarse_size, fine_size: The bits of the coarse and fine filters.
+        n_candidates: The number of candidates compared with the fine filter.
+        sparse_fine: Encrypt only the bits of the fine query set in some
+            candidate, see above.
+        pool: An ObfuscatorPool for the key pair, one is made if None.
+        n_jobs: The number of worker processes.
+        limit: Search only the first limit entries. All entries if None.
+
+    Returns:
+        The k best matches by the fine comparison, each (IoU, IoLquery,
+        IoLresult, id, offset, magnitude), best first.
+
+        A dict of statistics: the encryptions, the candidates, and the
+        multiplications (of ciphertexts, by the Database) and seconds of
+        each stage.
+    """
+    seq_len = p_database.seq_len
+    pool = pool or ObfuscatorPool(public_key, private_key=private_key)
+    ids = sorted(os.listdir(data_dir))[:limit]
+    stats = {}
+
+    with DecryptionService(private_key, n_jobs) as decryptor:
+        # Coarse filter, whole database
+        start = time.time()
+        coarse = encode(seq, coarse_size)
+        with share(pool.encrypt(coarse, n_jobs)) as query:
+            chunks = Parallel(n_jobs=n_jobs)(delayed(_score_entries)(query, coarse_size, data_dir, chunk,
+                                                                     seq_len, stride)
+                                             for chunk in _chunks(ids))
+        # Intersections are at most the size of the filter.
+        coarse_scores, stats['coarse_multiplications'] = _gather(chunks, slot_size(coarse_size), decryptor)
+        candidates = [(id_, offset) for _, _, _, id_, offset, _
+                      in _rank(coarse_scores, magnitude(coarse), n_candidates, metric)]
+        stats['coarse_seconds'] = time.time() - start
+
+        # Fine filter, candidates only
+        start = time.time()
+        fine = encode(seq, fine_size)
+        positions = [p for chunk in Parallel(n_jobs=n_jobs)(
+                         delayed(candidate_positions)(data_dir, chunk, fine_size, seq_len)
+                         for chunk in _chunks(candidates))
+                     for p in chunk]
+        if sparse_fine and positions:
+            # The Database sends the bits its candidates set.
+            union = np.unique(np.concatenate(positions))
+            positions = [np.searchsorted(union, p) for p in positions]
+            fine_bits = np.asarray(fine)[union].tolist()
+        else:
+            fine_bits = fine
+        with share(pool.encrypt(fine_bits, n_jobs)) as query:
+            chunks = Parallel(n_jobs=n_jobs)(delayed(_score_positions)(query, c, p)
+                                             for c, p in zip(_chunks(candidates), _chunks(positions)))
+        fine_scores, stats['fine_multiplications'] = _gather(chunks, slot_size(fine_size), decryptor)
+        top = _rank(fine_scores, magnitude(fine), k, metric)
+        stats['fine_seconds'] = time.time() - start
+
+    stats['encryptions'] = coarse_size + len(fine_bits)
+    stats['candidates'] = len(candidates)
+    return top, stats
+
+
+####################
+# Recall of the cascade against an exhaustive fine search
+####################
+def _plain_scores(coarse, fine, data_dir, ids, seq_len, stride):
+    """For each entry (or window): id, offset, the set bits of its fine
+    filter, then its plain intersection, magnitude and number of non-zero
+    blocks for the coarse and for the fine filter.
+    """
+    rows = []
+    for id_ in ids:
+        coarse_windows = dict(entry_filters(data_dir, id_, coarse.size, seq_len, stride))
+        for offset, bloom in entry_filters(data_dir, id_, fine.size, seq_len, stride):
+            small = coarse_windows[offset]
+            rows.append((id_, offset, bloom.positions(),
+                         small.intersection(coarse), small.magnitude(), len(nonzero_blocks(small, BLOCK_BITS)),
+                         bloom.intersection(fine), bloom.magnitude(), len(nonzero_blocks(bloom, BLOCK_BITS))))
+    return rows
+
+
+def _order(rows, column, query_mag, key):
+    """Indices of rows, best first by the comparison key of the
+    intersection and magnitude at column and column + 1. Ties are broken
+    by id and offset. Rows with no k-mers (magnitude 0) come last, as
+    _rank leaves them out.
+    """
+    return sorted(range(len(rows)), key=lambda e: (not rows[e][column + 1],
+                                                   -iou(rows[e][column], rows[e][column + 1], query_mag)[key],
+                                                   rows[e][0], rows[e][1]))
+
+
+def recall_report(seqs, data_dir, stride=None, k=5, metric='iou', coarse_sizes=(COARSE_SIZE,),
+                  fine_size=FINE_SIZE, n_candidates=(N_CANDIDATES,), sparse_fine=False,
+                  n_jobs=num_cores, limit=None, out=sys.stdout):
+    """Measures the recall and cost of the cascade against an exhaustive
+    fine search, in the clear, and prints a table.
+
+    Args:
+        seqs: Query sequences (strings).
+        data_dir, stride, k, metric, fine_size, sparse_fine, limit: As in
+            cascade_search.
+        coarse_sizes: The coarse filter sizes tried.
+        n_candidates: The numbers of candidates tried.
+        out: The stream the table is written to.
+
+    Returns:
+        A list of (coarse size, n_candidates, mean recall, encryptions,
+        multiplications) rows, the costs as fractions of those of the
+        exhaustive fine search. Multiplications are counted as those of
+        p_sparse_dot with every block product cached: one per non-zero
+        block of a filter after the first.
+    """
+    seq_len = p_database.seq_len
+    ids = sorted(os.listdir(data_dir))[:limit]
+    key = METRICS[metric]
+    rows = []
+    for coarse_size in coarse_sizes:
+        results = {n: [] for n in n_candidates}
+        for seq in seqs:
+            coarse = encode(seq, coarse_size, packed=True)
+            fine = encode(seq, fine_size, packed=True)
+            entries = [row for chunk in Parallel(n_jobs=n_jobs)(
+                           delayed(_plain_scores)(coarse, fine, data_dir, chunk, seq_len, stride)
+                           for chunk in _chunks(ids))
+                       for row in chunk]
+
+            coarse_order = _order(entries, 3, coarse.magnitude(), key)
+            fine_order = _order(entries, 6, fine.magnitude(), key)
+            exhaustive = set(fine_order[:k])
+            fine_rank = {e: rank for rank, e in enumerate(fine_order)}
+            coarse_mults = sum(max(row[5] - 1, 0) for row in entries)
+            full_mults = sum(max(row[8] - 1, 0) for row in entries)
+
+            for n in n_candidates:
+                chosen = coarse_order[:n]
+                found = set(sorted(chosen, key=fine_rank.get)[:k])
+                fine_bits = len(np.unique(np.concatenate([entries[e][2] for e in chosen]))) \
+                    if sparse_fine and chosen else fine_size
+                results[n].append((len(found & exhaustive) / max(len(exhaustive), 1),
+                                   (coarse_size + fine_bits) / fine_size,
+                                   (coarse_mults + sum(max(entries[e][8] - 1, 0) for e in chosen))
+                                   / max(full_mults, 1)))
+
+        for n in n_candidates:
+            rows.append((coarse_size, n) + tuple(np.mean(results[n], axis=0).tolist()))
+
+    out.write('recall@%d of the cascade against an exhaustive %d bit search, %d queries%s\n'
+              % (k, fine_size, len(seqs), ', sparse fine queries' if sparse_fine else ''))
+    out.write('coarse bits  candidates  recall  encryptions  multiplications\n')
+    for row in rows:
+        out.write('%11d  %10d  %6.3f  %11.3f  %15.3f\n' % row)
+    return rows
+
+
+####################
+# Main
+####################
+if __name__ == '__main__':
+    if len(sys.argv) >= 4 and sys.argv[1] == 'report':
+        # python p_cascade.py report data_dir query.fasta [query.fasta ...]
+        seqs = [read_fasta(f, p_database.seq_len) for f in sys.argv[3:]]
+        for sparse_fine in (False, True):
+            recall_report(seqs, sys.argv[2], coarse_sizes=(128, 256, SIZE), n_candidates=(10, 50, 200),
+                          sparse_fine=sparse_fine)
+            print()
+    else:
+        print('usage: python p_cascade.py report data_dir query.fasta [query.fasta ...]')
+        sys.exit(2)
+    sys.exit(0)
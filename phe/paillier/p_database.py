@@ -7,71 +7,396 @@ import json
 from collections import defaultdict, namedtuple
 import time
 import sys, os
+from contextlib import ExitStack
 import numpy as np
 import pickle as p
 from joblib import Parallel, delayed
-from Bio import SeqIO
 from phe import paillier
-from p_bloom_filter import encode
+from p_bloom_filter import encode, PackedBloomFilter, MINHASH_BITS
+from p_fasta import read_fasta, encode_fasta, encode_fasta_windows, minhash_fasta, minhash_fasta_windows, BLOCK_SIZE
+from p_index import index_path, build_index, open_index, pin_index
+from p_sparse_dot import as_query, sparse_dotproduct, is_encrypted, QueryBatch, BLOCK_BITS
+from p_packing import PackedScores, slot_size
+from p_shared_query import share
+from p_scheduler import run_batches, iter_batches, report_batches
 
 data_directory = None
 num_cores = 48 # Number of cores for parellel processing
 seq_len = 100
+batch_timings = [] # Timings of the batches of the last search of FASTA files
 
 ####################
 # Search for a query in a "database"
 ####################
-def search(query, data_dir):
+def search(query, data_dir, stride=None, index_dir=None, packed=False, limit=None,
+           encoding='bloom', minhash_bits=MINHASH_BITS):
     """Searches the database for the 'best match' to the given query. Returns
     relevent information to find the IOU scores of all the genes in the database
     in order to determine the 'best match'
 
     Args:
-        query: The encrypted bloom filter (array) of the gene being searched for.
+        query: The encrypted bloom filter (array or SharedQuery) of the gene
+            being searched for.
+        data_dir: A path to a directory with FASTA files to act as the database.
+        stride: If given, search whole entries in windows of seq_len bases
+            starting every stride bases, instead of only their first seq_len
+            bases.
+        index_dir: If given, read the entries' filters from the LSH index in
+            this directory (see p_index), building it first if needed,
+            instead of encoding the FASTA files.
+        packed: If True, pack the encrypted intersections into as few
+            ciphertexts as possible (see p_packing).
+        limit: Search only the first limit entries. All entries if None.
+        encoding: 'bloom' to encode entries as bloom filters, or 'minhash'
+            for b-bit MinHash sketches of minhash_bits bits (see
+            p_bloom_filter.minhash_encode). The index holds bloom filters
+            only.
 
     Returns:
-        A dictionary where each ID maps to the encrypted intersection of the
-        gene and query and the magnitude of the gene.
+        A list with, for each entry, the encrypted intersection of the gene
+        and query, the magnitude of the gene and its sequence. In windowed
+        mode, each entry instead has a list of those for every window, with
+        the offset of the window added.
+
+        If packed, a PackedScores holding that list and the packed
+        intersections instead.
     """
     global num_cores
     global data_directory
     
     data_directory = data_dir
-        
-    data = os.listdir(data_directory)
+    check_encoding(encoding, index_dir, stride)
+    
+    # Workers attach to one copy of the encrypted query instead of each
+    # task pickling all of it.
+    with share(query) as shared_query:
+        if index_dir and not stride:
+            scores = search_index(shared_query, data_dir, index_dir, limit)
+        else:
+            scores = search_files(shared_query, data_dir, stride, limit, encoding, minhash_bits)
+    
+    if packed:
+        # Intersections are at most the length of the query filter.
+        scores = PackedScores.from_scores(scores, slot_size(len(query)))
+    
+    return scores
+
+
+def check_encoding(encoding, index_dir=None, stride=None):
+    """Raises ValueError for an unknown encoding, or a MinHash search of the
+    LSH index, which holds bloom filters.
+    """
+    if encoding not in ('bloom', 'minhash'):
+        raise ValueError("encoding must be 'bloom' or 'minhash'")
+    if encoding == 'minhash' and index_dir and not stride:
+        raise ValueError('the LSH index holds bloom filters; search the FASTA files for MinHash')
+
+
+####################
+# Search for a query in the FASTA files of a "database"
+####################
+def search_files(query, data_dir, stride=None, limit=None, encoding='bloom',
+                 minhash_bits=MINHASH_BITS):
+    """Searches the database by encoding its FASTA files. Files are scored
+    in batches of similar size, largest first, with the next files read
+    ahead (see p_scheduler).
+
+    Args:
+        query, data_dir, stride, limit, encoding, minhash_bits: As in search.
+
+    Returns:
+        The same list as search.
+    """
+    global num_cores
+    global batch_timings
+    
+    data = sorted(os.listdir(data_dir))
     
     print('\nFound %s entries in database\n' % str(len(data)))
     
-    data = data[:500]
+    data = data[:limit]
     print('Using %s entries from database\n' % str(len(data)))
     
-    scores = Parallel(n_jobs=num_cores)(delayed(gen_scores)(id_, query) for id_ in data)
+    # Windows cover whole files; otherwise only the first block is read.
+    readahead = None if stride else BLOCK_SIZE
+    paths = [os.path.join(data_dir, id_) for id_ in data]
+    score = FileScorer(query, data_dir, stride, encoding=encoding, minhash_bits=minhash_bits)
+    scores, batch_timings = run_batches(score, data, paths, readahead=readahead, n_jobs=num_cores)
+    
+    report_batches(batch_timings, limit=5)
     
     return scores
 
 
+####################
+# Search for a query in a "database", streaming the results
+####################
+def search_stream(query, data_dir, stride=None, index_dir=None, packed=True, limit=None,
+                  encoding='bloom', minhash_bits=MINHASH_BITS):
+    """Searches the database as search does, but yields the results in
+    chunks as they are scored instead of returning them all at the end. The
+    results hold the id of each entry instead of its sequence; fetch the
+    sequences of the entries that matter with fetch_sequence.
+
+    Args:
+        query, data_dir, stride, index_dir, packed, encoding, minhash_bits:
+            As in search.
+        limit: Search only the first limit entries. All entries if None.
+
+    Yields:
+        Lists (or PackedScores if packed) of results for a chunk of entries.
+        The result of an entry is a tuple of the encrypted intersection, the
+        magnitude of the gene, its id and offset (0 unless windowed), or in
+        windowed mode a list of those for every window.
+    """
+    global num_cores
+    global seq_len
+    
+    check_encoding(encoding, index_dir, stride)
+    
+    with share(query) as query, ExitStack() as stack:
+        if index_dir and not stride:
+            path = index_path(index_dir, seq_len)
+            if not os.path.exists(path):
+                build_index(data_dir, index_dir, seq_len, n_jobs=num_cores)
+            # Workers read the generation the entries were counted in.
+            path = stack.enter_context(pin_index(path))
+            n_entries = len(open_index(path))
+            n_entries = n_entries if limit is None else min(n_entries, limit)
+            
+            # A few rows per task, so chunks arrive while the scan goes on.
+            bounds = list(range(0, n_entries, 64)) + [n_entries]
+            chunks = Parallel(n_jobs=num_cores, return_as='generator')(
+                delayed(gen_index_scores)(path, range(start, stop), query, ids=True)
+                for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start)
+        else:
+            data = sorted(os.listdir(data_dir))[:limit]
+            readahead = None if stride else BLOCK_SIZE
+            paths = [os.path.join(data_dir, id_) for id_ in data]
+            score = FileScorer(query, data_dir, stride, True, encoding, minhash_bits)
+            chunks = (batch_scores for _, batch_scores, _ in
+                      iter_batches(score, data, paths, readahead=readahead, n_jobs=num_cores))
+        
+        for chunk in chunks:
+            if packed:
+                # Intersections are at most the length of the query filter.
+                chunk = PackedScores.from_scores(chunk, slot_size(len(query)))
+            yield chunk
+
+
+####################
+# Search for several queries in one pass over the "database"
+####################
+def search_batch(queries, data_dir, stride=None, index_dir=None, packed=True, limit=None,
+                 encoding='bloom', minhash_bits=MINHASH_BITS):
+    """Searches for several queries, encrypted under one key, in a single
+    pass over the database: each entry is read and encoded once and its set
+    bits applied to every query.
+
+    Args:
+        queries: The encrypted bloom filters (arrays) of the genes being
+            searched for.
+        data_dir, stride, index_dir, packed, limit, encoding, minhash_bits:
+            As in search_stream.
+
+    Yields:
+        (query number, results) for each chunk of entries and each query,
+        the results as yielded by search_stream for that query alone.
+    """
+    with ExitStack() as stack:
+        # One query file per query, shared with the workers.
+        batch = QueryBatch([stack.enter_context(share(query)) for query in queries])
+        
+        for chunk in search_stream(batch, data_dir, stride, index_dir, packed=False, limit=limit,
+                                   encoding=encoding, minhash_bits=minhash_bits):
+            for number, scores in enumerate(split_scores(chunk, len(batch))):
+                if packed:
+                    scores = PackedScores.from_scores(scores, slot_size(len(batch[number])))
+                yield number, scores
+
+
+def split_scores(scores, n_queries):
+    """Splits results scored against a QueryBatch, holding a list of
+    intersections each, into the results of every query.
+
+    Returns:
+        n_queries lists of results.
+    """
+    def take(score, j):
+        if isinstance(score, list):
+            return [(window[0][j],) + tuple(window[1:]) for window in score]
+        return (score[0][j],) + tuple(score[1:])
+
+    return [[take(score, j) for score in scores] for j in range(n_queries)]
+
+
+####################
+# Read the sequence of a result
+####################
+def fetch_sequence(data_dir, id_, offset=0):
+    """Reads the seq_len bases of an entry that a result was scored on.
+
+    Args:
+        data_dir: A path to a directory with FASTA files to act as the database.
+        id_: The id (FASTA file name) of the entry.
+        offset: The offset of the window in the entry.
+
+    Returns:
+        The sequence (string).
+    """
+    global seq_len
+    
+    return read_fasta(os.path.join(data_dir, id_), offset + seq_len)[offset:]
+
+
+####################
+# Search for a query in the LSH index of a "database"
+####################
+def search_index(query, data_dir, index_dir, limit=None):
+    """Searches the database through its LSH index. Each worker scores a
+    range of index rows, reading the filters from the shared memory map.
+
+    Args:
+        query, data_dir, index_dir, limit: As in search.
+
+    Returns:
+        The same list as search.
+    """
+    global num_cores
+    global seq_len
+    
+    path = index_path(index_dir, seq_len)
+    if not os.path.exists(path):
+        print('building LSH index...')
+        build_index(data_dir, index_dir, seq_len, n_jobs=num_cores)
+        print('...index complete\n')
+    
+    # Workers read the generation the entries were counted in.
+    with pin_index(path) as path:
+        n_entries = len(open_index(path))
+        print('\nFound %s entries in index\n' % str(n_entries))
+        
+        n_entries = n_entries if limit is None else min(n_entries, limit)
+        print('Using %s entries from index\n' % str(n_entries))
+        
+        bounds = np.linspace(0, n_entries, min(num_cores, n_entries) + 1).astype(int)
+        scores = Parallel(n_jobs=num_cores)(delayed(gen_index_scores)(path, range(start, stop), query)
+                                            for start, stop in zip(bounds[:-1], bounds[1:]))
+    
+    return [score for chunk in scores for score in chunk]
+
+
+####################
+# Calculate the dot product and magnitude of results from LSH index rows
+####################
+def gen_index_scores(path, rows, query, ids=False):
+    index = open_index(path)
+    # Extract the query's ciphertexts once for all rows, and share the
+    # products of common blocks of bits between them.
+    query = as_query(query, BLOCK_BITS)
+    
+    if ids:
+        return [(dotproduct(index.filter(i), query), int(index.magnitudes[i]), index.entry_id(i), 0)
+                for i in rows]
+    
+    return [(dotproduct(index.filter(i), query), int(index.magnitudes[i]), index.sequence(i))
+            for i in rows]
+
+
 ####################
 # Calculate the dot product and magnitude of result based on a sequence ID
 ####################
-def gen_scores(id_, query):
+def gen_scores(id_, query, data_dir=None, stride=None, ids=False, encoding='bloom',
+               minhash_bits=MINHASH_BITS):
     global data_directory
     global seq_len
     
-    seq_file = os.path.join(data_directory, id_)
+    # Worker processes do not share the globals of the searching process.
+    seq_file = os.path.join(data_dir or data_directory, id_)
     
-    entry_seq = ''
-
-    with open(seq_file, "r") as handle:
-        for record in SeqIO.parse(handle, "fasta"):
-            entry_seq += str(record.seq)
+    if stride:
+        return gen_window_scores(seq_file, query, stride, id_ if ids else None, encoding, minhash_bits)
     
-    entry_seq = entry_seq[:seq_len]
+    if encoding == 'minhash':
+        entry_bloom, entry_seq = minhash_fasta(seq_file, seq_len, bits=minhash_bits, packed=True)
+    else:
+        # Read only the first seq_len bases, encoding them as they are read.
+        entry_bloom, entry_seq = encode_fasta(seq_file, seq_len, packed=True)
     
-    entry_bloom = encode(entry_seq)
+    if ids:
+        return (dotproduct(entry_bloom, query), magnitude(entry_bloom), id_, 0)
     
     seq_code = entry_seq
     
     return (dotproduct(entry_bloom, query), magnitude(entry_bloom), seq_code)
+
+
+####################
+# Score the files of a batch task
+####################
+class FileScorer(object):
+    """Scores database files with gen_scores, as p_scheduler calls it for
+    each entry of a batch. The encrypted query is prepared (as_query, with
+    the block cache) on the first entry, so once per batch task: a scorer
+    sent to a worker process is pickled without it.
+
+    Args:
+        query, data_dir, stride, ids, encoding, minhash_bits: As in gen_scores.
+    """
+    def __init__(self, query, data_dir=None, stride=None, ids=False, encoding='bloom',
+                 minhash_bits=MINHASH_BITS):
+        self.query = query
+        self.data_dir = data_dir
+        self.stride = stride
+        self.ids = ids
+        self.encoding = encoding
+        self.minhash_bits = minhash_bits
+        self.prepared = None
+
+    def __call__(self, id_):
+        if self.prepared is None:
+            self.prepared = as_query(self.query, BLOCK_BITS)
+        return gen_scores(id_, self.prepared, self.data_dir, self.stride, self.ids,
+                          self.encoding, self.minhash_bits)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['prepared'] = None
+        return state
+
+
+####################
+# Calculate the dot product and magnitude of every window of a sequence file
+####################
+def gen_window_scores(seq_file, query, stride, id_=None, encoding='bloom', minhash_bits=MINHASH_BITS):
+    """Scores overlapping windows of seq_len bases covering a whole entry.
+
+    Args:
+        seq_file: Path of the FASTA file of the entry.
+        query: The encrypted bloom filter (array) of the gene being searched for.
+        stride: The number of bases between window starts.
+        id_: If given, put this id of the entry in the results instead of
+            the sequences of the windows.
+        encoding, minhash_bits: As in search.
+
+    Returns:
+        A list with, for each window, the encrypted intersection of the window
+        and query, the magnitude of the window, its sequence and its offset in
+        the entry.
+    """
+    global seq_len
+    
+    # Overlapping windows share most blocks of bits.
+    query = as_query(query, BLOCK_BITS)
+    
+    if encoding == 'minhash':
+        windows = minhash_fasta_windows(seq_file, seq_len, stride, bits=minhash_bits, packed=True)
+    else:
+        windows = encode_fasta_windows(seq_file, seq_len, stride, packed=True)
+    
+    return [(dotproduct(window_bloom, query), magnitude(window_bloom),
+             window_seq if id_ is None else id_, offset)
+            for offset, window_bloom, window_seq in windows]
     
     
 ####################
@@ -82,12 +407,28 @@ def dotproduct(v1, v2):
     be binary.
 
     Args:
-        v1: A binary vector (array).
-        v2: A vector (array).
+        v1: A binary vector (array or PackedBloomFilter).
+        v2: A vector (array, PackedBloomFilter or EncryptedQuery).
 
     Returns:
         The dot product of the two vectors.
     """
+    if is_encrypted(v2):
+        # Multiply the raw ciphertexts at the set bits of v1.
+        return sparse_dotproduct(v1, v2)
+
+    if isinstance(v1, PackedBloomFilter):
+        if isinstance(v2, PackedBloomFilter):
+            return v1.intersection(v2)
+        # Only the set entries of v1 contribute to the sum.
+        positions = v1.positions()
+        if len(positions) == 0:
+            return v2[0] * 0
+        dot = v2[positions[0]]
+        for i in positions[1:]:
+            dot = dot + v2[i]
+        return dot
+
     v1_array = np.asarray(v1)
     v2_array = np.asarray(v2)
     #dot = sum([v2[i] for i,_ in enumerate(v1) if v1[i] == 1])
@@ -103,10 +444,12 @@ def magnitude(v):
     """Finds the magnitude of a binary vector (array).
 
     Args:
-        v: A binary vector (array).
+        v: A binary vector (array or PackedBloomFilter).
 
     Returns:
         The magnitude of the vector.
     """
-    
+    if isinstance(v, PackedBloomFilter):
+        return v.magnitude()
+
     return sum(v)                
\ No newline at end of file
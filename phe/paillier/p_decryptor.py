@@ -0,0 +1,177 @@
+"""Batched Paillier decryption with the private key held by the workers.
+
+Decrypting through joblib pickles the private key into every task, and a
+task per ciphertext spends more time on dispatch than on the arithmetic. A
+DecryptionService starts its worker processes once, each loading the key
+through an initializer, and sends them ciphertexts in large batches as
+plain integers. Workers decrypt by CRT, with hp and hq precomputed and
+gmpy2 for the modular arithmetic when it is installed.
+"""
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from phe import paillier
+
+try:
+    from gmpy2 import mpz, powmod, invert
+except ImportError:
+    mpz = int
+    from phe.util import powmod, invert
+
+BATCH_SIZE = 256        # Ciphertexts per worker task
+num_cores = 48 # Number of cores for parellel processing
+
+# The key loaded in this worker process
+_key = None
+
+####################
+# Paillier decryption by CRT
+####################
+class CRTKey(object):
+    """The parts of a private key used for CRT decryption, precomputed.
+
+    Args:
+        p, q: The primes of the private key.
+    """
+    def __init__(self, p, q):
+        self.p, self.q = mpz(p), mpz(q)
+        self.n = self.p * self.q
+        self.psquare, self.qsquare = self.p * self.p, self.q * self.q
+        self.p_inverse = invert(self.p, self.q)
+        self.hp = self.h_function(self.p, self.psquare)
+        self.hq = self.h_function(self.q, self.qsquare)
+
+    def h_function(self, x, xsquare):
+        """hp or hq, as in phe.paillier.PaillierPrivateKey."""
+        return invert(self.l_function(powmod(self.n + 1, x - 1, xsquare), x), x)
+
+    @staticmethod
+    def l_function(x, p):
+        return (x - 1) // p
+
+    def raw_decrypt(self, ciphertext):
+        """Decrypts a raw ciphertext to its raw plaintext (int)."""
+        c = mpz(ciphertext)
+        decrypt_to_p = self.l_function(powmod(c % self.psquare, self.p - 1, self.psquare), self.p) \
+            * self.hp % self.p
+        decrypt_to_q = self.l_function(powmod(c % self.qsquare, self.q - 1, self.qsquare), self.q) \
+            * self.hq % self.q
+        u = (decrypt_to_q - decrypt_to_p) * self.p_inverse % self.q
+        return int(decrypt_to_p + u * self.p)
+
+
+####################
+# Worker side
+####################
+def _load_key(p, q):
+    """Initializer of the worker processes."""
+    global _key
+    _key = CRTKey(p, q)
+
+
+def _decrypt_batch(ciphertexts):
+    """Decrypts a batch of raw ciphertexts with the key of this worker."""
+    return [_key.raw_decrypt(c) for c in ciphertexts]
+
+
+####################
+# A pool of processes holding the private key
+####################
+class DecryptionService(object):
+    """Worker processes that hold a private key and decrypt batches of
+    ciphertexts. Use it in a with block, or call close.
+
+    Args:
+        private_key: The private key for the paillier encryption.
+        n_jobs: The number of worker processes. With 1, decryption runs in
+            this process.
+        batch_size: The most ciphertexts sent to a worker per task.
+    """
+    def __init__(self, private_key, n_jobs=num_cores, batch_size=BATCH_SIZE):
+        self.public_key = private_key.public_key
+        self.key = CRTKey(private_key.p, private_key.q)
+        self.n_jobs = n_jobs
+        self.batch_size = batch_size
+        self.executor = None
+        if n_jobs > 1:
+            self.executor = ProcessPoolExecutor(max_workers=n_jobs,
+                                                mp_context=multiprocessing.get_context('spawn'),
+                                                initializer=_load_key,
+                                                initargs=(int(private_key.p), int(private_key.q)))
+
+    def raw_decrypt(self, ciphertexts):
+        """Decrypts raw ciphertexts (list of int).
+
+        Returns:
+            The raw plaintexts (list of int), in order.
+        """
+        ciphertexts = [int(c) for c in ciphertexts]
+        if self.executor is None or len(ciphertexts) <= self.batch_size:
+            return [self.key.raw_decrypt(c) for c in ciphertexts]
+
+        # Even batches over the workers, at most batch_size each
+        n_batches = max(self.n_jobs, -(-len(ciphertexts) // self.batch_size))
+        size = -(-len(ciphertexts) // n_batches)
+        batches = [ciphertexts[i:i + size] for i in range(0, len(ciphertexts), size)]
+
+        plaintexts = []
+        for batch in self.executor.map(_decrypt_batch, batches):
+            plaintexts.extend(batch)
+        return plaintexts
+
+    def decrypt(self, values):
+        """Decrypts encrypted numbers, as private_key.decrypt does for each.
+
+        Args:
+            values: The encrypted numbers (list of EncryptedNumber).
+
+        Returns:
+            The decoded numbers, in order.
+        """
+        plaintexts = self.raw_decrypt([x.ciphertext(be_secure=False) for x in values])
+        return [paillier.EncodedNumber(self.public_key, plaintext, x.exponent).decode()
+                for x, plaintext in zip(values, plaintexts)]
+
+    def close(self):
+        """Stops the worker processes."""
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+####################
+# Decrypt the intersections of search results
+####################
+def decrypt_results(results, decryptor):
+    """Decrypts the encrypted intersections of search results in one batch.
+
+    Args:
+        results: A list with, for each entry, a tuple of the intersection
+            followed by other fields, or a list of such tuples (one per
+            window), as returned by search.
+        decryptor: A DecryptionService for the private key.
+
+    Returns:
+        The results with each encrypted intersection decrypted (int).
+        Intersections that are not encrypted are left as they are.
+    """
+    encrypted = []
+    for result in results:
+        for window in (result if isinstance(result, list) else [result]):
+            if isinstance(window[0], paillier.EncryptedNumber):
+                encrypted.append(window[0])
+    values = iter(decryptor.decrypt(encrypted))
+
+    def plain(window):
+        if isinstance(window[0], paillier.EncryptedNumber):
+            return (next(values),) + tuple(window[1:])
+        return window
+
+    return [[plain(window) for window in result] if isinstance(result, list) else plain(result)
+            for result in results]
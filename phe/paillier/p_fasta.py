@@ -0,0 +1,189 @@
+"""Streaming reader for FASTA files. Reads the bases of a file in blocks and
+stops once enough bases have been read, so only the part of a genome that is
+encoded is ever held in memory.
+"""
+
+import sys
+from p_bloom_filter import StreamEncoder, WindowEncoder, minhash_encode, SIZE, K, H, NUM_HASHES, MINHASH_BITS
+
+BLOCK_SIZE = 1 << 16    # Characters read from the file at a time.
+
+####################
+# Stream the bases of a FASTA file
+####################
+def stream_fasta(file_loc, limit=None, block_size=BLOCK_SIZE):
+    """Reads the bases of all records in a FASTA file, in order, as if the
+    records were concatenated. Header lines (starting with '>') and
+    whitespace are skipped, as in Bio.SeqIO.
+
+    Args:
+        file_loc: Path of the FASTA file.
+        limit: Stop after this many bases. Reads the whole file if None.
+        block_size: Number of characters read from the file at a time.
+
+    Yields:
+        Consecutive chunks (strings) of the sequence, together at most
+        limit bases long.
+    """
+    remaining = limit
+    in_header = False
+    started = False         # Text before the first header is not sequence.
+    line_start = True
+
+    with open(file_loc, "r") as handle:
+        while remaining is None or remaining > 0:
+            block = handle.read(block_size)
+            if not block:
+                break
+
+            lines = block.split('\n')
+            for i, line in enumerate(lines):
+                if i > 0 or line_start:
+                    in_header = line.startswith('>')
+                    started = started or in_header
+                if in_header or not started:
+                    continue
+
+                bases = ''.join(line.split())
+                if remaining is not None:
+                    bases = bases[:remaining]
+                    remaining -= len(bases)
+                if bases:
+                    yield bases
+                if remaining == 0:
+                    return
+
+            line_start = block.endswith('\n')
+
+
+####################
+# Read the start of a FASTA file into a string
+####################
+def read_fasta(file_loc, limit=None):
+    """Reads the first limit bases of a FASTA file.
+
+    Args:
+        file_loc: Path of the FASTA file.
+        limit: Maximum number of bases returned. Reads the whole file if None.
+
+    Returns:
+        The sequence (string) of the concatenated records, truncated to limit.
+    """
+    return ''.join(stream_fasta(file_loc, limit))
+
+
+####################
+# Encode the start of a FASTA file while reading it
+####################
+def encode_fasta(file_loc, limit=None, size=SIZE, k=K, h=H,
+                 HASH_MAX=sys.maxsize + 1, num_hashes=NUM_HASHES, packed=False):
+    """Reads the first limit bases of a FASTA file and encodes them as a
+    bloom filter in the same pass.
+
+    Args:
+        file_loc: Path of the FASTA file.
+        limit: Number of bases encoded. Encodes the whole file if None.
+        size, k, h, HASH_MAX, num_hashes, packed: As in p_bloom_filter.encode.
+
+    Returns:
+        The bloom filter of the sequence.
+
+        The sequence (string) that was encoded.
+    """
+    encoder = StreamEncoder(size, k, h, HASH_MAX, num_hashes)
+    chunks = []
+    for chunk in stream_fasta(file_loc, limit):
+        encoder.update(chunk)
+        chunks.append(chunk)
+
+    return encoder.filter(packed), ''.join(chunks)
+
+
+####################
+# Encode overlapping windows of a whole FASTA file while reading it
+####################
+def encode_fasta_windows(file_loc, window, stride=None, size=SIZE, k=K, h=H,
+                         HASH_MAX=sys.maxsize + 1, num_hashes=NUM_HASHES,
+                         packed=False):
+    """Reads a whole FASTA file and encodes overlapping windows of it as bloom
+    filters, in one pass. See p_bloom_filter.WindowEncoder.
+
+    Args:
+        file_loc: Path of the FASTA file.
+        window: The number of bases in a window.
+        stride: The number of bases between window starts. Half a window if
+            None.
+        size, k, h, HASH_MAX, num_hashes, packed: As in p_bloom_filter.encode.
+
+    Yields:
+        (offset, bloom filter, window sequence) for each window, in order.
+    """
+    encoder = WindowEncoder(window, stride, size, k, h, HASH_MAX, num_hashes, packed)
+    for chunk in stream_fasta(file_loc):
+        for result in encoder.update(chunk):
+            yield result
+    for result in encoder.finish():
+        yield result
+
+
+####################
+# MinHash sketches of a FASTA file
+####################
+def minhash_fasta(file_loc, limit=None, size=SIZE, k=K, bits=MINHASH_BITS, packed=False):
+    """Reads the first limit bases of a FASTA file and encodes them as a
+    b-bit MinHash sketch, see p_bloom_filter.minhash_encode.
+
+    Args:
+        file_loc: Path of the FASTA file.
+        limit: Number of bases encoded. Encodes the whole file if None.
+        size, k, bits, packed: As in p_bloom_filter.minhash_encode.
+
+    Returns:
+        The sketch of the sequence.
+
+        The sequence (string) that was encoded.
+    """
+    seq = read_fasta(file_loc, limit)
+    return minhash_encode(seq, size, k, bits, packed=packed), seq
+
+
+def minhash_fasta_windows(file_loc, window, stride=None, size=SIZE, k=K, bits=MINHASH_BITS,
+                          packed=False):
+    """Encodes the windows of encode_fasta_windows (same offsets) as b-bit
+    MinHash sketches. Bases are streamed from the file, keeping only those
+    of the next window (and of the last window of the entry) in memory.
+
+    Args:
+        file_loc: Path of the FASTA file.
+        window, stride: As in encode_fasta_windows.
+        size, k, bits, packed: As in p_bloom_filter.minhash_encode.
+
+    Yields:
+        (offset, sketch, window sequence) for each window, in order.
+    """
+    if window < k:
+        raise ValueError('window must hold at least one k-mer')
+    stride = stride or max(window // 2, 1)
+
+    kept = ''           # Bases from offset kept_at on
+    kept_at = 0
+    total = 0
+    offset = 0          # Of the next window
+    last = None         # Offset of the last window yielded
+    for chunk in stream_fasta(file_loc):
+        kept += chunk
+        total += len(chunk)
+        while offset + window <= total:
+            window_seq = kept[offset - kept_at:offset - kept_at + window]
+            yield offset, minhash_encode(window_seq, size, k, bits, packed=packed), window_seq
+            last = offset
+            offset += stride
+        # Keep the next window, and the last window bases for the end window.
+        keep_from = max(min(offset, total - window), kept_at)
+        kept, kept_at = kept[keep_from - kept_at:], keep_from
+
+    # A last window aligned with the end covers every k-mer.
+    if last is None or last + window < total:
+        end = max(total - window, 0)
+        window_seq = kept[end - kept_at:end - kept_at + window]
+        yield end, minhash_encode(window_seq, size, k, bits, packed=packed), window_seq
@@ -0,0 +1,171 @@
+"""Python 3 port of the Paillier crypto system of code/paillier.py (from
+BLOOM: Bloom filter based outsourced oblivious matchings, COMSYS, RWTH
+Aachen, AGPL).
+
+Ciphertexts are plain integers (gmpy2 mpz when installed) rather than
+phe EncryptedNumber objects, and decryption uses the CRT. Changes from the
+original: Python 3 division and names, random numbers from the operating
+system, primes of exactly half the key length so n has the requested
+length, and the gensafeprime and packings dependencies dropped (see
+p_packing for packing).
+"""
+
+import random
+from phe.util import getprimeover
+
+try:
+    from gmpy2 import mpz, gcd, invert, powmod
+except ImportError:
+    from math import gcd
+    from phe.util import invert, powmod
+    mpz = int
+
+_random = random.SystemRandom()
+
+def randomPrime(k):
+    """A random prime of k bits."""
+    p = 0
+    while p.bit_length() != k:
+        p = mpz(getprimeover(k))
+    return p
+
+def randomFromCyclicGroup(n):
+    r = n
+    while gcd(n, r) != 1:
+        r = _random.randint(1, n - 1)
+    return mpz(r)
+
+def crt_pow(x, e, p, q, q_inv, phi_p, phi_q):
+    m1 = powmod(x, e % phi_p, p)
+    m2 = powmod(x, e % phi_q, q)
+    h = (q_inv * (m1 - m2)) % p # q_inv = q^-1 mod p
+    return m2 + h * q
+
+class Paillier(object):
+    """
+        Implementation of the Paillier crypto system.
+
+        It can be used in a procedural fashion by calling to the static methods, e.g.
+            * pubkey, privkey = Paillier.generateKeys(1024)
+            * A = Paillier.encrypt(111, pubkey)
+            * print(111 == Paillier.decrypt(A, privkey))
+
+        Or, it can be instantiated as an object with the same functions but fixed to
+        a specific public and private key, e.g.
+            * p = Paillier(1024)
+            * print(111 == p.Dec(p.Enc(111)))
+
+        *key_length*        bit length for the key to generate
+        *pubkey*            instantiate from public key (instance cannot decrypt then)
+    """
+    def __init__(self, key_length=1024, pubkey=None):
+        if pubkey:
+            self.pubkey = pubkey
+            self.privkey = None
+        else:
+            self.pubkey, self.privkey = Paillier.generateKeys(key_length)
+        self.n = self.pubkey['n']
+        self.nsq = self.pubkey['nsq']
+
+    def priv_to_pub(self):
+        """
+            Get a Paillier instance that holds only the public key.
+        """
+        return Paillier(pubkey=self.pubkey)
+
+    @staticmethod
+    def generateKeys(bit_length):
+        """
+            Generate a Paillier keypair of desired bit length.
+        """
+        p = randomPrime(bit_length // 2)
+        q = p
+        n = p * q
+        while p == q or n.bit_length() != bit_length or gcd(n, (p - 1) * (q - 1)) != 1:
+            q = randomPrime(bit_length - bit_length // 2)
+            n = p * q
+
+        # lm = lambda
+        lm = (p - 1) * (q - 1)
+        # Generator g of Z*/n^2Z.
+        g = n + 1
+        # Precompute mu for decryption
+        mu = invert(lm, n)
+
+        psq = p * p
+        qsq = q * q
+        qsq_inv = invert(qsq, psq)
+        return {'n': n, 'g': g, 'nsq': n * n}, \
+               {'n': n, 'nsq': n * n, 'g': g, 'lm': lm, 'mu': mu, 'p': p, 'q': q, 'psq': psq,
+                'phi_psq': psq - p, 'qsq': qsq, 'phi_qsq': qsq - q, 'qsq_inv': qsq_inv}
+
+    def Enc(self, m, r=None, rbyn=None):
+        """
+            Encrypt a clear text integer *m*, which may be negative.
+
+            *r*     randomness used for the encryption, fresh if None.
+            *rbyn*  r^n mod n^2, to precompute the modular exponentiation.
+        """
+        m = mpz(m) % self.n
+        return Paillier.encrypt(m, self.pubkey, r, rbyn)
+
+    def Dec(self, C, CRT=True):
+        """
+            Decrypt a ciphertext *C*, through the CRT if *CRT*.
+        """
+        if not self.privkey:
+            raise ValueError('cannot decrypt without the private key')
+
+        m = Paillier.decrypt(C, self.privkey, CRT=CRT)
+        if m > self.n // 2:
+            m -= self.n
+        return m
+
+    def Add(self, A, B):
+        return Paillier.add(A, B, self.nsq)
+
+    def AddScalar(self, A, b, rbyn=None):
+        return self.Add(A, self.Enc(b, rbyn=rbyn))
+
+    def Mult(self, A, s):
+        return Paillier.mult(A, s, self.n, self.nsq)
+
+    def XOR(self, A, b):
+        return self.AddScalar(self.Mult(A, 1 - 2 * b), b)
+
+    @staticmethod
+    def encrypt(m, pubkey, r=None, rbyn=None):
+        """
+            Choosing g = n+1 reduces encryption g^m r^n mod n^2 to
+            (mn + 1) r^n mod n^2, one modular exponentiation.
+        """
+        n = pubkey['n']
+        nsq = pubkey['nsq']
+        if rbyn is None:
+            if r is None:
+                r = randomFromCyclicGroup(n)
+            rbyn = powmod(r, n, nsq)
+        return (m * n + 1) * rbyn % nsq
+
+    @staticmethod
+    def decrypt(C, privkey, CRT=True):
+        """
+            Decryption, sped up by the CRT if *CRT*.
+        """
+        def L(u, n):
+            return (u - 1) // n
+
+        if CRT:
+            return (L(crt_pow(C, privkey['lm'], privkey['psq'], privkey['qsq'], privkey['qsq_inv'],
+                              privkey['phi_psq'], privkey['phi_qsq']), privkey['n']) * privkey['mu']) % privkey['n']
+        else:
+            return (L(powmod(C, privkey['lm'], privkey['nsq']), privkey['n']) * privkey['mu']) % privkey['n']
+
+    @staticmethod
+    def add(A, B, nsq):
+        return (A * B) % nsq
+
+    @staticmethod
+    def mult(A, s, n, nsq):
+        s %= n
+        return powmod(A, s, nsq)
@@ -0,0 +1,395 @@
+"""Persistent index of the bloom filters of a FASTA database directory.
+
+Encoding the database does not depend on the query, so it is done once and
+written to a single file. The file holds, for every entry, its bit-packed
+bloom filter, its magnitude, its id (the FASTA file name) and the sequence
+that was encoded. Searches open the file as a memory map: nothing is copied
+or re-encoded, and worker processes opening the same file share its pages.
+
+File layout: the MAGIC bytes, the length of a JSON header as a little-endian
+uint64, the header, then each section aligned to ALIGN bytes. The header
+holds the key the index was built with and the offset, dtype and shape of
+every section.
+"""
+
+import hashlib
+import itertools
+import json
+import os
+import struct
+import sys
+from contextlib import contextmanager
+import numpy as np
+from joblib import Parallel, delayed
+from p_bloom_filter import PackedBloomFilter, SIZE, K, H, NUM_HASHES
+from p_fasta import encode_fasta
+
+MAGIC = b'GEMIDX01'
+ALIGN = 64
+DIGEST_SIZE = 32        # Bytes of a SHA-256 digest
+num_cores = 48 # Number of cores for parellel processing
+
+# Indexes opened in this process, by path
+_open_indexes = {}
+
+# Numbers the pinned generations of this process
+_pins = itertools.count()
+
+####################
+# Name the index file of a set of encoding parameters
+####################
+def index_key(seq_len, LSH_size=SIZE, kmer_size=K, h=H, HASH_MAX=sys.maxsize + 1,
+              num_hashes=NUM_HASHES):
+    """The parameters that determine the filters in an index.
+
+    Returns:
+        A dictionary of the parameters, with the hash function by name.
+    """
+    return {'seq_len': seq_len,
+            'LSH_size': LSH_size,
+            'kmer_size': kmer_size,
+            'hash': getattr(h, '__name__', str(h)),
+            'hash_max': HASH_MAX,
+            'num_hashes': num_hashes}
+
+
+def index_path(index_dir, seq_len, LSH_size=SIZE, kmer_size=K, h=H,
+               HASH_MAX=sys.maxsize + 1, num_hashes=NUM_HASHES):
+    """Path of the index file for a set of encoding parameters.
+
+    Args:
+        index_dir: Directory holding index files.
+        seq_len, LSH_size, kmer_size, h, HASH_MAX, num_hashes: The encoding
+            parameters, as in the notebook Parameters.
+    """
+    key = index_key(seq_len, LSH_size, kmer_size, h, HASH_MAX, num_hashes)
+    name = 'lsh_%(seq_len)d_%(LSH_size)d_%(kmer_size)d_%(hash)s_%(num_hashes)d' % key
+    if HASH_MAX != sys.maxsize + 1:
+        name += '_%d' % HASH_MAX
+    return os.path.join(index_dir, name + '.idx')
+
+
+####################
+# Build an index of a database directory
+####################
+def build_index(data_dir, index_dir, seq_len, LSH_size=SIZE, kmer_size=K, h=H,
+                HASH_MAX=sys.maxsize + 1, num_hashes=NUM_HASHES, n_jobs=None):
+    """Encodes every FASTA file in a directory and writes the index file.
+
+    The file is written under a temporary name and moved into place, so an
+    index that is open for searching is never seen half written.
+
+    Args:
+        data_dir: A path to a directory with FASTA files to act as the database.
+        index_dir: Directory to write the index to.
+        seq_len: Number of bases encoded from the start of each file.
+        LSH_size, kmer_size, h, HASH_MAX, num_hashes: As in the notebook
+            Parameters.
+        n_jobs: Number of parallel jobs. num_cores if None.
+
+    Returns:
+        The path of the index file.
+    """
+    if h is hash:
+        raise ValueError('the builtin hash is salted per process; index with kmer_hash')
+
+    ids = sorted(os.listdir(data_dir))
+    entries = Parallel(n_jobs=n_jobs or num_cores)(
+        delayed(_encode_entry)(os.path.join(data_dir, id_), seq_len, LSH_size,
+                               kmer_size, h, HASH_MAX, num_hashes)
+        for id_ in ids)
+
+    path = index_path(index_dir, seq_len, LSH_size, kmer_size, h, HASH_MAX, num_hashes)
+    key = index_key(seq_len, LSH_size, kmer_size, h, HASH_MAX, num_hashes)
+    write_index(path, key, ids, entries)
+    return path
+
+
+####################
+# Refresh an index after the database directory changed
+####################
+def refresh_index(data_dir, index_dir, seq_len, LSH_size=SIZE, kmer_size=K, h=H,
+                  HASH_MAX=sys.maxsize + 1, num_hashes=NUM_HASHES, n_jobs=None):
+    """Brings an index up to date with its database directory.
+
+    Files whose size and modification time match the index are kept as
+    they are. Files that changed on disk are digested, and only re-encoded
+    if their content changed. New files are encoded and entries of deleted
+    files are dropped. The refreshed entries are written as a new generation
+    of the index file, which replaces the old one when complete: searches
+    that opened the old generation keep reading it until they reopen.
+
+    Args:
+        As in build_index.
+
+    Returns:
+        The path of the index file.
+
+        A dictionary counting the 'added', 'changed', 'removed' and
+        'unchanged' entries.
+    """
+    path = index_path(index_dir, seq_len, LSH_size, kmer_size, h, HASH_MAX, num_hashes)
+    key = index_key(seq_len, LSH_size, kmer_size, h, HASH_MAX, num_hashes)
+    if not os.path.exists(path):
+        build_index(data_dir, index_dir, seq_len, LSH_size, kmer_size, h,
+                    HASH_MAX, num_hashes, n_jobs)
+        return path, {'added': len(os.listdir(data_dir)), 'changed': 0,
+                      'removed': 0, 'unchanged': 0}
+
+    old = LSHIndex(path)
+    if old.key != key:
+        raise ValueError('index %s was built with %s' % (path, old.key))
+    old_rows = dict((id_, i) for i, id_ in enumerate(old.ids()))
+
+    ids = sorted(os.listdir(data_dir))
+    entries = {}
+    stale = []
+    for id_ in ids:
+        i = old_rows.get(id_)
+        st = os.stat(os.path.join(data_dir, id_))
+        if i is not None and (old.sizes[i], old.mtimes[i]) == (st.st_size, st.st_mtime_ns):
+            entries[id_] = old.entry(i)
+        else:
+            stale.append(id_)
+
+    # Digest files that changed on disk, encoding those whose content changed.
+    counts = {'added': 0, 'changed': 0, 'removed': len(set(old_rows) - set(ids)),
+              'unchanged': len(entries)}
+    results = Parallel(n_jobs=n_jobs or num_cores)(
+        delayed(_encode_entry)(os.path.join(data_dir, id_), seq_len, LSH_size,
+                               kmer_size, h, HASH_MAX, num_hashes,
+                               old.digest(old_rows[id_]) if id_ in old_rows else None)
+        for id_ in stale)
+    for id_, entry in zip(stale, results):
+        if id_ not in old_rows:
+            counts['added'] += 1
+        elif entry[0] is None:
+            counts['unchanged'] += 1
+            entry = old.entry(old_rows[id_])[:2] + entry[2:]
+        else:
+            counts['changed'] += 1
+        entries[id_] = entry
+
+    if stale or counts['removed']:
+        write_index(path, key, ids, [entries[id_] for id_ in ids],
+                    generation=old.header.get('generation', 0) + 1)
+    return path, counts
+
+
+def file_digest(file_loc):
+    """SHA-256 digest (bytes) of the content of a file."""
+    digest = hashlib.sha256()
+    with open(file_loc, 'rb') as handle:
+        for block in iter(lambda: handle.read(1 << 20), b''):
+            digest.update(block)
+    return digest.digest()
+
+
+def _encode_entry(seq_file, seq_len, LSH_size, kmer_size, h, HASH_MAX, num_hashes,
+                  old_digest=None):
+    """Encodes one database file.
+
+    Returns:
+        The tuple (packed filter words, sequence bytes, file size, file
+        modification time in ns, content digest). The words and sequence are
+        None if the digest equals old_digest.
+    """
+    # Stat before reading, so a file changed while it is read is seen as
+    # changed by the next refresh.
+    st = os.stat(seq_file)
+    digest = file_digest(seq_file)
+    if digest == old_digest:
+        return None, None, st.st_size, st.st_mtime_ns, digest
+
+    bloom, seq = encode_fasta(seq_file, seq_len, size=LSH_size, k=kmer_size, h=h,
+                              HASH_MAX=HASH_MAX, num_hashes=num_hashes, packed=True)
+    return (bloom.words, seq.encode('ascii', 'replace'), st.st_size, st.st_mtime_ns,
+            digest)
+
+
+def _blob(items):
+    """Concatenates byte strings, returning the blob and the item offsets."""
+    offsets = np.zeros(len(items) + 1, dtype='<i8')
+    offsets[1:] = np.cumsum([len(item) for item in items])
+    return np.frombuffer(b''.join(items), dtype=np.uint8), offsets
+
+
+def write_index(path, key, ids, entries, generation=0):
+    """Writes an index file.
+
+    Args:
+        path: Path of the index file.
+        key: The encoding parameters, from index_key.
+        ids: The entry ids (strings).
+        entries: For each id, the tuple (packed filter words, sequence bytes,
+            file size, file modification time in ns, content digest).
+        generation: Number of refreshes since the index was built.
+    """
+    words = (key['LSH_size'] + 63) // 64
+    filters = np.zeros((len(ids), words), dtype='<u8')
+    for i, entry in enumerate(entries):
+        filters[i] = entry[0]
+    magnitudes = np.array([PackedBloomFilter(key['LSH_size'], row).magnitude()
+                           for row in filters], dtype='<i8')
+    id_blob, id_offsets = _blob([id_.encode('utf-8') for id_ in ids])
+    seq_blob, seq_offsets = _blob([entry[1] for entry in entries])
+    digests = np.frombuffer(b''.join(entry[4] for entry in entries), dtype=np.uint8)
+
+    sections = [('filters', filters),
+                ('magnitudes', magnitudes),
+                ('id_offsets', id_offsets),
+                ('id_blob', id_blob),
+                ('seq_offsets', seq_offsets),
+                ('seq_blob', seq_blob),
+                ('sizes', np.array([entry[2] for entry in entries], dtype='<i8')),
+                ('mtimes', np.array([entry[3] for entry in entries], dtype='<i8')),
+                ('digests', digests.reshape(len(ids), DIGEST_SIZE))]
+
+    header = {'key': key, 'n_entries': len(ids), 'generation': generation,
+              'sections': {}}
+
+    # Offsets are relative to the end of the header, which is padded to ALIGN.
+    offset = 0
+    for name, array_ in sections:
+        header['sections'][name] = [offset, array_.dtype.str, list(array_.shape)]
+        offset += -(-array_.nbytes // ALIGN) * ALIGN
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    start = len(MAGIC) + 8 + len(header_bytes)
+    header_bytes += b' ' * (-start % ALIGN)
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as handle:
+        handle.write(MAGIC)
+        handle.write(struct.pack('<Q', len(header_bytes)))
+        handle.write(header_bytes)
+        for name, array_ in sections:
+            data = array_.tobytes()
+            handle.write(data)
+            handle.write(b'\0' * (-len(data) % ALIGN))
+    os.replace(tmp_path, path)
+
+
+####################
+# Read an index
+####################
+class LSHIndex(object):
+    """A memory-mapped index file.
+
+    Attributes:
+        path: Path of the index file.
+        key: The encoding parameters the index was built with.
+        header: The full file header.
+        filters: (number of entries, words) uint64 memmap of packed filters.
+        magnitudes: int64 memmap of the magnitude of every filter.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as handle:
+            if handle.read(len(MAGIC)) != MAGIC:
+                raise ValueError('%s is not an LSH index' % path)
+            header_len, = struct.unpack('<Q', handle.read(8))
+            self.header = json.loads(handle.read(header_len).decode('utf-8'))
+        self.key = self.header['key']
+
+        data = np.memmap(path, dtype=np.uint8, mode='r')
+        start = len(MAGIC) + 8 + header_len
+        for name, (offset, dtype, shape) in self.header['sections'].items():
+            count = int(np.prod(shape))
+            size = np.dtype(dtype).itemsize * count
+            section = data[start + offset:start + offset + size].view(dtype)
+            setattr(self, name, section.reshape(shape))
+
+    def __len__(self):
+        return self.header['n_entries']
+
+    def entry_id(self, i):
+        """Id (FASTA file name) of entry i."""
+        return self.id_blob[self.id_offsets[i]:self.id_offsets[i + 1]].tobytes().decode('utf-8')
+
+    def ids(self):
+        """Ids of all entries, in row order."""
+        return [self.entry_id(i) for i in range(len(self))]
+
+    def sequence(self, i):
+        """Encoded sequence (string) of entry i."""
+        return self.seq_blob[self.seq_offsets[i]:self.seq_offsets[i + 1]].tobytes().decode('ascii')
+
+    def filter(self, i):
+        """Bloom filter of entry i, as a PackedBloomFilter viewing the map."""
+        return PackedBloomFilter(self.key['LSH_size'], self.filters[i])
+
+    def positions(self, i):
+        """Sorted set-bit positions of the filter of entry i."""
+        return self.filter(i).positions()
+
+    def digest(self, i):
+        """Content digest (bytes) of the source file of entry i."""
+        return self.digests[i].tobytes()
+
+    def entry(self, i):
+        """Entry i in the format of write_index's entries."""
+        return (self.filters[i], self.seq_blob[self.seq_offsets[i]:self.seq_offsets[i + 1]].tobytes(),
+                int(self.sizes[i]), int(self.mtimes[i]), self.digest(i))
+
+
+def open_index(path):
+    """Opens an index, reusing the map if this process already opened the
+    current generation of the file. Maps of files that were removed, such
+    as the pins of finished searches, are dropped before opening another.
+    """
+    index = _open_indexes.get(path)
+    st = os.stat(path)
+    version = (st.st_ino, st.st_mtime_ns)
+    if index is None or index[0] != version:
+        for old in [old for old in _open_indexes if not os.path.exists(old)]:
+            del _open_indexes[old]
+        index = (version, LSHIndex(path))
+        _open_indexes[path] = index
+    return index[1]
+
+
+@contextmanager
+def pin_index(path):
+    """Pins the current generation of an index for the length of a search.
+
+    Worker processes open the index by path, and a refresh replaces the
+    file under that path. The generation a search was planned on is hard
+    linked to a file of its own, which workers open instead, and which is
+    removed when the search ends.
+
+    Args:
+        path: Path of the index file, or None for searches without an index.
+
+    Yields:
+        The path of the pinned generation, None if path is None.
+    """
+    if path is None:
+        yield None
+        return
+    pin = '%s.%d.%d.pin' % (path, os.getpid(), next(_pins))
+    os.link(path, pin)
+    try:
+        yield pin
+    finally:
+        _open_indexes.pop(pin, None)
+        os.remove(pin)
+
+
+####################
+# Main
+####################
+if __name__ == '__main__':
+    if len(sys.argv) < 5 or sys.argv[1] not in ('build', 'refresh'):
+        print('usage: python p_index.py build|refresh data_dir index_dir seq_len '
+              '[LSH_size kmer_size num_hashes]')
+        sys.exit(2)
+    data_dir, index_dir = sys.argv[2:4]
+    params = dict(zip(('seq_len', 'LSH_size', 'kmer_size', 'num_hashes'),
+                      [int(x) for x in sys.argv[4:]]))
+    if sys.argv[1] == 'build':
+        print(build_index(data_dir, index_dir, **params))
+    else:
+        print(refresh_index(data_dir, index_dir, **params))
+    sys.exit(0)
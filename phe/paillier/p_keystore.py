@@ -0,0 +1,289 @@
+"""A store of Paillier key pairs, so the Querier does not generate a key pair
+(a search for two large primes) for every query.
+
+Key pairs are generated once and saved, with the constants derived from
+them (the CRT constants of decryption and of CRTEncryptor), so loading one
+takes no modular inverses or exponentiations. The current key pair is
+replaced after MAX_AGE seconds or MAX_USES queries, and the KEEP most
+recent older ones are kept so results under them can still be decrypted.
+
+Material made for one key pair is stored under its key id and removed with
+it: the obfuscator pool (see p_obfuscation) and the cache of encrypted
+queries. A cached encrypted query is sent unchanged each time it is used,
+so the Database can tell that the same query was repeated; the cache is for
+workloads where that is acceptable.
+
+Key files hold the private key unencrypted and are readable only by their
+owner, as ssh keys are.
+
+Directory layout: <key_id>.key (JSON), <key_id>.pool (see
+p_obfuscation.write_pool), <key_id>.queries/ (query files, see
+p_shared_query.write_query) and current.json, naming the current key pair
+and counting its uses.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from phe import paillier
+from p_obfuscation import ObfuscatorPool, CRTEncryptor, pool_secret, POOL_FILES
+from p_shared_query import SharedQuery, write_query
+
+try:
+    from gmpy2 import mpz
+except ImportError:
+    mpz = int
+
+KEY_DIR = os.path.join(os.path.expanduser('~'), '.gemstone', 'keys')
+N_LENGTH = paillier.DEFAULT_KEYSIZE  # Bits of n
+MAX_AGE = None      # Seconds a key pair is used for, no limit if None
+MAX_USES = None     # Queries a key pair is used for, no limit if None
+KEEP = 2            # Replaced key pairs kept
+CURRENT = 'current.json'
+
+####################
+# Identify a key pair
+####################
+def key_id(public_key):
+    """A short id of a public key, the start of the SHA-256 of n."""
+    return hashlib.sha256(('%x' % public_key.n).encode('utf-8')).hexdigest()[:16]
+
+
+####################
+# A key pair with its constants
+####################
+class StoredKey(object):
+    """A key pair of a KeyStore.
+
+    Attributes:
+        key_id: The id of the key pair, see key_id.
+        public_key: The public key for the paillier encryption.
+        private_key: The private key for the paillier encryption.
+        encryptor: A CRTEncryptor for the key pair.
+        created: When the key pair was generated (seconds since the epoch).
+    """
+    def __init__(self, public_key, private_key, encryptor=None, created=None):
+        self.key_id = key_id(public_key)
+        self.public_key = public_key
+        self.private_key = private_key
+        self.encryptor = encryptor or CRTEncryptor(private_key)
+        self.created = time.time() if created is None else created
+
+
+def _write_json(path, data):
+    """Writes a JSON file atomically, readable only by its owner."""
+    handle, tmp = tempfile.mkstemp(prefix='.tmp_', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(handle, 'w') as out:
+            json.dump(data, out)
+        os.chmod(tmp, 0o600)
+        os.replace(tmp, path)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+
+def save_key(path, key):
+    """Writes a key pair and its constants to a key file."""
+    private_key, encryptor = key.private_key, key.encryptor
+    hexes = {name: '%x' % getattr(private_key, name)
+             for name in ('p', 'q', 'p_inverse', 'hp', 'hq')}
+    hexes.update({'crt_' + name: '%x' % getattr(encryptor, name)
+                  for name in ('exponent_p', 'exponent_q', 'qsquare_inverse')})
+    hexes['n'] = '%x' % key.public_key.n
+    hexes['created'] = key.created
+    _write_json(path, hexes)
+
+
+def load_key(path):
+    """Reads a key file, restoring the keys from the saved constants."""
+    with open(path) as handle:
+        data = json.load(handle)
+    value = lambda name: int(data[name], 16)
+
+    public_key = paillier.PaillierPublicKey(value('n'))
+    if value('p') * value('q') != public_key.n:
+        raise ValueError('%s does not hold a valid key pair' % path)
+
+    # The constants of PaillierPrivateKey.__init__, without computing them
+    private_key = paillier.PaillierPrivateKey.__new__(paillier.PaillierPrivateKey)
+    private_key.public_key = public_key
+    for name in ('p', 'q', 'p_inverse', 'hp', 'hq'):
+        setattr(private_key, name, value(name))
+    private_key.psquare = private_key.p * private_key.p
+    private_key.qsquare = private_key.q * private_key.q
+
+    encryptor = CRTEncryptor.__new__(CRTEncryptor)
+    encryptor.public_key = public_key
+    encryptor.psquare, encryptor.qsquare = mpz(private_key.psquare), mpz(private_key.qsquare)
+    for name in ('exponent_p', 'exponent_q', 'qsquare_inverse'):
+        setattr(encryptor, name, mpz(value('crt_' + name)))
+
+    return StoredKey(public_key, private_key, encryptor, data['created'])
+
+
+####################
+# A store of key pairs
+####################
+class KeyStore(object):
+    """Key pairs saved in a directory, with a current key pair that is
+    replaced as configured.
+
+    Args:
+        directory: The directory of the store, created if needed.
+        n_length: The bits of n of generated key pairs.
+        max_age: Seconds a key pair is used for, no limit if None.
+        max_uses: Queries a key pair is used for, no limit if None.
+        keep: The number of replaced key pairs kept.
+    """
+    def __init__(self, directory=KEY_DIR, n_length=N_LENGTH, max_age=MAX_AGE,
+                 max_uses=MAX_USES, keep=KEEP):
+        self.directory = directory
+        self.n_length = n_length
+        self.max_age = max_age
+        self.max_uses = max_uses
+        self.keep = keep
+        self._keys = {}
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    def key_path(self, key_id):
+        return os.path.join(self.directory, key_id + '.key')
+
+    def pool_path(self, key_id):
+        """The obfuscator pool file of a key pair."""
+        return os.path.join(self.directory, key_id + '.pool')
+
+    def query_dir(self, key_id):
+        """The directory of the cached encrypted queries of a key pair."""
+        return os.path.join(self.directory, key_id + '.queries')
+
+    def _state(self):
+        try:
+            with open(os.path.join(self.directory, CURRENT)) as handle:
+                return json.load(handle)
+        except (OSError, ValueError):
+            return None
+
+    def _due(self, state):
+        """Whether the current key pair has to be replaced."""
+        if state is None or not os.path.exists(self.key_path(state['key_id'])):
+            return True
+        if self.max_age is not None and time.time() - state['created'] >= self.max_age:
+            return True
+        return self.max_uses is not None and state['uses'] >= self.max_uses
+
+    def current(self, use=True):
+        """The current key pair, generating a new one if there is none or it
+        is due to be replaced.
+
+        Args:
+            use: Count a use of the key pair, see max_uses.
+
+        Returns:
+            The key pair (StoredKey).
+        """
+        state = self._state()
+        if self._due(state):
+            key = self.rotate()
+            state = self._state()
+        else:
+            key = self.load(state['key_id'])
+
+        if use:
+            state['uses'] += 1
+            _write_json(os.path.join(self.directory, CURRENT), state)
+        return key
+
+    def load(self, key_id):
+        """A key pair of the store, by id."""
+        if key_id not in self._keys:
+            self._keys[key_id] = load_key(self.key_path(key_id))
+        return self._keys[key_id]
+
+    def rotate(self):
+        """Generates a new current key pair, removing the oldest replaced
+        ones beyond keep.
+
+        Returns:
+            The new key pair (StoredKey).
+        """
+        public_key, private_key = paillier.generate_paillier_keypair(n_length=self.n_length)
+        key = StoredKey(public_key, private_key)
+        save_key(self.key_path(key.key_id), key)
+        _write_json(os.path.join(self.directory, CURRENT),
+                    {'key_id': key.key_id, 'created': key.created, 'uses': 0})
+        self._keys[key.key_id] = key
+
+        replaced = [k for k in self.key_ids() if k != key.key_id]
+        for old in replaced[:max(len(replaced) - self.keep, 0)]:
+            self.remove(old)
+        return key
+
+    def key_ids(self):
+        """The ids of the stored key pairs, oldest first."""
+        ids = [name[:-len('.key')] for name in os.listdir(self.directory) if name.endswith('.key')]
+        return sorted(ids, key=lambda k: os.path.getmtime(self.key_path(k)))
+
+    def remove(self, key_id):
+        """Removes a key pair with its obfuscator pool and cached queries."""
+        for path in (self.key_path(key_id), self.pool_path(key_id)):
+            if os.path.exists(path):
+                os.remove(path)
+        shutil.rmtree(self.query_dir(key_id), ignore_errors=True)
+        self._keys.pop(key_id, None)
+
+    ####################
+    # Material tied to a key pair
+    ####################
+    def load_pool(self, key):
+        """The saved obfuscator pool of a key pair, or an empty pool. The
+        saved pool file is removed as it is loaded, see
+        p_obfuscation.ObfuscatorPool.load.
+        """
+        path = self.pool_path(key.key_id)
+        if POOL_FILES and os.path.exists(path):
+            return ObfuscatorPool.load(path, key.public_key, pool_secret(key.private_key),
+                                       key.private_key)
+        return ObfuscatorPool(key.public_key, private_key=key.private_key)
+
+    def save_pool(self, key, pool):
+        """Saves the unused obfuscators of a pool for the next session. They
+        are dropped if pool files are not supported (see
+        p_obfuscation.POOL_FILES).
+        """
+        pool.stop()
+        if POOL_FILES:
+            pool.save(self.pool_path(key.key_id), pool_secret(key.private_key))
+
+    def query_path(self, key, LSH):
+        """The cache file of the encrypted query of a bloom filter."""
+        digest = hashlib.sha256(bytes(int(x) & 0xff for x in LSH)).hexdigest()
+        return os.path.join(self.query_dir(key.key_id), digest + '.q')
+
+    def cached_query(self, key, LSH):
+        """The cached encrypted query of a bloom filter (SharedQuery), or
+        None if it is not cached.
+        """
+        path = self.query_path(key, LSH)
+        return SharedQuery(path) if os.path.exists(path) else None
+
+    def cache_query(self, key, LSH, enc_vector):
+        """Caches the encrypted query of a bloom filter.
+
+        Returns:
+            The cached query (SharedQuery).
+        """
+        path = self.query_path(key, LSH)
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        handle, tmp = tempfile.mkstemp(prefix='.tmp_', dir=os.path.dirname(path))
+        os.close(handle)
+        try:
+            write_query(tmp, enc_vector)
+            os.replace(tmp, path)
+        except Exception:
+            os.remove(tmp)
+            raise
+        return SharedQuery(path)
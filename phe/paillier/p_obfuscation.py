@@ -0,0 +1,349 @@
+"""Precomputed Paillier obfuscators for fast query encryption.
+
+Encrypting m under the public key is (n*m + 1) * r**n mod n**2 for a random
+r. The query bits are only 0 or 1, so nearly all of the cost is the
+obfuscator r**n. An ObfuscatorPool computes obfuscators ahead of time, on a
+background thread feeding worker processes, and encryption then takes one
+modular multiply per bit.
+
+The Querier holds the private key, so it can also compute r**n through the
+CRT, as two exponentiations modulo p**2 and q**2 with exponents reduced by
+their totients, which is 3-4 times cheaper (CRTEncryptor, after crt_pow in
+code/paillier.py). CRTEncryptor.encrypt takes the arguments of
+public_key.encrypt and gives the same ciphertexts.
+
+Each obfuscator is used once: it is removed from the pool when taken, and a
+pool file is removed when it is loaded. Pool files are encrypted and
+authenticated with a secret (see pool_secret), since anyone holding an
+obfuscator can strip it from the ciphertext it was used in.
+
+File layout: the MAGIC bytes, a random nonce of NONCE_SIZE bytes, then the
+payload sealed with AES-256-GCM (the ciphertext and its 16 byte tag), with
+MAGIC as associated data. The key is derived from the secret with
+HKDF-SHA256. The payload is a JSON header (public key n, count and width of
+the values) and a newline, then the values as fixed-width big-endian
+integers. Pool files need the cryptography package; without it pools are
+kept in memory only (POOL_FILES is False).
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from joblib import Parallel, delayed
+from phe import paillier
+from phe.util import powmod
+
+try:
+    from gmpy2 import mpz, invert
+except ImportError:
+    mpz = int
+    from phe.util import invert
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+except ImportError:
+    AESGCM = None
+
+MAGIC = b'GEMOBF02'
+NONCE_SIZE = 12
+TAG_SIZE = 16
+POOL_FILES = AESGCM is not None    # Pool files can be written and read
+CHUNK = 64              # Obfuscators computed per worker task
+num_cores = 48 # Number of cores for parellel processing
+
+####################
+# Encrypt with a given obfuscator
+####################
+def encrypt_obfuscated(public_key, value, obfuscator, precision=None):
+    """Encrypts a number as public_key.encrypt does, with the obfuscator
+    r**n mod n**2 given.
+
+    Returns:
+        The encrypted number (EncryptedNumber).
+    """
+    encoding = paillier.EncodedNumber.encode(public_key, value, precision)
+    nude = public_key.raw_encrypt(encoding.encoding, r_value=1)
+    x = paillier.EncryptedNumber(public_key, int(mpz(nude) * obfuscator % public_key.nsquare),
+                                 encoding.exponent)
+    # Already obfuscated, so it is not obfuscated again when sent.
+    x._EncryptedNumber__is_obfuscated = True
+    return x
+
+
+####################
+# Encrypt through the CRT with the private key
+####################
+class CRTEncryptor(object):
+    """Encryption for the holder of the private key, computing r**n mod
+    n**2 modulo p**2 and q**2 and joining the two by the CRT.
+
+    Args:
+        private_key: The private key for the paillier encryption.
+    """
+    def __init__(self, private_key):
+        self.public_key = private_key.public_key
+        p, q = mpz(private_key.p), mpz(private_key.q)
+        n = p * q
+        self.psquare, self.qsquare = p * p, q * q
+        # r**n mod p**2 = r**(n mod phi(p**2)) mod p**2, phi(p**2) = p*(p - 1)
+        self.exponent_p = n % (self.psquare - p)
+        self.exponent_q = n % (self.qsquare - q)
+        self.qsquare_inverse = invert(self.qsquare, self.psquare)
+
+    def obfuscator(self, r=None):
+        """r**n mod n**2, for a fresh random r if r is None."""
+        r = mpz(r or self.public_key.get_random_lt_n())
+        x_p = powmod(r, self.exponent_p, self.psquare)
+        x_q = powmod(r, self.exponent_q, self.qsquare)
+        return int(x_q + (x_p - x_q) * self.qsquare_inverse % self.psquare * self.qsquare)
+
+    def encrypt(self, value, precision=None, r_value=None):
+        """Encrypts a number, with the arguments and result of
+        public_key.encrypt.
+        """
+        return encrypt_obfuscated(self.public_key, value, self.obfuscator(r_value), precision)
+
+
+####################
+# Compute obfuscators
+####################
+def make_obfuscators(public_key, count, crt=None):
+    """Computes count obfuscators r**n mod n**2, each for a fresh random r.
+
+    Args:
+        public_key: The public key for the paillier encryption.
+        count: The number of obfuscators.
+        crt: A CRTEncryptor for the key, to compute them through the CRT.
+
+    Returns:
+        The obfuscators (list of int).
+    """
+    if crt is not None:
+        return [crt.obfuscator() for _ in range(count)]
+
+    n, nsquare = public_key.n, public_key.nsquare
+    return [int(powmod(public_key.get_random_lt_n(), n, nsquare)) for _ in range(count)]
+
+
+def compute_obfuscators(public_key, count, n_jobs=num_cores, crt=None):
+    """Computes count obfuscators in parallel, CHUNK per task."""
+    sizes = [min(CHUNK, count - start) for start in range(0, count, CHUNK)]
+    if len(sizes) <= 1 or n_jobs == 1:
+        return make_obfuscators(public_key, count, crt)
+
+    chunks = Parallel(n_jobs=n_jobs)(delayed(make_obfuscators)(public_key, size, crt) for size in sizes)
+    return [r for chunk in chunks for r in chunk]
+
+
+####################
+# A pool of single-use obfuscators
+####################
+class ObfuscatorPool(object):
+    """Obfuscators computed ahead of encryption, each handed out once.
+
+    Args:
+        public_key: The public key the obfuscators are for.
+        values: Obfuscators already computed, e.g. loaded from a file.
+        private_key: If given, obfuscators are computed through the CRT.
+
+    Attributes:
+        computed: The number of obfuscators encryption had to compute
+            because the pool was empty.
+    """
+    def __init__(self, public_key, values=None, private_key=None):
+        self.public_key = public_key
+        self.crt = CRTEncryptor(private_key) if private_key is not None else None
+        self.values = list(values or [])
+        self.computed = 0
+        self._lock = threading.Condition()
+        self._producer = None
+        self._stop = False
+
+    def __len__(self):
+        with self._lock:
+            return len(self.values)
+
+    def fill(self, count, n_jobs=num_cores):
+        """Computes count obfuscators and adds them to the pool."""
+        values = compute_obfuscators(self.public_key, count, n_jobs, self.crt)
+        with self._lock:
+            self.values.extend(values)
+            self._lock.notify_all()
+
+    def start(self, size, n_jobs=num_cores):
+        """Starts a background thread keeping at least size obfuscators in
+        the pool, refilling it as they are taken.
+
+        Args:
+            size: The number of obfuscators kept ready, e.g. the size of the
+                bloom filters.
+            n_jobs: The number of processes computing obfuscators.
+        """
+        if self._producer is not None and self._producer.is_alive():
+            return
+        self._stop = False
+        self._producer = threading.Thread(target=self._produce, args=(size, n_jobs), daemon=True)
+        self._producer.start()
+
+    def _produce(self, size, n_jobs):
+        batch = CHUNK * max(n_jobs, 1)
+        while True:
+            with self._lock:
+                while not self._stop and len(self.values) >= size:
+                    self._lock.wait()
+                if self._stop:
+                    return
+                count = min(size - len(self.values), batch)
+            self.fill(count, n_jobs)
+
+    def stop(self):
+        """Stops the background thread, after the batch it is computing."""
+        with self._lock:
+            self._stop = True
+            self._lock.notify_all()
+        if self._producer is not None:
+            self._producer.join()
+            self._producer = None
+
+    def wait(self, count):
+        """Blocks until the pool holds count obfuscators, or the background
+        thread is not running.
+        """
+        with self._lock:
+            while len(self.values) < count and self._producer is not None \
+                    and self._producer.is_alive():
+                self._lock.wait(0.1)
+
+    def take(self, count, n_jobs=num_cores):
+        """Removes count obfuscators from the pool, computing any the pool
+        is short of.
+
+        Returns:
+            The obfuscators (list of int).
+        """
+        with self._lock:
+            taken = self.values[:count]
+            del self.values[:count]
+            # Wakes the background thread to refill the pool.
+            self._lock.notify_all()
+
+        if len(taken) < count:
+            self.computed += count - len(taken)
+            taken.extend(compute_obfuscators(self.public_key, count - len(taken), n_jobs, self.crt))
+
+        return taken
+
+    def encrypt(self, values, n_jobs=num_cores):
+        """Encrypts a list of numbers, as public_key.encrypt does for each,
+        using one obfuscator from the pool per number.
+
+        Args:
+            values: The numbers to encrypt, e.g. a bloom filter.
+            n_jobs: The number of processes computing obfuscators if the
+                pool runs short.
+
+        Returns:
+            The encrypted numbers (list of EncryptedNumber).
+        """
+        obfuscators = self.take(len(values), n_jobs)
+        return [encrypt_obfuscated(self.public_key, value, r) for value, r in zip(values, obfuscators)]
+
+    def save(self, path, secret):
+        """Moves the obfuscators left in the pool to an encrypted file, so
+        they can be loaded (once) by a later session.
+
+        Args:
+            path: Path of the pool file.
+            secret: Bytes the file is encrypted with, see pool_secret.
+        """
+        with self._lock:
+            values, self.values = self.values, []
+        write_pool(path, self.public_key, values, secret)
+
+    @classmethod
+    def load(cls, path, public_key, secret, private_key=None):
+        """Loads the obfuscators of a pool file and removes the file, so they
+        are not used again.
+        """
+        values = read_pool(path, public_key, secret)
+        os.remove(path)
+        return cls(public_key, values, private_key)
+
+
+####################
+# Derive the secret of a pool file
+####################
+def pool_secret(private_key):
+    """Derives the secret of the pool files of a key pair from its private
+    key, so only the key holder can read them.
+    """
+    data = b'GEMstone obfuscator pool\n%x\n%x' % (private_key.p, private_key.q)
+    return hashlib.sha256(data).digest()
+
+
+def _cipher(secret):
+    """The AES-256-GCM cipher of pool files written with secret."""
+    if AESGCM is None:
+        raise ImportError('obfuscator pool files need the cryptography package')
+    key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+               info=b'GEMstone obfuscator pool file').derive(secret)
+    return AESGCM(key)
+
+
+####################
+# Write and read pool files
+####################
+def write_pool(path, public_key, values, secret):
+    """Writes obfuscators to an encrypted pool file, readable only by the
+    owner.
+    """
+    width = (public_key.nsquare.bit_length() + 7) // 8
+    header = {'n': '%x' % public_key.n, 'count': len(values), 'width': width}
+    payload = json.dumps(header).encode('utf-8') + b'\n' \
+        + b''.join(int(r).to_bytes(width, 'big') for r in values)
+
+    nonce = os.urandom(NONCE_SIZE)
+    sealed = _cipher(secret).encrypt(nonce, payload, MAGIC)
+
+    handle, tmp = tempfile.mkstemp(prefix='.obfuscators_', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(handle, 'wb') as out:
+            out.write(MAGIC + nonce + sealed)
+        os.chmod(tmp, 0o600)
+        os.replace(tmp, path)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+
+def read_pool(path, public_key, secret):
+    """Reads the obfuscators of an encrypted pool file.
+
+    Raises:
+        ValueError: If the file is not a pool file, was not written with
+            secret, was changed, or is for another public key.
+        ImportError: If the cryptography package is not installed.
+    """
+    with open(path, 'rb') as handle:
+        data = handle.read()
+
+    if data[:len(MAGIC)] != MAGIC or len(data) < len(MAGIC) + NONCE_SIZE + TAG_SIZE:
+        raise ValueError('%s is not an obfuscator pool file' % path)
+
+    nonce = data[len(MAGIC):len(MAGIC) + NONCE_SIZE]
+    try:
+        payload = _cipher(secret).decrypt(nonce, data[len(MAGIC) + NONCE_SIZE:], MAGIC)
+    except InvalidTag:
+        raise ValueError('%s was changed or is for another secret' % path)
+    header_bytes, values = payload.split(b'\n', 1)
+    header = json.loads(header_bytes.decode('utf-8'))
+    if int(header['n'], 16) != public_key.n:
+        raise ValueError('%s holds obfuscators for another public key' % path)
+
+    width = header['width']
+    return [int.from_bytes(values[i * width:(i + 1) * width], 'big') for i in range(header['count'])]
@@ -0,0 +1,174 @@
+"""Packing of encrypted search results, after code/packings.py. Intersection
+counts are small (at most the bloom filter size), so many of them fit in one
+Paillier plaintext: the Database shifts and adds them into as few ciphertexts
+as possible and the Querier decrypts each of those once, instead of once per
+database entry.
+"""
+
+from joblib import Parallel, delayed
+from phe import paillier
+from phe.util import powmod
+from p_decryptor import DecryptionService
+
+
+####################
+# Find the number of bits needed for a result
+####################
+def slot_size(max_value):
+    """Finds the number of bits (slot size) that holds values from 0 up to
+    max_value, e.g. the size of the bloom filters for intersections.
+    """
+    return max(int(max_value).bit_length(), 1)
+
+
+####################
+# Find the number of results packed into one ciphertext
+####################
+def slots_per_ciphertext(public_key, slot_bits):
+    """Finds how many slot_bits bit values fit in one plaintext of the key,
+    keeping the packed plaintext below n.
+    """
+    return max((public_key.n.bit_length() - 1) // slot_bits, 1)
+
+
+####################
+# Pack encrypted values into fewer ciphertexts
+####################
+def pack(values, slot_bits):
+    """Packs encrypted values into as few ciphertexts as possible, value i of
+    a ciphertext taking bits i * slot_bits up to (i + 1) * slot_bits of its
+    plaintext. Each packed ciphertext is obfuscated once, as it is sent to the
+    Querier.
+
+    Args:
+        values: Encrypted non-negative integers (list of EncryptedNumber)
+            below 2 ** slot_bits, all under the same public key.
+        slot_bits: The number of bits per value.
+
+    Returns:
+        The packed values (list of EncryptedNumber).
+    """
+    if not values:
+        return []
+
+    public_key = values[0].public_key
+    nsquare = public_key.nsquare
+    shift = 1 << slot_bits
+    k = slots_per_ciphertext(public_key, slot_bits)
+
+    packed = []
+    for start in range(0, len(values), k):
+        group = values[start:start + k]
+        # Horner's rule from the last value down, so value 0 ends up lowest.
+        X = group[-1].ciphertext(be_secure=False)
+        for value in reversed(group[:-1]):
+            X = powmod(X, shift, nsquare) * value.ciphertext(be_secure=False) % nsquare
+        packed_value = paillier.EncryptedNumber(public_key, int(X))
+        packed_value.obfuscate()
+        packed.append(packed_value)
+
+    return packed
+
+
+####################
+# Decrypt and unpack packed values
+####################
+def unpack(packed, private_key, slot_bits, count, n_jobs=1):
+    """Decrypts packed ciphertexts, in parallel, and splits them back into
+    the values given to pack.
+
+    Args:
+        packed: The packed values (list of EncryptedNumber).
+        private_key: The private key for the paillier encryption, or a
+            DecryptionService holding it (n_jobs is then not used).
+        slot_bits: The number of bits per value, as given to pack.
+        count: The number of values that were packed.
+        n_jobs: The number of processes decrypting.
+
+    Returns:
+        The values (list of int), in order.
+    """
+    k = slots_per_ciphertext(private_key.public_key, slot_bits)
+    mask = (1 << slot_bits) - 1
+
+    if isinstance(private_key, DecryptionService):
+        plaintexts = private_key.raw_decrypt([x.ciphertext(be_secure=False) for x in packed])
+    else:
+        plaintexts = Parallel(n_jobs=n_jobs)(delayed(private_key.raw_decrypt)(x.ciphertext(be_secure=False))
+                                             for x in packed)
+
+    values = []
+    for plaintext in plaintexts:
+        for _ in range(min(k, count - len(values))):
+            values.append(plaintext & mask)
+            plaintext >>= slot_bits
+
+    return values
+
+
+####################
+# Search results with packed intersections
+####################
+class PackedScores(object):
+    """Search results whose encrypted intersections are packed together.
+
+    Attributes:
+        ciphertexts: The packed intersections (list of EncryptedNumber).
+        slot_bits: The number of bits per intersection.
+        count: The number of intersections.
+        scores: The results as returned by search, with None in place of
+            each intersection.
+    """
+    def __init__(self, ciphertexts, slot_bits, count, scores):
+        self.ciphertexts = ciphertexts
+        self.slot_bits = slot_bits
+        self.count = count
+        self.scores = scores
+
+    @classmethod
+    def from_scores(cls, scores, slot_bits):
+        """Packs the intersections of search results.
+
+        Args:
+            scores: A list with, for each entry, a tuple of the encrypted
+                intersection followed by other fields, or a list of such
+                tuples (one per window).
+            slot_bits: The number of bits per intersection, see slot_size.
+        """
+        values = []
+        stripped = []
+        for score in scores:
+            if isinstance(score, list):
+                values.extend(window[0] for window in score)
+                stripped.append([(None,) + tuple(window[1:]) for window in score])
+            else:
+                values.append(score[0])
+                stripped.append((None,) + tuple(score[1:]))
+
+        return cls(pack(values, slot_bits), slot_bits, len(values), stripped)
+
+    def __len__(self):
+        return len(self.scores)
+
+    def unpack(self, private_key, n_jobs=1):
+        """Decrypts the packed intersections.
+
+        Args:
+            private_key: The private key for the paillier encryption, or a
+                DecryptionService holding it.
+            n_jobs: The number of processes decrypting.
+
+        Returns:
+            The results in the format of search, with each intersection
+            decrypted (int).
+        """
+        values = iter(unpack(self.ciphertexts, private_key, self.slot_bits, self.count, n_jobs))
+
+        scores = []
+        for score in self.scores:
+            if isinstance(score, list):
+                scores.append([(next(values),) + window[1:] for window in score])
+            else:
+                scores.append((next(values),) + score[1:])
+
+        return scores
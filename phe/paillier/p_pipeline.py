@@ -0,0 +1,273 @@
+"""Pipelined search: the Database scores an encrypted query while the Querier
+is still encrypting it, and the Querier decrypts results while other shards
+are still scoring.
+
+An encrypted intersection is the product of the query ciphertexts at the set
+bits of an entry's filter, so it can be built from the products over ranges
+of bits. The Querier encrypts the query a range of CHUNK_BITS bits at a time
+(encrypt_chunks). The Database is split into shards, each a worker process
+that encodes its entries as soon as it starts, and multiplies each entry's
+partial product by the product over each range as the range arrives (using
+the block cache of p_sparse_dot.EncryptedQuery). Once the last range is in,
+each shard sends its results, and they are yielded as each shard finishes.
+
+Encoding the database, encrypting the query and decrypting the results then
+overlap, so the time of a search approaches that of its longest stage
+rather than the sum of the stages.
+"""
+
+import multiprocessing
+import os
+import queue
+from contextlib import ExitStack
+import numpy as np
+from phe import paillier
+import p_database
+from p_bloom_filter import MINHASH_BITS
+from p_database import check_encoding
+from p_fasta import encode_fasta, encode_fasta_windows, minhash_fasta, minhash_fasta_windows
+from p_index import index_path, build_index, open_index, pin_index
+from p_sparse_dot import EncryptedQuery, nonzero_blocks, BLOCK_BITS
+from p_packing import PackedScores, slot_size
+from p_shard import shard_entries
+
+CHUNK_BITS = 128    # Bits of the query encrypted and sent at a time, a multiple of BLOCK_BITS
+RESULT_CHUNK = 64   # Results sent by a shard at a time
+POLL_SECONDS = 1.0  # Seconds between checks that the shards are alive
+num_cores = 48 # Number of cores for parellel processing
+
+####################
+# Encrypt a query a range of bits at a time
+####################
+def encrypt_chunks(LSH, encrypt, chunk_bits=CHUNK_BITS):
+    """Encrypts a bloom filter a range of bits at a time.
+
+    Args:
+        LSH: The bloom filter (array) of the query.
+        encrypt: A function encrypting a list of numbers, e.g.
+            ObfuscatorPool.encrypt.
+        chunk_bits: The bits per range, a multiple of BLOCK_BITS.
+
+    Yields:
+        (start, encrypted bits) for each range, in order.
+    """
+    if chunk_bits % BLOCK_BITS:
+        raise ValueError('chunk_bits must be a multiple of %d' % BLOCK_BITS)
+
+    for start in range(0, len(LSH), chunk_bits):
+        yield start, encrypt([int(x) for x in LSH[start:start + chunk_bits]])
+
+
+####################
+# A shard accumulating partial products
+####################
+class PartialProducts(object):
+    """The encrypted intersections of database entries with a query that
+    arrives a range of bits at a time.
+
+    Args:
+        entries: (id, offset, filter) of each entry, filter a
+            PackedBloomFilter.
+    """
+    def __init__(self, entries):
+        self.ids = [(id_, offset) for id_, offset, _ in entries]
+        self.magnitudes = [bloom.magnitude() for _, _, bloom in entries]
+        self.blocks = []
+        for _, _, bloom in entries:
+            blocks = nonzero_blocks(bloom, BLOCK_BITS)
+            self.blocks.append((np.array([b for b, _ in blocks], dtype=np.int64),
+                                [pattern for _, pattern in blocks]))
+        self.products = [None] * len(entries)
+
+    def add(self, public_key, exponent, start, ciphertexts):
+        """Multiplies in the product over a range of bits of the query.
+
+        Args:
+            public_key: The public key of the query.
+            exponent: The exponent of the ciphertexts.
+            start: The first bit of the range, a multiple of BLOCK_BITS.
+            ciphertexts: The raw ciphertexts of the range.
+        """
+        chunk = EncryptedQuery([paillier.EncryptedNumber(public_key, c, exponent) for c in ciphertexts],
+                               BLOCK_BITS)
+        first = start // BLOCK_BITS
+        last = first + -(-len(ciphertexts) // BLOCK_BITS)
+        nsquare = chunk.nsquare
+
+        for e, (block_ids, patterns) in enumerate(self.blocks):
+            lo, hi = np.searchsorted(block_ids, (first, last))
+            if lo == hi:
+                continue
+            product = chunk.cached_product(None, [(int(b) - first, p) for b, p
+                                                  in zip(block_ids[lo:hi], patterns[lo:hi])])
+            self.products[e] = product if self.products[e] is None \
+                else self.products[e] * product % nsquare
+
+    def results(self):
+        """The results, in the format of p_database.search_stream but with
+        raw ciphertexts, 1 (an encryption of 0) for entries with no bits in
+        common with the query.
+        """
+        return [(int(product) if product is not None else 1, magnitude, id_, offset)
+                for product, magnitude, (id_, offset) in zip(self.products, self.magnitudes, self.ids)]
+
+
+def _encode_entries(data_dir, ids, rows, stride, path, encoding='bloom', minhash_bits=MINHASH_BITS):
+    """(id, offset, filter) of the entries of a shard."""
+    if path is not None:
+        index = open_index(path)
+        return [(index.entry_id(i), 0, index.filter(i)) for i in rows]
+    seq_len = p_database.seq_len
+    if stride and encoding == 'minhash':
+        return [(id_, offset, sketch) for id_ in ids for offset, sketch, _
+                in minhash_fasta_windows(os.path.join(data_dir, id_), seq_len, stride, bits=minhash_bits,
+                                         packed=True)]
+    if stride:
+        return [(id_, offset, bloom) for id_ in ids for offset, bloom, _
+                in encode_fasta_windows(os.path.join(data_dir, id_), seq_len, stride, packed=True)]
+    if encoding == 'minhash':
+        return [(id_, 0, minhash_fasta(os.path.join(data_dir, id_), seq_len, bits=minhash_bits, packed=True)[0])
+                for id_ in ids]
+    return [(id_, 0, encode_fasta(os.path.join(data_dir, id_), seq_len, packed=True)[0])
+            for id_ in ids]
+
+
+def _shard_main(shard, inbox, outbox, data_dir, ids, rows, stride, path, seq_len, encoding, minhash_bits):
+    """A shard process: encodes its entries, then accumulates the ranges of
+    the query from inbox until ('end',), and sends its results to outbox.
+    """
+    try:
+        p_database.seq_len = seq_len
+        partial = PartialProducts(_encode_entries(data_dir, ids, rows, stride, path, encoding, minhash_bits))
+        public_key = exponent = None
+        while True:
+            message = inbox.get()
+            if message[0] == 'key':
+                public_key, exponent = paillier.PaillierPublicKey(message[1]), message[2]
+            elif message[0] == 'chunk':
+                partial.add(public_key, exponent, message[1], message[2])
+            else:
+                break
+
+        results = partial.results()
+        if stride:
+            results = _group_windows(results)
+        for start in range(0, len(results), RESULT_CHUNK):
+            outbox.put(('scores', shard, results[start:start + RESULT_CHUNK]))
+        outbox.put(('done', shard, None))
+    except Exception as e:
+        outbox.put(('error', shard, '%s: %s' % (type(e).__name__, e)))
+
+
+def _group_windows(scores):
+    """Gathers the window results of each entry into a list, as
+    p_database.search_stream gives them in windowed mode.
+    """
+    grouped = []
+    for score in scores:
+        if grouped and grouped[-1][0][2] == score[2]:
+            grouped[-1].append(score)
+        else:
+            grouped.append([score])
+    return grouped
+
+
+####################
+# Search while the query is encrypted
+####################
+def search_pipelined(query_chunks, data_dir, stride=None, index_dir=None, packed=True, limit=None,
+                     n_shards=num_cores, encoding='bloom', minhash_bits=MINHASH_BITS):
+    """Searches the database for a query given a range of bits at a time,
+    scoring each range as it arrives.
+
+    Args:
+        query_chunks: (start, encrypted bits) for each range of the query,
+            in order, e.g. from encrypt_chunks. Ranges are encrypted as the
+            shards consume them.
+        data_dir, stride, index_dir, packed, limit, encoding, minhash_bits:
+            As in p_database.search_stream.
+        n_shards: The number of shard processes.
+
+    Yields:
+        Lists (or PackedScores if packed) of results, as search_stream
+        does, as each shard finishes.
+    """
+    check_encoding(encoding, index_dir, stride)
+    pinned = ExitStack()
+    processes = []
+    try:
+        path = None
+        if index_dir and not stride:
+            path = index_path(index_dir, p_database.seq_len)
+            if not os.path.exists(path):
+                build_index(data_dir, index_dir, p_database.seq_len, n_jobs=n_shards)
+            # Shards read the generation the entries were counted in.
+            path = pinned.enter_context(pin_index(path))
+            n_entries = len(open_index(path))
+            entries = list(range(n_entries if limit is None else min(n_entries, limit)))
+        else:
+            entries = sorted(os.listdir(data_dir))[:limit]
+        n_shards = max(min(n_shards, len(entries)), 1)
+
+        context = multiprocessing.get_context('spawn')
+        outbox = context.Queue()
+        inboxes = [context.Queue() for _ in range(n_shards)]
+        for shard, inbox in enumerate(inboxes):
+            part = shard_entries(entries, shard, n_shards)
+            ids, rows = (None, part) if path else (part, None)
+            processes.append(context.Process(target=_shard_main, daemon=True,
+                                             args=(shard, inbox, outbox, data_dir, ids, rows, stride,
+                                                   path, p_database.seq_len, encoding, minhash_bits)))
+        for process in processes:
+            process.start()
+
+        # The shards encode their entries while the query is encrypted.
+        public_key = exponent = None
+        query_size = 0
+        for start, chunk in query_chunks:
+            query_size = max(query_size, start + len(chunk))
+            if public_key is None:
+                public_key, exponent = chunk[0].public_key, chunk[0].exponent
+                for inbox in inboxes:
+                    inbox.put(('key', public_key.n, exponent))
+            raw = [x.ciphertext(be_secure=False) for x in chunk]
+            for inbox in inboxes:
+                inbox.put(('chunk', start, raw))
+        for inbox in inboxes:
+            inbox.put(('end',))
+
+        done = set()
+        suspects = set()
+        while len(done) < n_shards:
+            try:
+                kind, shard, body = outbox.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                # The last messages of a shard can still be in the pipe as it
+                # exits, so a shard found dead on two polls in a row failed.
+                dead = set(shard for shard, process in enumerate(processes)
+                           if shard not in done and not process.is_alive())
+                failed = sorted(dead & suspects)
+                if failed:
+                    raise RuntimeError('shard %d exited with code %s before sending its results'
+                                       % (failed[0], processes[failed[0]].exitcode))
+                suspects = dead
+                continue
+            if kind == 'error':
+                raise RuntimeError('shard %d failed: %s' % (shard, body))
+            if kind == 'done':
+                done.add(shard)
+                continue
+
+            wrap = lambda score: (paillier.EncryptedNumber(public_key, score[0], exponent),) + score[1:]
+            scores = [[wrap(window) for window in score] if isinstance(score, list) else wrap(score)
+                      for score in body]
+            if packed:
+                # Intersections are at most the length of the query filter.
+                scores = PackedScores.from_scores(scores, slot_size(query_size))
+            yield scores
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        pinned.close()
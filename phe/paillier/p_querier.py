@@ -2,23 +2,40 @@
 Queries the database for specific genes."""
 
 # Load our packages for the environment
+import os
 import sys
 import time
 from joblib import Parallel, delayed
 from phe import paillier
-from p_bloom_filter import encode
-from p_database import search, magnitude
+from p_bloom_filter import encode, minhash_encode, minhash_jaccard, SIZE, MINHASH_BITS
+from p_database import search_stream, search_batch, fetch_sequence, magnitude
+from p_shard import stream_shards, fetch_shard_sequences
+from p_server import search_server, fetch_server_sequences
+from p_pipeline import search_pipelined, encrypt_chunks
+from p_topk import TopK, top_k, METRICS
+from p_obfuscation import ObfuscatorPool, CRTEncryptor
+from p_keystore import KeyStore
+from p_decryptor import DecryptionService
 from optimize_invert import invert
-from Bio import SeqIO
+from p_fasta import read_fasta
 
 paillier.invert = invert
 num_cores = 48 # Number of cores for parellel processing
 query_len = 100
+num_results = 5 # Number of best matches kept
+rank_by = 'iou' # Comparison the matches are ranked on: iou, ioLquery or ioLresult
+search_limit = None # Number of database entries searched, all if None
+key_dir = None # Directory of a p_keystore.KeyStore to reuse key pairs from, a new key pair per run if None
+cache_queries = False # Reuse the encrypted query of a repeated query (needs key_dir; the Database can tell it is repeated)
+server = None # Address of a p_server Database server, (host, port) or a Unix socket path, searched instead of data_dir if given
+pipelined = False # Search while the query is being encrypted, see p_pipeline (local searches without the query cache)
+encoding = 'bloom' # Encoding of queries and entries: 'bloom' filters or b-bit 'minhash' sketches (see p_bloom_filter.minhash_encode)
+minhash_bits = MINHASH_BITS # Bits kept of each MinHash when encoding is 'minhash'
 
 ####################
 # Main function to run pipeline
 ####################
-def main(f, d, dev = False):
+def main(f, d, dev = False, stride = None, workers = None):
     """Reads in queries from a file and searches for them. If no file present,
     reads in quieries from the standard input and searches for them.
 
@@ -29,36 +46,34 @@ def main(f, d, dev = False):
         d: A path do a directory with FASTA files to act as the database to search
         dev: a boolean indicator, if True, runs the pipeline on only the first 
              entry in a data set rather than the whole set. 
+        stride: if given, searches whole database entries in windows of
+             query_len bases starting every stride bases.
+        workers: if given, the (host, port) addresses of shard workers
+             (see p_shard) that search the database instead of this process.
     """
     global query_len
     
     start = time.time()
     
     print('\nStart time: ' + str(start) + '\n')
-    print('generating key pair...')
     
-    # Create the encryption public and private key pair
-    public_key, private_key = paillier.generate_paillier_keypair()
+    public_key, private_key, pool, store, key = load_keys(SIZE)
+    cache = (store, key) if cache_queries and store else None
     
-    print('...key pair complete\n')
     
-    
-    # Build the query by concatenating the entries in a FASTA file together
-    queries = ''
-    
-    with open(f, "r") as handle:
-        for record in SeqIO.parse(handle, "fasta"):
-            queries += str(record.seq)
+    # Build the query by concatenating the entries in a FASTA file together,
+    # reading no further than query_len bases
+    seq = read_fasta(f, query_len)
         
         
     q_start = time.time()
-    seq = queries
-    seq = seq[:query_len]
     
     print("Query: ", seq.upper()[:1000], "\n")
 
     
-    max_iou, max_ioLquery, max_ioLresult, best_seq, best_mag = query(seq, public_key, private_key, dev = dev, data_dir = d)
+    max_iou, max_ioLquery, max_ioLresult, best_seq, best_mag, best_offset, top = query(seq, public_key, private_key, dev = dev, data_dir = d, stride = stride, workers = workers, pool = pool, cache = cache)
+    
+    release_keys(pool, store, key)
     
     
     q_end = time.time()
@@ -70,10 +85,16 @@ def main(f, d, dev = False):
     print('Length of query: %s' % str(len(seq)), '\n')
     print("Best IoU: ", max_iou)
     print("Best IoLenQuery: ", max_ioLquery)
-    print("Best IoLenResult: ", max_ioLresult, '\n') 
+    print("Best IoLenResult: ", max_ioLresult)
+    print("Offset in result: ", best_offset, '\n') 
     
     print("Sequence: ", best_seq[:1000])
     print("---------------------------------------------\n")    
+    
+    print("Top %s matches by %s:" % (str(len(top)), rank_by))
+    for score_set in top:
+        print("IoU %.4f  IoLenQuery %.4f  IoLenResult %.4f  %s @ %s" % score_set[:5])
+    print()
             
     end = time.time()
     print('End time: ' + str(end))
@@ -84,27 +105,195 @@ def main(f, d, dev = False):
     with open("results.txt", "a") as myfile:
         myfile.write(out)
 
+####################
+# Get the key pair of a run
+####################
+def load_keys(pool_size):
+    """Loads the current key pair of the key store in key_dir, or generates
+    a key pair if key_dir is None, and starts precomputing obfuscators.
+
+    Args:
+        pool_size: The number of obfuscators kept ready.
+
+    Returns:
+        The public key, private key, ObfuscatorPool, and the KeyStore and
+        StoredKey (None if key_dir is None).
+    """
+    store, key = None, None
+    if key_dir:
+        print('loading key pair...')
+        
+        # Reuse the current key pair of the store, and its unused obfuscators
+        store = KeyStore(key_dir)
+        key = store.current()
+        public_key, private_key = key.public_key, key.private_key
+        pool = store.load_pool(key)
+        
+        print('...key pair %s loaded\n' % key.key_id)
+    else:
+        print('generating key pair...')
+        
+        # Create the encryption public and private key pair
+        public_key, private_key = paillier.generate_paillier_keypair()
+        pool = ObfuscatorPool(public_key, private_key = private_key)
+        
+        print('...key pair complete\n')
+    
+    # Precompute the obfuscators of the query encryption in the background,
+    # while the query is read and encoded, through the CRT with the private key
+    pool.start(pool_size, n_jobs = num_cores)
+    
+    return public_key, private_key, pool, store, key
+
+
+def release_keys(pool, store, key):
+    """Stops precomputing obfuscators, saving the unused ones in the key
+    store if there is one.
+    """
+    if store:
+        store.save_pool(key, pool)
+    else:
+        pool.stop()
+
+
+####################
+# Main function to run a batch of queries
+####################
+def main_batch(files, d, stride = None):
+    """Searches for the query of each of several FASTA files in one pass
+    over the database, under one key pair.
+
+    Args:
+        files: FASTA files, each containing a query.
+        d: A path do a directory with FASTA files to act as the database to search
+        stride: if given, searches whole database entries in windows of
+             query_len bases starting every stride bases.
+    """
+    start = time.time()
+    
+    print('\nStart time: ' + str(start) + '\n')
+    
+    public_key, private_key, pool, store, key = load_keys(SIZE * len(files))
+    
+    seqs = [read_fasta(f, query_len) for f in files]
+    
+    q_start = time.time()
+    
+    results = query_batch(seqs, public_key, private_key, data_dir = d, stride = stride, pool = pool)
+    
+    release_keys(pool, store, key)
+    
+    q_elapsed = time.time() - q_start
+    
+    print('Batch run time: ' + str(q_elapsed) + '\n')
+    
+    for f, seq, top in zip(files, seqs, results):
+        print("Query %s: " % f, seq.upper()[:1000], "\n")
+        print("Top %s matches by %s:" % (str(len(top)), rank_by))
+        for score_set in top:
+            print("IoU %.4f  IoLenQuery %.4f  IoLenResult %.4f  %s @ %s" % score_set[:5])
+        print("---------------------------------------------\n")
+    
+    end = time.time()
+    print('End time: ' + str(end))
+    print('Time elapsed (min): ' + str(float(end - start)/60))
+    
+    with open("results.txt", "a") as myfile:
+        for seq, top in zip(seqs, results):
+            best = top[0] if top else (0, 0, 0, '', 0, '', 0)
+            myfile.write(str([best[0], best[1], best[2], q_elapsed, seq[:2000], best[5]][:2000])+'\n')
+
+
+####################
+# Query a database with several queries in one pass
+####################
+def query_batch(queries, public_key, private_key, data_dir, stride = None, pool = None):
+    """Encodes and encrypts several queries and searches for all of them
+    in one pass over the database, each entry being read and encoded once.
+    Each query's results are decrypted and ranked as they arrive.
+
+    Args:
+        queries: Genetic sequences (strings) to be searched for.
+        public_key, private_key, data_dir, stride, pool: As in query.
+
+    Returns:
+        For each query, its num_results best matches, as returned by query.
+    """
+    print("encoding and encrypting %s queries..." % str(len(queries)))
+    
+    encrypt_start = time.time()
+    
+    LSHs = [encode_query(q) for q in queries]
+    query_mags = [magnitude(LSH) for LSH in LSHs]
+    
+    if pool is not None:
+        pool.wait(sum(len(LSH) for LSH in LSHs))
+        encrypted = [pool.encrypt(LSH, n_jobs=num_cores) for LSH in LSHs]
+    else:
+        encryptor = CRTEncryptor(private_key)
+        encrypted = [Parallel(n_jobs=num_cores)(delayed(encryptor.encrypt)(x) for x in LSH) for LSH in LSHs]
+    
+    print("...encrypt complete: Encrypt time (min) = %s" % str(float(time.time() - encrypt_start)/60))
+    print("searching, decrypting and ranking results as they arrive...")
+    
+    search_start = time.time()
+    
+    key = METRICS[rank_by]
+    best = [TopK(num_results) for _ in queries]
+    
+    with DecryptionService(private_key, num_cores) as decryptor:
+        for number, chunk in search_batch(encrypted, data_dir, stride = stride, limit = search_limit, encoding = encoding, minhash_bits = minhash_bits):
+            for id_ in chunk.unpack(decryptor):
+                score_set = calc_iou(id_, private_key, query_mags[number], key)
+                best[number].push(score_set[key], score_set)
+    
+    print("...scores complete: Search time (min) = %s" % str(float(time.time() - search_start)/60))
+    print("fetching sequences of the best matches...")
+    
+    results = []
+    for top in best:
+        results.append([score_set[:3] + (score_set[3], score_set[5], fetch_sequence(data_dir, score_set[3], score_set[5]), score_set[4])
+                        for score_set in top.items()])
+    
+    print("...search complete \n")
+    
+    return results
+
+
 ####################
 # Query a database with a query and public key and decrypt using a private key
 ####################
-def query(query, public_key, private_key, dev, data_dir):
+def query(query, public_key, private_key, dev, data_dir, stride = None, workers = None, pool = None, cache = None):
     """Encodes a query and searches for it in the data base.
 
     Args:
         query: A genetic sequence (string) to be searched for.
         public_key: The public key for the paillier encryption.
         private_key: The private key for the paillier encryption.
+        stride: if given, searches whole database entries in windows
+            starting every stride bases.
+        workers: if given, the addresses of shard workers searching the
+            database.
+        pool: if given, an ObfuscatorPool (see p_obfuscation) for the
+            public key, making encryption one multiply per bit.
+        cache: if given, the (KeyStore, StoredKey) whose cache of encrypted
+            queries is used, so a repeated query is not encrypted again.
 
     Returns:
         The 'Gene' that is the 'best match' to the query.
 
         The IOU for the 'best match' and the query.
+
+        The offset of the best matching window in the 'best match'.
+
+        The num_results best matches, each a tuple of IoU, IoLquery,
+        IoLresult, entry id, offset, sequence and magnitude.
     """
     global num_cores
 
     print("encoding query...")
     
-    query = encode(query)
+    query = encode_query(query)
     
     print('Length of query BF: ' + str(len(query)))
     print("...encode complete\n")
@@ -117,51 +306,123 @@ def query(query, public_key, private_key, dev, data_dir):
     
     encrypt_start = time.time()
     
-    query = Parallel(n_jobs=num_cores)(delayed(public_key.encrypt)(x) for x in query)
+    # A cached query was encrypted by an earlier run under the same key pair
+    LSH = query
+    cached = cache[0].cached_query(cache[1], LSH) if cache else None
+    pipeline = pipelined and not (cache or server or workers)
+    if cached is not None:
+        query = cached
+    elif pipeline:
+        # Ranges of bits are encrypted as the database shards take them.
+        if pool is not None:
+            encrypt = lambda bits: pool.encrypt(bits, n_jobs=num_cores)
+        else:
+            encryptor = CRTEncryptor(private_key)
+            encrypt = lambda bits: [encryptor.encrypt(x) for x in bits]
+    elif pool is not None:
+        pool.wait(len(query))
+        query = pool.encrypt(query, n_jobs=num_cores)
+    else:
+        encryptor = CRTEncryptor(private_key)
+        query = Parallel(n_jobs=num_cores)(delayed(encryptor.encrypt)(x) for x in query)
+
+    if cache and cached is None:
+        query = cache[0].cache_query(cache[1], LSH, query)
 
     encrypt_end = time.time()
     
-    print("...encrypt complete: Encrypt time (min) = %s" % str(float(encrypt_end - encrypt_start)/60))
+    if pipeline:
+        print("...the query is encrypted as it is searched")
+    else:
+        print("...encrypt complete: Encrypt time (min) = %s" % str(float(encrypt_end - encrypt_start)/60))
     print("generating scores...")
     
-    scores = search(query, data_dir = data_dir)
+    # Results arrive in chunks, with entry ids instead of sequences.
+    if server:
+        chunks = search_server(query, server, stride = stride, packed = True, limit = search_limit, encoding = encoding, minhash_bits = minhash_bits)
+    elif workers:
+        # Workers reading the same directory are each sent their part of it.
+        entries = sorted(os.listdir(data_dir))[:search_limit] if os.path.isdir(data_dir) else None
+        chunks = (chunk for _, chunk in stream_shards(query, workers, stride = stride, packed = True, ids = True, entries = entries, encoding = encoding, minhash_bits = minhash_bits))
+    elif pipeline:
+        chunks = search_pipelined(encrypt_chunks(LSH, encrypt), data_dir, stride = stride, packed = True, limit = search_limit, n_shards = num_cores, encoding = encoding, minhash_bits = minhash_bits)
+    else:
+        chunks = search_stream(query, data_dir, stride = stride, packed = True, limit = search_limit, encoding = encoding, minhash_bits = minhash_bits)
+    
+    print("decrypting and ranking results as they arrive...")
     
-    print("...scores complete")
-    print("performing search...")
+    decrypt_start = time.time()
     
-    max_iou = 0
-    best_id = 0
-    best_seq = ''
-    result_scores = Parallel(n_jobs=num_cores)(delayed(calc_iou)(id_, private_key, query_mag) for id_ in scores)
+    key = METRICS[rank_by]
+    # Decrypt each chunk as it arrives, keeping only the best results. The
+    # decryption workers load the private key once.
+    with DecryptionService(private_key, num_cores) as decryptor:
+        decrypted = (chunk.unpack(decryptor) for chunk in chunks)
+        top = top_k(decrypted, lambda id_: calc_iou(id_, private_key, query_mag, key), num_results, rank_by)
     
-    for score_set in result_scores:
-        if score_set[0] >= max_iou: 
-            max_iou = score_set[0]
-            max_ioLquery = score_set[1]
-            max_ioLresult = score_set[2]  
-            best_seq = score_set[3]
-            result_mag = score_set[4]
+    decrypt_end = time.time()
+    
+    print("...scores complete: Search time (min) = %s" % str(float(decrypt_end - decrypt_start)/60))
+    print("fetching sequences of the best matches...")
+    
+    # Only the best matches' sequences are read.
+    if server:
+        sequences = fetch_server_sequences(server, [(score_set[3], score_set[5]) for score_set in top])
+    elif workers:
+        sequences = fetch_shard_sequences(workers, [(score_set[3], score_set[5]) for score_set in top])
+    else:
+        sequences = [fetch_sequence(data_dir, score_set[3], score_set[5]) for score_set in top]
+    
+    top = [score_set[:3] + (score_set[3], score_set[5], seq, score_set[4])
+           for score_set, seq in zip(top, sequences)]
+    
+    max_iou, max_ioLquery, max_ioLresult, best_seq, result_mag, best_offset = 0, 0, 0, '', 0, 0
+    if top:
+        max_iou, max_ioLquery, max_ioLresult, _, best_offset, best_seq, result_mag = top[0]
             
     print("...search complete \n")
     
-    return max_iou, max_ioLquery, max_ioLresult, best_seq, result_mag
+    return max_iou, max_ioLquery, max_ioLresult, best_seq, result_mag, best_offset, top
+
+
+####################
+# Encode a query
+####################
+def encode_query(seq):
+    """Encodes a query as a bloom filter, or as a MinHash sketch if encoding
+    is 'minhash'.
+    """
+    if encoding == 'minhash':
+        return minhash_encode(seq, SIZE, bits = minhash_bits)
+    return encode(seq)
 
 
 ####################
 # Calculate the Intersection over Union
 ####################
-def calc_iou(id_, private_key, query_mag):
-    intersection = private_key.decrypt(id_[0])
+def calc_iou(id_, private_key, query_mag, key = 0):
+    # Windowed results hold one score per window; keep the best window by
+    # the comparison at position key of the score sets.
+    if isinstance(id_, list):
+        return max((calc_iou(window, private_key, query_mag) for window in id_),
+                   key=lambda score_set: score_set[key])
+    
+    # Packed results are already decrypted.
+    intersection = private_key.decrypt(id_[0]) if isinstance(id_[0], paillier.EncryptedNumber) else id_[0]
     Iou, IoLquery, IoLresult = iou(intersection, id_[1], query_mag)
+    offset = id_[3] if len(id_) > 3 else 0
     
-    return Iou, IoLquery, IoLresult, id_[2], id_[1]
+    return Iou, IoLquery, IoLresult, id_[2], id_[1], offset
 
 
 ####################
 # Calculate the Intersection over Union
 ####################
 def iou(intersection, data_mag, query_mag):
-    """Finds the IOU for two bloom filters.
+    """Finds the IOU for two bloom filters. With MinHash sketches the IOU is
+    the estimated Jaccard similarity of the k-mer sets (see
+    p_bloom_filter.minhash_jaccard), and the IoLs are the fraction of
+    matching MinHashes.
 
     Args:
         intersection: The intersection of the two genes.
@@ -169,13 +430,17 @@ def iou(intersection, data_mag, query_mag):
         query_mag: The magnitude of the gene being searched for.
 
     Returns:
-        The IOU for the two genes.
+        The IOU for the two genes. Each ratio is 0 if its denominator is,
+        e.g. for a sequence of only 'N' bases, which sets no bits.
     """
     union = (data_mag + query_mag) - intersection
     
-    iou = intersection/union
-    max_ioLquery = intersection/query_mag
-    max_ioLresult = intersection/data_mag
+    if encoding == 'minhash':
+        iou = minhash_jaccard(intersection, SIZE, minhash_bits) if data_mag and query_mag else 0
+    else:
+        iou = intersection/union if union else 0
+    max_ioLquery = intersection/query_mag if query_mag else 0
+    max_ioLresult = intersection/data_mag if data_mag else 0
     
     return iou, max_ioLquery, max_ioLresult
 
@@ -184,5 +449,11 @@ def iou(intersection, data_mag, query_mag):
 # Main
 ####################
 if __name__ == '__main__':
-    main(sys.argv[1], sys.argv[2])
+    if sys.argv[1] == 'batch':
+        # p_querier.py batch data_dir query1.fasta query2.fasta ...
+        main_batch(sys.argv[3:], sys.argv[2])
+    elif len(sys.argv) > 3:
+        main(sys.argv[1], sys.argv[2], stride = int(sys.argv[3]))
+    else:
+        main(sys.argv[1], sys.argv[2])
     sys.exit(0)
\ No newline at end of file
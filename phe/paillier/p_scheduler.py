@@ -0,0 +1,215 @@
+"""Batched scheduling of database scans. Scoring one FASTA file is a small
+task, and file sizes range from plasmids to whole genomes, so one task per
+file spends its time on dispatch and leaves a few large files running alone
+at the end. Files are instead grouped into batches of similar total size,
+dispatched largest first, and each batch reads the next files ahead on a
+thread while the current one is scored.
+"""
+
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from joblib import Parallel, delayed
+
+BATCH_COST = 1 << 20    # Bytes of FASTA scored per batch
+MAX_BATCH = 64          # Files per batch
+PREFETCH = 2            # Files read ahead of the one being scored
+READ_BLOCK = 1 << 16    # Bytes read at a time when prefetching
+num_cores = 48 # Number of cores for parellel processing
+
+####################
+# Group entries into batches
+####################
+def plan_batches(costs, batch_cost=BATCH_COST, max_batch=MAX_BATCH):
+    """Groups entries into batches, largest entries first. An entry costing
+    batch_cost or more gets a batch of its own; smaller ones are added to a
+    batch until it costs batch_cost or holds max_batch entries.
+
+    Args:
+        costs: The cost (e.g. bytes to read) of each entry.
+        batch_cost: The cost at which a batch is full.
+        max_batch: The number of entries at which a batch is full.
+
+    Returns:
+        Lists of entry indices, the batch with the largest entry first.
+    """
+    order = sorted(range(len(costs)), key=lambda i: costs[i], reverse=True)
+
+    batches = []
+    batch, total = [], 0
+    for i in order:
+        batch.append(i)
+        total += costs[i]
+        if total >= batch_cost or len(batch) >= max_batch:
+            batches.append(batch)
+            batch, total = [], 0
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+####################
+# Read a file ahead of its use
+####################
+def prefetch(path, nbytes=None):
+    """Reads up to nbytes of a file (all of it if None) and discards them, so
+    that they are in the page cache when the file is parsed.
+    """
+    try:
+        with open(path, 'rb', buffering=0) as handle:
+            remaining = nbytes
+            while remaining is None or remaining > 0:
+                block = handle.read(READ_BLOCK if remaining is None else min(READ_BLOCK, remaining))
+                if not block:
+                    break
+                if remaining is not None:
+                    remaining -= len(block)
+    except OSError:
+        # The scoring function reports missing files.
+        pass
+
+
+####################
+# Score one batch
+####################
+def run_batch(score, items, paths, readahead=None, batch=0):
+    """Scores a batch of entries in order, reading the next PREFETCH files
+    on threads while the current entry is scored.
+
+    Args:
+        score: The function scoring one entry, called as score(item).
+        items: The entries of the batch.
+        paths: The file read by score for each entry.
+        readahead: The bytes of each file to prefetch, all if None.
+        batch: The number of the batch, for its timing.
+
+    Returns:
+        The scores of the entries, in order.
+
+        The timing of the batch: a dict of its number, entries, bytes
+        prefetched, start and end times (seconds since the epoch) and the
+        seconds spent waiting for prefetches.
+    """
+    start = time.time()
+    waited = 0.0
+    nbytes = 0
+
+    with ThreadPoolExecutor(max_workers=PREFETCH) as pool:
+        pending = [pool.submit(prefetch, path, readahead) for path in paths[:PREFETCH]]
+
+        scores = []
+        for i, item in enumerate(items):
+            wait_start = time.time()
+            pending[i].result()
+            waited += time.time() - wait_start
+            if i + PREFETCH < len(paths):
+                pending.append(pool.submit(prefetch, paths[i + PREFETCH], readahead))
+
+            try:
+                size = os.path.getsize(paths[i])
+                nbytes += size if readahead is None else min(size, readahead)
+            except OSError:
+                pass
+            scores.append(score(item))
+
+    timing = {'batch': batch, 'entries': len(items), 'bytes': nbytes,
+              'start': start, 'end': time.time(), 'wait': waited}
+
+    return scores, timing
+
+
+####################
+# Score all entries in batches
+####################
+def iter_batches(score, items, paths, costs=None, readahead=None, n_jobs=num_cores,
+                 batch_cost=BATCH_COST, max_batch=MAX_BATCH):
+    """Scores entries in parallel batches, see plan_batches and run_batch,
+    yielding each batch as it is done so results can be consumed as a
+    stream.
+
+    Args:
+        score: The function scoring one entry, called as score(item) in a
+            worker process.
+        items: The entries to score.
+        paths: The file read by score for each entry.
+        costs: The cost of each entry. The file sizes, up to readahead
+            bytes, if None.
+        readahead: The bytes of each file read by score, all if None.
+        n_jobs: The number of processes scoring batches.
+        batch_cost, max_batch: As in plan_batches.
+
+    Yields:
+        (indices in items, scores, timing) for each batch, in the order run.
+    """
+    if costs is None:
+        costs = [file_cost(path, readahead) for path in paths]
+
+    batches = plan_batches(costs, batch_cost, max_batch)
+
+    results = Parallel(n_jobs=n_jobs, batch_size=1, return_as='generator')(
+        delayed(run_batch)(score, [items[i] for i in batch], [paths[i] for i in batch],
+                           readahead, number)
+        for number, batch in enumerate(batches))
+
+    for batch, (batch_scores, timing) in zip(batches, results):
+        yield batch, batch_scores, timing
+
+
+def run_batches(score, items, paths, costs=None, readahead=None, n_jobs=num_cores,
+                batch_cost=BATCH_COST, max_batch=MAX_BATCH):
+    """Scores entries in parallel batches, as iter_batches.
+
+    Returns:
+        The scores of the entries, in the order of items.
+
+        The timing of each batch, see run_batch, in the order run.
+    """
+    scores = [None] * len(items)
+    timings = []
+    for batch, batch_scores, timing in iter_batches(score, items, paths, costs, readahead,
+                                                    n_jobs, batch_cost, max_batch):
+        for i, batch_score in zip(batch, batch_scores):
+            scores[i] = batch_score
+        timings.append(timing)
+
+    return scores, timings
+
+
+def file_cost(path, readahead=None):
+    """The bytes of a file that are read, at most readahead."""
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return 0
+    return size if readahead is None else min(size, readahead)
+
+
+####################
+# Report the timings of batches
+####################
+def report_batches(timings, out=sys.stdout, limit=None):
+    """Prints the timing of each batch, and a summary line, to tune
+    BATCH_COST and MAX_BATCH.
+
+    Args:
+        timings: Batch timings from run_batches.
+        out: The stream written to.
+        limit: Print only the limit slowest batches, all if None.
+    """
+    if not timings:
+        return
+
+    first = min(t['start'] for t in timings)
+    rows = sorted(timings, key=lambda t: t['end'] - t['start'], reverse=True)[:limit]
+    out.write('batch  entries        MB   start(s)  time(s)  wait(s)\n')
+    for t in sorted(rows, key=lambda t: t['batch']):
+        out.write('%5d  %7d  %8.2f  %9.2f  %7.2f  %7.2f\n'
+                  % (t['batch'], t['entries'], t['bytes'] / 2.0**20, t['start'] - first,
+                     t['end'] - t['start'], t['wait']))
+
+    times = [t['end'] - t['start'] for t in timings]
+    out.write('%d batches, %.2f s mean, %.2f s max, %.2f s wall\n'
+              % (len(times), sum(times) / len(times), max(times),
+                 max(t['end'] for t in timings) - first))
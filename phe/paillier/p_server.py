@@ -0,0 +1,471 @@
+"""The Database role as a long-lived asyncio server. The server keeps a pool
+of scoring processes running, with the LSH index (see p_index) open in each,
+and searches for encrypted queries from several clients at once, streaming
+the results of each back as they are scored.
+
+Protocol: each frame is a kind byte and a big-endian uint64 length, followed
+by the body. Queries and results are p_wire messages, so no pickle crosses
+the connection. A client sends:
+
+    SEARCH  a big-endian uint32 length, JSON options (stride, limit,
+            packed, encoding, minhash_bits), then the encrypted query as a
+            p_wire query message
+    CANCEL  (empty) stops the running search
+    FETCH   JSON list of [id, offset], see p_database.fetch_sequence
+
+and the server replies to a search with RESULTS frames (one p_wire results
+message per chunk of entries), then DONE (JSON with the number of results
+and whether the search was cancelled) or ERROR (a message). A FETCH is
+answered with a FETCH frame holding the JSON list of sequences, None for
+entries not in the database. A connection can carry any number of requests,
+one at a time: a request sent during a search cancels the search, and is
+served after its DONE. Closing the connection cancels its search.
+
+Each search keeps at most in_flight chunks submitted to the pool and waits
+for the client to drain each chunk before submitting another, so a slow
+client holds back only its own search. Cancelling a search drops the chunks
+that have not started; those being scored finish and are discarded.
+
+Workers score, pack and serialize the chunks, so the event loop only moves
+bytes. Serve on TCP with (host, port), or on a Unix socket with a path.
+"""
+
+import asyncio
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from joblib.externals.loky import get_reusable_executor
+import p_database
+from p_database import gen_scores, gen_index_scores, check_encoding
+from p_bloom_filter import MINHASH_BITS
+from p_index import index_path, build_index, open_index, pin_index
+from p_packing import PackedScores, slot_size
+from p_shared_query import SharedQuery
+from p_sparse_dot import as_query, BLOCK_BITS
+from p_shard import (FRAME, SEARCH, CANCEL, FETCH, RESULTS, DONE, ERROR, send_frame, recv_frame,
+                     dumps_json, search_body, parse_search, check_options, fetch_local)
+from p_wire import dumps_results, loads_results
+CHUNK_SIZE = 64     # Entries scored per task
+num_cores = 48 # Number of cores for parellel processing
+
+####################
+# Score chunks in the worker processes
+####################
+def _warm(seq_len, path):
+    """Initializes a worker process: the search settings of the server, and
+    the index opened once.
+    """
+    p_database.seq_len = seq_len
+    if path is not None:
+        open_index(path)
+
+
+def _build_index(data_dir, index_dir, seq_len, n_jobs):
+    """Builds the index, then stops the joblib workers that built it: a
+    process started by multiprocessing waits for them when it exits, and
+    they never exit on their own.
+    """
+    build_index(data_dir, index_dir, seq_len, n_jobs=n_jobs)
+    get_reusable_executor().shutdown(wait=True)
+
+
+def _pack(scores, query, packed):
+    """A chunk of results as a p_wire message."""
+    if packed:
+        # Intersections are at most the length of the query filter.
+        scores = PackedScores.from_scores(scores, slot_size(len(query)))
+    return dumps_results(scores, query.public_key)
+
+
+async def _create_shared(loop, query):
+    """Writes the query file of a search in a thread. If the search is
+    cancelled meanwhile, the file is removed once written.
+    """
+    creating = loop.run_in_executor(None, SharedQuery.create, query)
+    try:
+        return await asyncio.shield(creating)
+    except asyncio.CancelledError:
+        creating.add_done_callback(lambda f: f.cancelled() or f.exception() or f.result().unlink())
+        raise
+
+
+def _score_rows(query, packed, path, start, stop):
+    """Scores rows of the index, returning (count, p_wire message)."""
+    return stop - start, _pack(gen_index_scores(path, range(start, stop), query, ids=True), query, packed)
+
+
+def _score_files(query, packed, data_dir, ids, stride, encoding='bloom', minhash_bits=MINHASH_BITS):
+    """Scores FASTA files of the database, returning (count, p_wire message)."""
+    prepared = as_query(query, BLOCK_BITS)
+    scores = [gen_scores(id_, prepared, data_dir, stride, True, encoding, minhash_bits) for id_ in ids]
+    return len(ids), _pack(scores, query, packed)
+
+
+####################
+# Frames on asyncio streams
+####################
+async def read_frame(reader):
+    """Reads a (kind, body) frame, or None if the connection is closed."""
+    try:
+        kind, length = FRAME.unpack(await reader.readexactly(FRAME.size))
+        return kind, await reader.readexactly(length)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+
+
+async def write_frame(writer, kind, body=b''):
+    """Writes a frame, waiting while the client is behind."""
+    writer.write(FRAME.pack(kind, len(body)))
+    writer.write(body)
+    await writer.drain()
+
+
+####################
+# The Database server
+####################
+class DatabaseServer(object):
+    """Searches the database in data_dir for clients, see the protocol
+    above.
+
+    Args:
+        data_dir: A path to a directory with FASTA files to act as the database.
+        index_dir: If given, search the LSH index of data_dir in this
+            directory (built if missing), unless a search is windowed.
+        n_jobs: The number of scoring processes.
+        in_flight: The chunks a search may have submitted at once, n_jobs
+            if None.
+
+    Attributes:
+        sessions: The number of open client connections.
+    """
+    def __init__(self, data_dir, index_dir=None, n_jobs=num_cores, in_flight=None):
+        self.data_dir = data_dir
+        self.index_dir = index_dir
+        self.n_jobs = n_jobs
+        self.in_flight = in_flight or n_jobs
+        self.path = None
+        self.executor = None
+        self.server = None
+        self.sessions = 0
+
+    async def start(self, address):
+        """Opens the index, starts the scoring processes and listens.
+
+        Args:
+            address: (host, port) for TCP, port 0 picking a free port, or
+                the path of a Unix socket.
+
+        Returns:
+            The address listened on.
+        """
+        loop = asyncio.get_running_loop()
+        if self.index_dir:
+            self.path = index_path(self.index_dir, p_database.seq_len)
+            if not os.path.exists(self.path):
+                await loop.run_in_executor(None, _build_index, self.data_dir, self.index_dir,
+                                           p_database.seq_len, self.n_jobs)
+
+        self.executor = ProcessPoolExecutor(self.n_jobs, multiprocessing.get_context('spawn'),
+                                            initializer=_warm, initargs=(p_database.seq_len, self.path))
+        # Start every process now rather than on the first search.
+        await asyncio.gather(*[loop.run_in_executor(self.executor, _warm, p_database.seq_len, self.path)
+                               for _ in range(self.n_jobs)])
+
+        if isinstance(address, str):
+            self.server = await asyncio.start_unix_server(self.handle, address)
+            return address
+        self.server = await asyncio.start_server(self.handle, *address)
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def serve_forever(self):
+        await self.server.serve_forever()
+
+    async def close(self):
+        """Stops listening and stops the scoring processes."""
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+    ####################
+    # Serve one client
+    ####################
+    async def handle(self, reader, writer):
+        """Serves the requests of one connection, one at a time."""
+        self.sessions += 1
+        next_frame = asyncio.ensure_future(read_frame(reader))
+        queued = None
+        try:
+            while True:
+                if queued is not None:
+                    frame, queued = queued, None
+                else:
+                    frame = await next_frame
+                    if frame is None:
+                        break
+                    next_frame = asyncio.ensure_future(read_frame(reader))
+                kind, body = frame
+
+                if kind == SEARCH:
+                    search = asyncio.ensure_future(self.search(body, writer))
+                    await asyncio.wait({search, next_frame}, return_when=asyncio.FIRST_COMPLETED)
+                    if search.done():
+                        search.result()
+                    else:
+                        # A cancel, or any frame or a close, stops the search.
+                        # Any other request is served next.
+                        search.cancel()
+                        count = await search
+                        if next_frame.result() is not None:
+                            await write_frame(writer, DONE, dumps_json({'count': count, 'cancelled': True}))
+                            queued = next_frame.result()
+                            next_frame = asyncio.ensure_future(read_frame(reader))
+                elif kind == FETCH:
+                    results = json.loads(body.decode('utf-8'))
+                    await write_frame(writer, FETCH, dumps_json([fetch_local(self.data_dir, id_, offset)
+                                                            for id_, offset in results]))
+                elif kind != CANCEL:
+                    await write_frame(writer, ERROR, b'unknown request %r' % kind)
+        except ConnectionError:
+            pass
+        finally:
+            next_frame.cancel()
+            self.sessions -= 1
+            writer.close()
+
+    def tasks(self, path, stride, limit, encoding='bloom', minhash_bits=MINHASH_BITS):
+        """The scoring tasks of a search, as (function, arguments after the
+        query and packed). MinHash searches encode the FASTA files, as the
+        index holds bloom filters.
+
+        Args:
+            path: The generation of the index pinned for the search, or None.
+        """
+        check_encoding(encoding)
+        if path is not None and not stride and encoding == 'bloom':
+            n_entries = len(open_index(path))
+            n_entries = n_entries if limit is None else min(n_entries, limit)
+            return [(_score_rows, (path, start, min(start + CHUNK_SIZE, n_entries)))
+                    for start in range(0, n_entries, CHUNK_SIZE)]
+
+        ids = sorted(os.listdir(self.data_dir))[:limit]
+        return [(_score_files, (self.data_dir, ids[start:start + CHUNK_SIZE], stride, encoding, minhash_bits))
+                for start in range(0, len(ids), CHUNK_SIZE)]
+
+    async def search(self, body, writer):
+        """Runs one search, streaming each chunk of results to the client
+        in order.
+
+        Returns:
+            The number of entries whose results were sent.
+        """
+        loop = asyncio.get_running_loop()
+        count = 0
+        pending = deque()
+        try:
+            # Decoding and writing the query would hold up every client.
+            options, query = await loop.run_in_executor(None, parse_search, body)
+            check_options(options)
+            stride, packed = options.get('stride'), options.get('packed', True)
+
+            # The workers read the generation of the index the tasks were
+            # planned on, even if it is refreshed during the search.
+            query = await _create_shared(loop, query)
+            with query, pin_index(self.path) as path:
+                tasks = iter(self.tasks(path, stride, options.get('limit'), options.get('encoding', 'bloom'),
+                                        options.get('minhash_bits', MINHASH_BITS)))
+
+                def submit():
+                    for function, args in tasks:
+                        pending.append(loop.run_in_executor(self.executor, function, query, packed, *args))
+                        return
+
+                for _ in range(self.in_flight):
+                    submit()
+                while pending:
+                    n, message = await pending.popleft()
+                    submit()
+                    await write_frame(writer, RESULTS, message)
+                    count += n
+
+            await write_frame(writer, DONE, dumps_json({'count': count, 'cancelled': False}))
+        except asyncio.CancelledError:
+            pass
+        except ConnectionError:
+            raise
+        except Exception as e:
+            await write_frame(writer, ERROR, ('%s: %s' % (type(e).__name__, e)).encode('utf-8'))
+        finally:
+            for future in pending:
+                future.cancel()
+        return count
+
+
+def serve(data_dir, address, index_dir=None, n_jobs=num_cores, ready=None):
+    """Runs a Database server until it is killed.
+
+    Args:
+        data_dir, index_dir, n_jobs: As in DatabaseServer.
+        address: As in DatabaseServer.start.
+        ready: If given, a queue to put the address listened on once the
+            server accepts connections.
+    """
+    async def run():
+        # SIGTERM stops the server cleanly, with its scoring processes.
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        server = DatabaseServer(data_dir, index_dir, n_jobs)
+        try:
+            listening = await server.start(address)
+            if ready is not None:
+                ready.put(listening)
+            await server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            await server.close()
+
+    asyncio.run(run())
+
+
+####################
+# Clients
+####################
+def connect(address, timeout=None):
+    """A socket connected to a server at (host, port) or a Unix socket path."""
+    if isinstance(address, str):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(address)
+        return sock
+    return socket.create_connection(tuple(address), timeout)
+
+
+def search_server(query, address, stride=None, packed=True, limit=None, timeout=None,
+                  encoding='bloom', minhash_bits=MINHASH_BITS):
+    """Searches for an encrypted query on a Database server, yielding the
+    chunks of results as they arrive. Closing the generator early cancels
+    the search.
+
+    Args:
+        query: The encrypted bloom filter (list of EncryptedNumber, or a
+            SharedQuery) of the gene being searched for.
+        address: The address of the server, see connect.
+        stride, packed, limit, encoding, minhash_bits: As in
+            p_database.search_stream.
+        timeout: Seconds to wait for the server to connect or send.
+
+    Yields:
+        Lists (or PackedScores if packed) of results, as search_stream does.
+    """
+    # A query file is local to this machine, so the server gets the entries.
+    if isinstance(query, SharedQuery):
+        query = [query[i] for i in range(len(query))]
+    options = {'stride': stride, 'packed': packed, 'limit': limit, 'encoding': encoding,
+               'minhash_bits': minhash_bits}
+
+    with connect(address, timeout) as sock:
+        send_frame(sock, SEARCH, search_body(options, query))
+        done = False
+        try:
+            while True:
+                frame = recv_frame(sock)
+                if frame is None:
+                    raise ConnectionError('server closed the connection')
+                kind, body = frame
+                if kind == RESULTS:
+                    yield loads_results(body)
+                elif kind == DONE:
+                    done = True
+                    return
+                else:
+                    raise RuntimeError(body.decode('utf-8'))
+        finally:
+            if not done:
+                try:
+                    send_frame(sock, CANCEL)
+                except OSError:
+                    pass
+
+
+def fetch_server_sequences(address, results, timeout=None):
+    """Asks a Database server for the sequences of a few results.
+
+    Args:
+        address: The address of the server, see connect.
+        results: (id, offset) of each result, as in p_database.fetch_sequence.
+
+    Returns:
+        The sequence of each result, or None if the server does not have it.
+    """
+    with connect(address, timeout) as sock:
+        send_frame(sock, FETCH, dumps_json([list(result) for result in results]))
+        frame = recv_frame(sock)
+    if frame is None or frame[0] != FETCH:
+        raise RuntimeError('server at %s did not send sequences' % (address,))
+    return json.loads(frame[1].decode('utf-8'))
+
+
+####################
+# Start a server on this host
+####################
+def start_local_server(data_dir, address=('127.0.0.1', 0), index_dir=None, n_jobs=num_cores):
+    """Starts a Database server as a local process, e.g. for testing.
+
+    Returns:
+        The address the server listens on.
+
+        The server process, to pass to stop_local_server.
+    """
+    context = multiprocessing.get_context('spawn')
+    ready = context.Queue()
+    process = context.Process(target=serve, args=(data_dir, address),
+                              kwargs={'index_dir': index_dir, 'n_jobs': n_jobs, 'ready': ready},
+                              daemon=False)
+    process.start()
+
+    while True:
+        try:
+            return ready.get(timeout=1), process
+        except queue.Empty:
+            if not process.is_alive():
+                raise RuntimeError('the Database server exited before accepting connections')
+
+
+def stop_local_server(process):
+    """Stops a server started by start_local_server."""
+    process.terminate()
+    process.join()
+
+
+####################
+# Main
+####################
+if __name__ == '__main__':
+    if len(sys.argv) >= 4 and sys.argv[1] == 'serve':
+        target = sys.argv[3]
+        if ':' in target:
+            host, port = target.rsplit(':', 1)
+            target = (host, int(port))
+        print('serving %s on %s' % (sys.argv[2], sys.argv[3]))
+        serve(sys.argv[2], target, index_dir=sys.argv[4] if len(sys.argv) > 4 else None)
+    elif len(sys.argv) >= 4 and sys.argv[1] == 'local':
+        import p_querier
+        address, process = start_local_server(sys.argv[3])
+        try:
+            p_querier.server = address
+            p_querier.main(sys.argv[2], sys.argv[3], stride=int(sys.argv[4]) if len(sys.argv) > 4 else None)
+        finally:
+            stop_local_server(process)
+    else:
+        print('usage: python p_server.py serve data_dir host:port|unix_socket_path [index_dir]\n'
+              '       python p_server.py local query.fasta data_dir [stride]')
+        sys.exit(2)
+    sys.exit(0)
@@ -0,0 +1,505 @@
+"""Sharded search of a database. A coordinator sends the encrypted query once
+to each of several shard workers (processes on this or other hosts), each
+worker scores its part of the database and streams its results back as they
+are computed, and the coordinator merges them in shard order. Either the
+coordinator splits a list of entry ids between the workers (when they share
+the database, e.g. local workers), or each worker holds its own part of the
+database and scores all of it. Every entry is searched, in wall time
+proportional to the size of the database over the number of workers.
+
+Protocol: each frame is a kind byte and a big-endian uint64 length, followed
+by the body, as in p_server. The coordinator sends a SEARCH frame (a
+big-endian uint32 length, JSON options with the ids of the entries to score,
+then the encrypted query as a p_wire query message) or a FETCH frame (JSON list of [id, offset]). The worker
+replies to a search with RESULTS frames, one p_wire results message per
+batch of entries, then DONE (JSON with the number of results) or ERROR (a
+message), and to a fetch with a FETCH frame holding the JSON list of
+sequences. Nothing received is unpickled, so a worker only reads JSON and
+ciphertexts from its peers.
+"""
+
+import json
+import multiprocessing
+import os
+import queue
+import socket
+import socketserver
+import struct
+import sys
+import threading
+from contextlib import ExitStack
+import numpy as np
+from joblib import Parallel, delayed
+import p_database
+from p_database import FileScorer, gen_index_scores, fetch_sequence, check_encoding
+from p_bloom_filter import MINHASH_BITS
+from p_index import index_path, build_index, open_index, pin_index
+from p_packing import PackedScores, slot_size
+from p_shared_query import share, SharedQuery
+from p_scheduler import run_batches
+from p_fasta import BLOCK_SIZE
+from p_wire import dumps_query, loads_query, dumps_results, loads_results
+
+FRAME = struct.Struct('>cQ')
+OPTIONS = struct.Struct('>I')
+SEARCH, CANCEL, FETCH, RESULTS, DONE, ERROR = b'S', b'C', b'F', b'R', b'D', b'E'
+BATCH_SIZE = 64     # Entries scored by a worker between result messages
+num_cores = 48 # Number of cores for parellel processing
+
+####################
+# Send and receive frames
+####################
+def send_frame(sock, kind, body=b''):
+    sock.sendall(FRAME.pack(kind, len(body)) + body)
+
+
+def recv_exact(sock, n):
+    """Receives exactly n bytes, or None if the connection is closed first."""
+    buf = bytearray(n)
+    view = memoryview(buf)
+    received = 0
+    while received < n:
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            return None
+        received += count
+
+    return buf
+
+
+def recv_frame(sock):
+    """Receives a (kind, body) frame, or None if the connection is closed."""
+    header = recv_exact(sock, FRAME.size)
+    if header is None:
+        return None
+    kind, length = FRAME.unpack(header)
+    body = recv_exact(sock, length)
+    if body is None:
+        raise ConnectionError('connection closed in the middle of a frame')
+    return kind, bytes(body)
+
+
+def dumps_json(data):
+    return json.dumps(data).encode('utf-8')
+
+
+def search_body(options, query):
+    """The body of a SEARCH frame: options (dict) as JSON and the encrypted
+    query (list of EncryptedNumber) as a p_wire message.
+    """
+    options = dumps_json(options)
+    return OPTIONS.pack(len(options)) + options + dumps_query(query)
+
+
+def parse_search(body):
+    """The options (dict) and encrypted query of a SEARCH frame body."""
+    (length,) = OPTIONS.unpack(body[:OPTIONS.size])
+    options = json.loads(body[OPTIONS.size:OPTIONS.size + length].decode('utf-8'))
+    return options, loads_query(body[OPTIONS.size + length:])
+
+
+def check_options(options):
+    """Raises ValueError for search options a client sent that the search
+    cannot run with, before any work is dispatched (a stride of 0 or less
+    would never move the window).
+    """
+    if not isinstance(options, dict):
+        raise ValueError('search options must be an object')
+    def check_int(name, least, default=None):
+        # Options without a default may be None.
+        value = options.get(name, default)
+        if value is None and default is None:
+            return
+        if not isinstance(value, int) or isinstance(value, bool) or value < least:
+            raise ValueError('%s must be an integer of at least %d' % (name, least))
+
+    check_int('stride', 1)
+    check_int('limit', 0)
+    check_int('minhash_bits', 1, MINHASH_BITS)
+    for name in ('packed', 'ids'):
+        if not isinstance(options.get(name, False), bool):
+            raise ValueError('%s must be true or false' % name)
+    if not isinstance(options.get('entries', []), (list, type(None))):
+        raise ValueError('entries must be a list of ids')
+    check_encoding(options.get('encoding', 'bloom'))
+
+
+####################
+# Split the entries of a database into shards
+####################
+def shard_entries(entries, shard, n_shards):
+    """Finds the contiguous part of entries that belongs to a shard.
+
+    Args:
+        entries: The entries (sequence) of the whole database, in a fixed
+            order.
+        shard: The index of the shard, from 0 to n_shards - 1.
+        n_shards: The number of shards.
+
+    Returns:
+        The entries of the shard.
+    """
+    bounds = np.linspace(0, len(entries), n_shards + 1).astype(int)
+
+    return entries[bounds[shard]:bounds[shard + 1]]
+
+
+####################
+# Score the entries of one shard
+####################
+def score_shard(query, data_dir, entries=None, stride=None, index_dir=None,
+                n_jobs=num_cores, batch_size=BATCH_SIZE, ids=False, encoding='bloom',
+                minhash_bits=MINHASH_BITS):
+    """Scores the entries of one shard of the database, as p_database.search
+    does for the whole of it.
+
+    Args:
+        query: The encrypted bloom filter (array) of the gene being searched for.
+        data_dir: A path to a directory with FASTA files to act as the database.
+        entries: The ids (file names) of the entries to score, as chosen by
+            the coordinator, or None to score every entry in data_dir (or
+            the index).
+        stride: As in p_database.search.
+        index_dir: As in p_database.search.
+        n_jobs: The number of processes scoring entries.
+        batch_size: The number of entries scored at a time.
+        ids: If True, give results in the format of
+            p_database.search_stream, with entry ids instead of sequences.
+        encoding, minhash_bits: As in p_database.search. MinHash searches
+            encode the FASTA files, as the index holds bloom filters.
+
+    Yields:
+        Lists of results of consecutive entries, in the format of
+        p_database.search.
+    """
+    check_encoding(encoding)
+    # Ids are file names; never read outside data_dir.
+    if entries is not None and any(not isinstance(id_, str) or os.path.basename(id_) != id_
+                                   for id_ in entries):
+        raise ValueError('entry ids must be file names in the database directory')
+
+    with share(query) as query, ExitStack() as stack:
+        if index_dir and not stride and encoding == 'bloom':
+            path = index_path(index_dir, p_database.seq_len)
+            if not os.path.exists(path):
+                build_index(data_dir, index_dir, p_database.seq_len, n_jobs=n_jobs)
+            # Workers read the generation the rows were looked up in.
+            path = stack.enter_context(pin_index(path))
+            index = open_index(path)
+            if entries is None:
+                rows = range(len(index))
+            else:
+                row_of = dict((id_, i) for i, id_ in enumerate(index.ids()))
+                missing = [id_ for id_ in entries if id_ not in row_of]
+                if missing:
+                    raise KeyError('%d entries are not in the index, e.g. %s' % (len(missing), missing[0]))
+                rows = [row_of[id_] for id_ in entries]
+
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start:start + batch_size]
+                bounds = np.linspace(0, len(batch), min(n_jobs, len(batch)) + 1).astype(int)
+                chunks = Parallel(n_jobs=n_jobs)(delayed(gen_index_scores)(path, batch[a:b], query, ids)
+                                                 for a, b in zip(bounds[:-1], bounds[1:]))
+                yield [score for chunk in chunks for score in chunk]
+        else:
+            if entries is None:
+                entries = sorted(os.listdir(data_dir))
+            readahead = None if stride else BLOCK_SIZE
+            score = FileScorer(query, data_dir, stride, ids, encoding, minhash_bits)
+
+            for start in range(0, len(entries), batch_size):
+                batch = entries[start:start + batch_size]
+                paths = [os.path.join(data_dir, id_) for id_ in batch]
+                scores, _ = run_batches(score, batch, paths, readahead=readahead, n_jobs=n_jobs)
+                yield scores
+
+
+####################
+# Shard worker
+####################
+class ShardHandler(socketserver.BaseRequestHandler):
+    """Serves one request from a coordinator: a search, or a fetch of the
+    sequences of results, answered with None for entries not in this
+    worker's data_dir.
+    """
+    def handle(self):
+        frame = recv_frame(self.request)
+        if frame is None:
+            return
+        kind, body = frame
+        server = self.server
+        try:
+            if kind == FETCH:
+                results = json.loads(body.decode('utf-8'))
+                send_frame(self.request, FETCH, dumps_json([fetch_local(server.data_dir, id_, offset)
+                                                            for id_, offset in results]))
+                return
+            if kind != SEARCH:
+                send_frame(self.request, ERROR, b'unknown request %r' % kind)
+                return
+
+            options, query = parse_search(body)
+            check_options(options)
+            public_key = query[0].public_key
+            count = 0
+            for scores in score_shard(query, server.data_dir, options.get('entries'),
+                                      options.get('stride'), server.index_dir, server.n_jobs,
+                                      ids=options.get('ids', False),
+                                      encoding=options.get('encoding', 'bloom'),
+                                      minhash_bits=options.get('minhash_bits', MINHASH_BITS)):
+                send_frame(self.request, RESULTS, dumps_results(scores, public_key))
+                count += len(scores)
+        except Exception as e:
+            send_frame(self.request, ERROR, ('%s: %s' % (type(e).__name__, e)).encode('utf-8'))
+            return
+
+        send_frame(self.request, DONE, dumps_json({'count': count}))
+
+
+def fetch_local(data_dir, id_, offset):
+    """The sequence of a result, or None if the entry is not in data_dir."""
+    # Ids are file names; never read outside data_dir.
+    if not isinstance(id_, str) or not isinstance(offset, int) or os.path.basename(id_) != id_ \
+            or not os.path.isfile(os.path.join(data_dir, id_)):
+        return None
+    return fetch_sequence(data_dir, id_, offset)
+
+
+class ShardServer(socketserver.ThreadingTCPServer):
+    """A shard worker, searching the database in data_dir for coordinators.
+
+    Args:
+        address: The (host, port) to listen on. Port 0 picks a free port.
+        data_dir: A path to a directory with FASTA files to act as the database.
+        index_dir: If given, search the LSH index of data_dir in this
+            directory, see p_index.
+        n_jobs: The number of processes scoring entries.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, data_dir, index_dir=None, n_jobs=num_cores):
+        self.data_dir = data_dir
+        self.index_dir = index_dir
+        self.n_jobs = n_jobs
+        socketserver.ThreadingTCPServer.__init__(self, address, ShardHandler)
+
+
+def serve_shard(data_dir, host='127.0.0.1', port=0, index_dir=None, n_jobs=num_cores,
+                ready=None):
+    """Runs a shard worker until it is killed.
+
+    Args:
+        data_dir, index_dir, n_jobs: As in ShardServer.
+        host, port: The address to listen on. Port 0 picks a free port.
+        ready: If given, a queue to put the (host, port) listened on once
+            the worker accepts connections.
+    """
+    server = ShardServer((host, port), data_dir, index_dir, n_jobs)
+    if ready is not None:
+        ready.put(server.server_address)
+    server.serve_forever()
+
+
+####################
+# Search a sharded database
+####################
+def stream_shards(query, workers, stride=None, packed=False, ids=False, timeout=None, entries=None,
+                  encoding='bloom', minhash_bits=MINHASH_BITS):
+    """Searches a database split over shard workers, yielding the results
+    of all workers as they arrive.
+
+    Args:
+        query: The encrypted bloom filter (array) of the gene being searched for.
+        workers: The (host, port) address of each worker.
+        stride: As in p_database.search.
+        packed: As in p_database.search, packing each chunk.
+        ids: If True, give results in the format of
+            p_database.search_stream, with entry ids instead of sequences.
+        timeout: Seconds to wait for a worker to connect or send.
+        entries: The ids of the entries to search, when every worker can
+            read all of them (e.g. local workers sharing data_dir). Worker i
+            is sent part i of len(workers), see shard_entries. If None, each
+            worker searches every entry it holds.
+        encoding, minhash_bits: As in p_database.search.
+
+    Yields:
+        (shard, results) for each chunk of results sent by a worker. The
+        chunks of one shard arrive in order.
+    """
+    # A query file is local to this machine, so workers get the entries.
+    if isinstance(query, SharedQuery):
+        query = [query[i] for i in range(len(query))]
+    # Serialize the query once for all workers.
+    query_bytes = dumps_query(query)
+    arrived = queue.Queue()
+
+    def gather(shard, address):
+        try:
+            part = None if entries is None else list(shard_entries(entries, shard, len(workers)))
+            options = dumps_json({'entries': part, 'stride': stride, 'ids': ids,
+                                  'encoding': encoding, 'minhash_bits': minhash_bits})
+            with socket.create_connection(address, timeout) as sock:
+                send_frame(sock, SEARCH, OPTIONS.pack(len(options)) + options + query_bytes)
+                while True:
+                    frame = recv_frame(sock)
+                    if frame is None:
+                        raise ConnectionError('worker closed the connection')
+                    kind, body = frame
+                    if kind == RESULTS:
+                        arrived.put(('scores', shard, loads_results(body)))
+                    elif kind == DONE:
+                        break
+                    else:
+                        raise RuntimeError(body.decode('utf-8', 'replace'))
+            arrived.put(('done', shard, None))
+        except Exception as e:
+            arrived.put(('error', shard, 'shard %d at %s:%d: %s'
+                         % ((shard,) + tuple(address[:2]) + (e,))))
+
+    for shard, address in enumerate(workers):
+        threading.Thread(target=gather, args=(shard, tuple(address)), daemon=True).start()
+
+    remaining = len(workers)
+    errors = []
+    while remaining:
+        kind, shard, body = arrived.get()
+        if kind == 'scores':
+            if packed:
+                # Intersections are at most the length of the query filter.
+                body = PackedScores.from_scores(body, slot_size(len(query)))
+            yield shard, body
+        else:
+            remaining -= 1
+            if kind == 'error':
+                errors.append(body)
+
+    if errors:
+        raise RuntimeError('sharded search failed: ' + '; '.join(errors))
+
+
+def search_shards(query, workers, stride=None, packed=False, timeout=None, entries=None,
+                  encoding='bloom', minhash_bits=MINHASH_BITS):
+    """Searches a database split over shard workers, see stream_shards, and
+    merges the results in shard order.
+
+    Returns:
+        The same as p_database.search, over all entries of all shards.
+    """
+    results = [[] for _ in workers]
+    for shard, scores in stream_shards(query, workers, stride, timeout=timeout, entries=entries,
+                                       encoding=encoding, minhash_bits=minhash_bits):
+        results[shard].extend(scores)
+
+    scores = [score for shard_scores in results for score in shard_scores]
+    if packed:
+        # Intersections are at most the length of the query filter.
+        scores = PackedScores.from_scores(scores, slot_size(len(query)))
+
+    return scores
+
+
+####################
+# Read the sequences of results from shard workers
+####################
+def fetch_shard_sequences(workers, results, timeout=None):
+    """Asks shard workers for the sequences of a few results.
+
+    Args:
+        workers: The (host, port) address of each worker.
+        results: (id, offset) of each result, as in p_database.fetch_sequence.
+        timeout: Seconds to wait for a worker to connect or send.
+
+    Returns:
+        The sequence of each result, from the first worker that has it, or
+        None if no worker has it.
+    """
+    sequences = [None] * len(results)
+    for address in workers:
+        missing = [i for i, seq in enumerate(sequences) if seq is None]
+        if not missing:
+            break
+        with socket.create_connection(tuple(address), timeout) as sock:
+            send_frame(sock, FETCH, dumps_json([list(results[i]) for i in missing]))
+            frame = recv_frame(sock)
+        if frame is None or frame[0] != FETCH:
+            raise RuntimeError('worker at %s:%d did not send sequences' % tuple(address[:2]))
+        for i, seq in zip(missing, json.loads(frame[1].decode('utf-8'))):
+            sequences[i] = seq
+
+    return sequences
+
+
+####################
+# Start shard workers on this host
+####################
+def start_local_workers(data_dir, n_workers, index_dir=None, n_jobs=None):
+    """Starts shard workers as local processes, e.g. for testing. The
+    workers share data_dir, so search them with the entries of data_dir
+    (see stream_shards) to split it between them.
+
+    Args:
+        data_dir, index_dir: As in ShardServer.
+        n_workers: The number of workers.
+        n_jobs: The number of processes scoring entries per worker. Shares
+            num_cores between the workers if None.
+
+    Returns:
+        The (host, port) address of each worker.
+
+        The worker processes, to pass to stop_local_workers.
+    """
+    if n_jobs is None:
+        n_jobs = max(num_cores // n_workers, 1)
+
+    context = multiprocessing.get_context('spawn')
+    ready = context.Queue()
+    processes = [context.Process(target=serve_shard, args=(data_dir,),
+                                 kwargs={'index_dir': index_dir, 'n_jobs': n_jobs, 'ready': ready},
+                                 daemon=True)
+                 for _ in range(n_workers)]
+    for process in processes:
+        process.start()
+
+    addresses = []
+    while len(addresses) < n_workers:
+        try:
+            addresses.append(ready.get(timeout=1))
+        except queue.Empty:
+            if not all(process.is_alive() for process in processes):
+                stop_local_workers(processes)
+                raise RuntimeError('a shard worker exited before accepting connections')
+
+    return addresses, processes
+
+
+def stop_local_workers(processes):
+    """Stops workers started by start_local_workers."""
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join()
+
+
+####################
+# Main
+####################
+if __name__ == '__main__':
+    if len(sys.argv) >= 4 and sys.argv[1] == 'worker':
+        host, port = sys.argv[3].rsplit(':', 1)
+        print('serving %s on %s:%s' % (sys.argv[2], host, port))
+        serve_shard(sys.argv[2], host=host, port=int(port),
+                    index_dir=sys.argv[4] if len(sys.argv) > 4 else None)
+    elif len(sys.argv) >= 5 and sys.argv[1] == 'local':
+        from p_querier import main
+        addresses, processes = start_local_workers(sys.argv[3], int(sys.argv[4]))
+        try:
+            main(sys.argv[2], sys.argv[3], stride=int(sys.argv[5]) if len(sys.argv) > 5 else None,
+                 workers=addresses)
+        finally:
+            stop_local_workers(processes)
+    else:
+        print('usage: python p_shard.py worker data_dir host:port [index_dir]\n'
+              '       python p_shard.py local query.fasta data_dir n_workers [stride]')
+        sys.exit(2)
+    sys.exit(0)
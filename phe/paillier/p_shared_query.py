@@ -0,0 +1,237 @@
+"""An encrypted query shared with worker processes through a memory-mapped
+file, instead of being pickled into every task.
+
+The query ciphertexts are written once as fixed-width big-endian integers.
+A SharedQuery pickles as just the path of the file; workers map the file and
+decode a ciphertext only when it is first used, so dispatching a task costs
+the same however long the query is.
+
+File layout (as p_index): the MAGIC bytes, the length of a JSON header as a
+little-endian uint64, the header (public key n, exponent, count and width of
+the ciphertexts), padding to ALIGN bytes, then the ciphertexts.
+"""
+
+import json
+import os
+import struct
+import tempfile
+from contextlib import contextmanager
+import numpy as np
+from phe import paillier
+
+try:
+    from gmpy2 import mpz
+except ImportError:
+    mpz = int
+
+MAGIC = b'GEMQRY01'
+ALIGN = 64
+# RAM-backed when available, so the file never reaches a disk.
+QUERY_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+MAX_ATTACHED = 16   # Query files kept mapped by a process at a time
+
+# Buffers attached in this process, by path, oldest first
+_attached = {}
+
+####################
+# Write an encrypted query to a file
+####################
+def write_query(path, enc_vector):
+    """Writes the ciphertexts of an encrypted query as fixed-width big-endian
+    integers.
+
+    Args:
+        path: Path of the file.
+        enc_vector: The encrypted bloom filter (array of EncryptedNumber),
+            all with the same public key and exponent.
+    """
+    public_key = enc_vector[0].public_key
+    exponent = enc_vector[0].exponent
+    width = (public_key.nsquare.bit_length() + 7) // 8
+
+    for x in enc_vector:
+        if x.public_key != public_key or x.exponent != exponent:
+            raise ValueError('encrypted entries must share a public key and exponent')
+
+    header = {'n': '%x' % public_key.n, 'exponent': exponent,
+              'count': len(enc_vector), 'width': width}
+    header_bytes = json.dumps(header).encode('utf-8')
+    start = len(MAGIC) + 8 + len(header_bytes)
+    header_bytes += b' ' * (-start % ALIGN)
+
+    with open(path, 'wb') as handle:
+        handle.write(MAGIC)
+        handle.write(struct.pack('<Q', len(header_bytes)))
+        handle.write(header_bytes)
+        for x in enc_vector:
+            handle.write(int(x.ciphertext(be_secure=False)).to_bytes(width, 'big'))
+
+
+####################
+# Map a query file
+####################
+class QueryBuffer(object):
+    """A mapped query file and the ciphertexts decoded from it so far.
+
+    Attributes:
+        public_key: The public key of the query.
+        exponent: The exponent of every ciphertext.
+        data: (count, width) uint8 memmap of the ciphertexts.
+        decoded: The ciphertexts (mpz or int) decoded so far, None if not.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as handle:
+            if handle.read(len(MAGIC)) != MAGIC:
+                raise ValueError('%s is not a query file' % path)
+            header_len, = struct.unpack('<Q', handle.read(8))
+            header = json.loads(handle.read(header_len).decode('utf-8'))
+
+        self.public_key = paillier.PaillierPublicKey(int(header['n'], 16))
+        self.exponent = header['exponent']
+        self.data = np.memmap(path, dtype=np.uint8, mode='r',
+                              offset=len(MAGIC) + 8 + header_len,
+                              shape=(header['count'], header['width']))
+        self.decoded = [None] * header['count']
+
+    def ciphertext(self, i):
+        """Raw ciphertext i, decoded on first use."""
+        c = self.decoded[i]
+        if c is None:
+            c = self.decoded[i] = mpz(int.from_bytes(self.data[i].tobytes(), 'big'))
+        return c
+
+
+def attach(path):
+    """Maps a query file, reusing the buffer if this process already mapped
+    the same file.
+
+    Worker processes outlive the searches whose files they map, and only
+    the process that created a file detaches it. Before mapping a new file,
+    buffers of files that were removed are dropped, and then the oldest
+    buffers, keeping at most MAX_ATTACHED.
+    """
+    st = os.stat(path)
+    version = (st.st_ino, st.st_mtime_ns)
+    buffer = _attached.get(path)
+    if buffer is None or buffer[0] != version:
+        _attached.pop(path, None)
+        for old in [old for old in _attached if not os.path.exists(old)]:
+            del _attached[old]
+        while len(_attached) >= MAX_ATTACHED:
+            del _attached[next(iter(_attached))]
+        buffer = (version, QueryBuffer(path))
+        _attached[path] = buffer
+    return buffer[1]
+
+
+####################
+# An encrypted query shared through a file
+####################
+class SharedQuery(object):
+    """An encrypted query stored in a query file. Indexing gives the
+    EncryptedNumber entries of the query, like the list it was made from;
+    raw_ciphertexts gives the raw ciphertexts without wrapping them.
+
+    Args:
+        path: Path of the query file, see write_query.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._buffer = None
+        self._owner = False
+
+    @classmethod
+    def create(cls, enc_vector, directory=QUERY_DIR):
+        """Writes an encrypted query to a new query file. The file is removed
+        by unlink, or when leaving a with block.
+        """
+        handle, path = tempfile.mkstemp(prefix='gemstone_query_', suffix='.q', dir=directory)
+        os.close(handle)
+        try:
+            write_query(path, enc_vector)
+        except Exception:
+            os.remove(path)
+            raise
+
+        shared = cls(path)
+        shared._owner = True
+        return shared
+
+    @property
+    def buffer(self):
+        if self._buffer is None:
+            self._buffer = attach(self.path)
+        return self._buffer
+
+    @property
+    def public_key(self):
+        return self.buffer.public_key
+
+    @property
+    def exponent(self):
+        return self.buffer.exponent
+
+    def __len__(self):
+        return len(self.buffer.decoded)
+
+    def __getitem__(self, i):
+        return paillier.EncryptedNumber(self.public_key, int(self.buffer.ciphertext(i)), self.exponent)
+
+    def raw_ciphertexts(self):
+        """The raw ciphertexts, as a sequence decoding each on first use."""
+        return RawCiphertexts(self.buffer)
+
+    def __getstate__(self):
+        # Only the path is sent to workers.
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def unlink(self):
+        """Removes the query file, if this SharedQuery created it."""
+        if self._owner and os.path.exists(self.path):
+            os.remove(self.path)
+        _attached.pop(self.path, None)
+        self._buffer = None
+        self._owner = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.unlink()
+
+
+class RawCiphertexts(object):
+    """The raw ciphertexts of a query buffer, decoded on first use."""
+    def __init__(self, buffer):
+        self.buffer = buffer
+
+    def __len__(self):
+        return len(self.buffer.decoded)
+
+    def __getitem__(self, i):
+        return self.buffer.ciphertext(i)
+
+
+####################
+# Share an encrypted query for the length of a search
+####################
+@contextmanager
+def share(query, directory=QUERY_DIR):
+    """Writes an encrypted query to a query file for the duration of a with
+    block, yielding the SharedQuery to pass to workers. Queries that are not
+    encrypted lists (plain filters, or already shared) are yielded unchanged.
+    """
+    if isinstance(query, SharedQuery) or len(query) == 0 \
+            or not isinstance(query[0], paillier.EncryptedNumber):
+        yield query
+        return
+
+    shared = SharedQuery.create(query, directory)
+    try:
+        yield shared
+    finally:
+        shared.unlink()
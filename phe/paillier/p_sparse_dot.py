@@ -0,0 +1,384 @@
+"""Sparse dot product between binary bloom filters and an encrypted (Paillier)
+bloom filter. The intersection of a binary filter with an encrypted query is
+the encrypted sum of the query entries at the filter's set bits, which in
+Paillier is the product of their ciphertexts mod n^2. The ciphertexts are
+multiplied as raw integers (gmpy2 when available) and only the final product
+is wrapped in an EncryptedNumber; zero bits cost nothing.
+
+Database entries overlap heavily, so an EncryptedQuery can also cache partial
+products: the filter is split into blocks of block_bits bits and the product
+for each bit pattern of a block that recurs is computed once per query. An
+entry's product is then one cached lookup per non-zero block. The cache holds
+at most cache_size products of n^2 size (CACHE_SIZE, about 16 MB per query
+and process with 2048 bit keys), and a pattern is only cached the second time
+it is used, so patterns met once do not fill it.
+
+A QueryBatch holds several encrypted queries, so each database filter is
+read, encoded and split into bits or blocks once for all of them.
+"""
+
+import numpy as np
+from phe import paillier
+from p_bloom_filter import PackedBloomFilter
+from p_shared_query import SharedQuery
+
+try:
+    from gmpy2 import mpz
+except ImportError:
+    mpz = int
+
+BLOCK_BITS = 16     # Bits per block of the partial-product cache.
+CACHE_SIZE = 1 << 15    # Products cached per query, see EncryptedQuery.
+BLOCK_DTYPES = {8: '<u1', 16: '<u2', 32: '<u4'}
+
+####################
+# Find the set bits of a binary vector
+####################
+def set_positions(v):
+    """Finds the indices of the set bits of a binary vector.
+
+    Args:
+        v: A binary vector (array or PackedBloomFilter).
+
+    Returns:
+        The indices (array) of the non-zero entries of v, in order.
+    """
+    if isinstance(v, PackedBloomFilter):
+        return v.positions()
+
+    return np.flatnonzero(np.asarray(v))
+
+
+####################
+# An encrypted query, as raw ciphertexts
+####################
+class EncryptedQuery(object):
+    """The raw ciphertexts of an encrypted bloom filter, extracted once so
+    that it can be intersected with many database filters.
+
+    Args:
+        enc_vector: The encrypted bloom filter (array of EncryptedNumber,
+            or SharedQuery). All entries must have the same exponent, as
+            when encrypting integers.
+        block_bits: If given (8, 16 or 32), cache the partial products of
+            blocks of this many bits, see block_product.
+        full: Fill the cache up front, one multiplication per pattern of
+            every block, up to cache_size products. Only sensible for 8 bit
+            blocks; by default patterns are cached on their second use.
+        cache_size: The most products of more than one bit cached. The
+            memory of the cache is about cache_size times the bytes of n^2
+            (512 for a 2048 bit key), and as many (block, pattern) keys are
+            remembered to admit patterns on their second use.
+
+    Attributes:
+        multiplications: The number of modular multiplications done so far.
+        cached: The number of products of more than one bit cached.
+    """
+    def __init__(self, enc_vector, block_bits=None, full=False, cache_size=CACHE_SIZE):
+        if block_bits is not None and block_bits not in BLOCK_DTYPES:
+            raise ValueError('block_bits must be one of %s' % sorted(BLOCK_DTYPES))
+
+        if len(enc_vector) == 0:
+            raise ValueError('empty encrypted vector')
+
+        if isinstance(enc_vector, SharedQuery):
+            # Checked when written; decoded as the entries are used.
+            self.public_key = enc_vector.public_key
+            self.exponent = enc_vector.exponent
+            self.ciphertexts = enc_vector.raw_ciphertexts()
+        else:
+            self.public_key = enc_vector[0].public_key
+            self.exponent = enc_vector[0].exponent
+
+            for x in enc_vector:
+                if x.public_key != self.public_key or x.exponent != self.exponent:
+                    raise ValueError('encrypted entries must share a public key and exponent')
+
+            # Not re-obfuscated: only the final products leave the database.
+            self.ciphertexts = [mpz(x.ciphertext(be_secure=False)) for x in enc_vector]
+        self.nsquare = mpz(self.public_key.nsquare)
+        self.block_bits = block_bits
+        self.blocks = {}        # block -> {pattern: product}
+        self.seen = set()       # (block, pattern) used once, not cached yet
+        self.cache_size = cache_size
+        self.cached = 0
+        self.multiplications = 0
+
+        if full:
+            n = len(self.ciphertexts)
+            for block, offset in enumerate(range(0, n, block_bits)):
+                for pattern in range(1, 1 << min(block_bits, n - offset)):
+                    self.block_product(block, pattern, admit=True)
+
+    def __len__(self):
+        return len(self.ciphertexts)
+
+    def __getitem__(self, i):
+        return paillier.EncryptedNumber(self.public_key, int(self.ciphertexts[i]), self.exponent)
+
+    def product(self, positions):
+        """Multiplies the ciphertexts at the given positions mod n^2.
+
+        Args:
+            positions: Indices (iterable of int) of the entries to add.
+
+        Returns:
+            The raw ciphertext (mpz or int) of the encrypted sum. 1, the
+            trivial encryption of 0, if positions is empty.
+        """
+        ciphertexts = self.ciphertexts
+        nsquare = self.nsquare
+        product = None
+        for i in positions:
+            if product is None:
+                product = ciphertexts[i]
+            else:
+                product = product * ciphertexts[i] % nsquare
+                self.multiplications += 1
+
+        return mpz(1) if product is None else product
+
+    def block_product(self, block, pattern, admit=False):
+        """Finds the product of the ciphertexts at the set bits of one block.
+        It is the cached product of the pattern with its lowest bits cleared,
+        times the ciphertexts of those bits, one multiplication each. The
+        pattern and the intermediate ones are cached if they were used
+        before (or admit is set) and the cache is not full.
+
+        Args:
+            block: The index of the block, covering entries
+                block * block_bits up to (block + 1) * block_bits.
+            pattern: The bits (int) of the block, bit t being entry
+                block * block_bits + t. Must not be 0.
+            admit: Cache the products on their first use.
+
+        Returns:
+            The raw ciphertext (mpz or int) of the encrypted block sum.
+        """
+        table = self.blocks.get(block)
+        if table is None:
+            table = self.blocks[block] = {}
+        elif pattern in table:
+            return table[pattern]
+
+        # Clear lowest bits until a cached (or single bit) pattern is left.
+        chain = []
+        rest = pattern
+        while rest not in table and rest & (rest - 1):
+            chain.append(rest)
+            rest &= rest - 1
+
+        offset = block * self.block_bits
+        product = table.get(rest)
+        if product is None:
+            # A single bit is the query's own ciphertext, kept at no cost.
+            product = table[rest] = self.ciphertexts[offset + rest.bit_length() - 1]
+
+        # Add the cleared bits back, caching the intermediate patterns.
+        for p in reversed(chain):
+            low = (p & -p).bit_length() - 1
+            product = product * self.ciphertexts[offset + low] % self.nsquare
+            self.multiplications += 1
+            self._admit(table, block, p, product, admit)
+
+        return product
+
+    def _admit(self, table, block, pattern, product, admit):
+        """Caches a product if its pattern was used before and the cache
+        has room, otherwise remembers the pattern.
+        """
+        if self.cached >= self.cache_size:
+            return
+        key = (block, pattern)
+        if admit or key in self.seen:
+            self.seen.discard(key)
+            table[pattern] = product
+            self.cached += 1
+        elif len(self.seen) < self.cache_size:
+            self.seen.add(key)
+
+    def cached_product(self, v, blocks=None):
+        """Multiplies the cached block products of the non-zero blocks of a
+        binary vector.
+
+        Args:
+            v: A binary vector (array or PackedBloomFilter).
+            blocks: The non-zero blocks of v, from nonzero_blocks, if they
+                were already found.
+
+        Returns:
+            The raw ciphertext (mpz or int) of the encrypted sum.
+        """
+        if blocks is None:
+            blocks = nonzero_blocks(v, self.block_bits)
+
+        nsquare = self.nsquare
+        product = None
+        for block, pattern in blocks:
+            block_product = self.block_product(block, pattern)
+            if product is None:
+                product = block_product
+            else:
+                product = product * block_product % nsquare
+                self.multiplications += 1
+
+        return mpz(1) if product is None else product
+
+    def dot(self, v):
+        """Finds the dot product of a binary vector with the encrypted query.
+
+        Args:
+            v: A binary vector (array or PackedBloomFilter).
+
+        Returns:
+            The encrypted dot product (EncryptedNumber).
+        """
+        if self.block_bits:
+            product = self.cached_product(v)
+        else:
+            product = self.product(set_positions(v).tolist())
+
+        return paillier.EncryptedNumber(self.public_key, int(product), self.exponent)
+
+
+####################
+# Split a binary vector into blocks
+####################
+def nonzero_blocks(v, block_bits):
+    """Finds the non-zero blocks of block_bits bits of a binary vector.
+
+    Args:
+        v: A binary vector (array or PackedBloomFilter).
+        block_bits: The bits per block (8, 16 or 32).
+
+    Returns:
+        (block, pattern) pairs (list of int pairs), see
+        EncryptedQuery.block_product.
+    """
+    if not isinstance(v, PackedBloomFilter):
+        v = PackedBloomFilter.from_array(v)
+
+    patterns = v.words.view(BLOCK_DTYPES[block_bits])
+    nonzero = np.flatnonzero(patterns)
+    return list(zip(nonzero.tolist(), patterns[nonzero].tolist()))
+
+
+####################
+# Several encrypted queries scored together
+####################
+class QueryBatch(object):
+    """Encrypted queries searched for in one pass over the database. It
+    behaves as a list of the queries; its dot product with a binary vector
+    is the list of the dot products with each query.
+
+    Args:
+        queries: The encrypted bloom filters (arrays of EncryptedNumber,
+            SharedQuery or EncryptedQuery).
+        block_bits: As in EncryptedQuery.
+    """
+    def __init__(self, queries, block_bits=None):
+        self.queries = list(queries)
+        self.block_bits = block_bits
+
+    def __len__(self):
+        return len(self.queries)
+
+    def __getitem__(self, i):
+        return self.queries[i]
+
+    def prepared(self, block_bits=None):
+        """The batch with every query an EncryptedQuery, see as_query."""
+        return QueryBatch([as_query(q, block_bits) for q in self.queries], block_bits)
+
+    def dot(self, v):
+        """Finds the dot products of a binary vector with every query,
+        splitting the vector into bits or blocks only once.
+
+        Returns:
+            The encrypted dot products (list of EncryptedNumber), in the
+            order of the queries.
+        """
+        if self.block_bits:
+            blocks = nonzero_blocks(v, self.block_bits)
+            products = [q.cached_product(v, blocks) for q in self.queries]
+        else:
+            positions = set_positions(v).tolist()
+            products = [q.product(positions) for q in self.queries]
+
+        return [paillier.EncryptedNumber(q.public_key, int(product), q.exponent)
+                for q, product in zip(self.queries, products)]
+
+
+####################
+# Calculate the dot product between a binary vector and an encrypted vector
+####################
+def sparse_dotproduct(v1, v2):
+    """Finds the dot product of a binary vector and an encrypted vector,
+    touching only the encrypted entries at the set bits of v1.
+
+    Args:
+        v1: A binary vector (array or PackedBloomFilter).
+        v2: The encrypted vector (EncryptedQuery, SharedQuery or array of
+            EncryptedNumber), or a QueryBatch.
+
+    Returns:
+        The encrypted dot product (EncryptedNumber), or a list of them for
+        a QueryBatch.
+    """
+    if isinstance(v2, QueryBatch):
+        return as_query(v2, v2.block_bits).dot(v1)
+    if isinstance(v2, SharedQuery):
+        # Decodes only the ciphertexts at the set bits of v1.
+        v2 = EncryptedQuery(v2)
+    if isinstance(v2, EncryptedQuery):
+        return v2.dot(v1)
+
+    public_key = v2[0].public_key
+    exponent = v2[0].exponent
+    nsquare = mpz(public_key.nsquare)
+    positions = set_positions(v1).tolist()
+    if any(v2[i].exponent != exponent for i in positions):
+        # Mixed exponents need rescaling; leave that to phe.
+        return sum(v2[i] for i in positions[1:]) + v2[positions[0]]
+
+    product = mpz(1)
+    for i in positions:
+        product = product * mpz(v2[i].ciphertext(be_secure=False)) % nsquare
+
+    return paillier.EncryptedNumber(public_key, int(product), exponent)
+
+
+####################
+# Check if a vector is encrypted
+####################
+def is_encrypted(v):
+    """Checks whether v is an encrypted (Paillier) vector, or a batch of
+    them.
+    """
+    if isinstance(v, EncryptedQuery):
+        return True
+    if isinstance(v, QueryBatch):
+        return len(v) > 0 and is_encrypted(v[0])
+
+    return len(v) > 0 and isinstance(v[0], paillier.EncryptedNumber)
+
+
+####################
+# Prepare an encrypted vector for many dot products
+####################
+def as_query(v, block_bits=None):
+    """Wraps an encrypted vector in an EncryptedQuery, so its ciphertexts are
+    extracted only once. Other vectors are returned unchanged.
+
+    Args:
+        v: The vector.
+        block_bits: As in EncryptedQuery, to cache partial products when
+            many entries are scored against the query.
+    """
+    if isinstance(v, QueryBatch):
+        return v if v.block_bits == block_bits and all(isinstance(q, EncryptedQuery) for q in v) \
+            else v.prepared(block_bits)
+    if isinstance(v, EncryptedQuery) or not is_encrypted(v):
+        return v
+
+    return EncryptedQuery(v, block_bits)
@@ -0,0 +1,71 @@
+"""Streaming selection of the best search results. Results are scored as
+they arrive and only the k best are kept, in a heap, so the memory used does
+not grow with the size of the database.
+"""
+
+import heapq
+
+# Position of each comparison in a score set (Iou, IoLquery, IoLresult, ...)
+METRICS = {'iou': 0, 'ioLquery': 1, 'ioLresult': 2}
+
+####################
+# The k best items of a stream
+####################
+class TopK(object):
+    """Keeps the k items with the largest keys pushed so far. Among items
+    with equal keys the one pushed last wins, as with a '>=' scan for the
+    maximum.
+
+    Args:
+        k: The number of items kept.
+    """
+    def __init__(self, k=1):
+        if k < 1:
+            raise ValueError('k must be at least 1')
+        self.k = k
+        self.heap = []
+        self.count = 0
+
+    def push(self, key, item):
+        """Offers an item, keeping it if it is among the k best so far."""
+        # The counter breaks ties and keeps items from being compared.
+        entry = (key, self.count, item)
+        self.count += 1
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, entry)
+        elif entry[:2] > self.heap[0][:2]:
+            heapq.heapreplace(self.heap, entry)
+
+    def __len__(self):
+        return len(self.heap)
+
+    def items(self):
+        """The kept items, best first."""
+        return [entry[2] for entry in sorted(self.heap, key=lambda entry: entry[:2], reverse=True)]
+
+
+####################
+# Select the best scores of a stream of results
+####################
+def top_k(chunks, score, k=1, metric='iou'):
+    """Scores a stream of results and keeps the k best.
+
+    Args:
+        chunks: An iterable of lists of results, e.g. from
+            p_database.search_stream after decrypting.
+        score: A function from one result to its score set, a tuple
+            starting with (Iou, IoLquery, IoLresult).
+        k: The number of score sets kept.
+        metric: The comparison ranked on, a key of METRICS.
+
+    Returns:
+        The k best score sets, best first.
+    """
+    key = METRICS[metric]
+    best = TopK(k)
+    for chunk in chunks:
+        for result in chunk:
+            score_set = score(result)
+            best.push(score_set[key], score_set)
+
+    return best.items()
@@ -0,0 +1,298 @@
+"""A compact binary format for moving encrypted queries and results between
+the Querier and the Database.
+
+Pickling a list of EncryptedNumber stores the public key with every
+ciphertext and each ciphertext as a Python long. This format stores the
+key once, in a header, and the ciphertexts as fixed-width big-endian
+blocks, so writing and reading them is little more than a copy. Messages
+are written and read a chunk at a time, so results can be sent as they are
+scored (e.g. from p_database.search_stream).
+
+Layout (integers little-endian):
+
+    MAGIC (4 bytes) | version (uint8) | kind (uint8) | header length (uint32)
+    header: JSON with the key id, n (hex), exponent, ciphertext width and
+            the parameters of the message (e.g. slot_bits)
+    chunks: count (uint32) | flags (uint8) | metadata length (uint32)
+            count * width bytes of ciphertexts
+            metadata: JSON of the other fields of the results, compressed
+                      with zlib if flags & COMPRESSED
+    end:    a chunk with count 0xFFFFFFFF
+
+A query message holds the ciphertexts of the encrypted bloom filter and no
+metadata. A result chunk holds the intersections (packed or not) as
+ciphertexts and the results with None in place of each intersection as
+metadata.
+
+Only Paillier ciphertexts are supported; SEAL ciphertexts are not plain
+integers.
+"""
+
+import json
+import struct
+import zlib
+from io import BytesIO
+from phe import paillier
+from p_packing import PackedScores
+from p_keystore import key_id
+
+MAGIC = b'GEMW'
+VERSION = 1
+QUERY = 1
+RESULTS = 2
+COMPRESSED = 1
+END = 0xFFFFFFFF
+PREAMBLE = struct.Struct('<4sBBI')
+CHUNK_HEADER = struct.Struct('<IBI')
+CHUNK_SIZE = 1024       # Ciphertexts per chunk of a query
+
+####################
+# Write a message
+####################
+class WireWriter(object):
+    """Writes a message to a binary stream, a chunk at a time.
+
+    Args:
+        stream: A writable binary file object (file, socket.makefile, ...).
+        public_key: The public key of the ciphertexts.
+        kind: QUERY or RESULTS.
+        exponent: The exponent of every ciphertext.
+        compress: Compress the metadata of chunks with zlib.
+        params: Other parameters stored in the header.
+    """
+    def __init__(self, stream, public_key, kind, exponent=0, compress=True, **params):
+        self.stream = stream
+        self.public_key = public_key
+        self.width = (public_key.nsquare.bit_length() + 7) // 8
+        self.compress = compress
+
+        header = dict(params, key_id=key_id(public_key), n='%x' % public_key.n,
+                      exponent=exponent, width=self.width)
+        header_bytes = json.dumps(header).encode('utf-8')
+        stream.write(PREAMBLE.pack(MAGIC, VERSION, kind, len(header_bytes)))
+        stream.write(header_bytes)
+
+    def write_chunk(self, ciphertexts, metadata=None):
+        """Writes a chunk.
+
+        Args:
+            ciphertexts: Raw ciphertexts (ints, or mpz).
+            metadata: Data stored as JSON with the chunk, or None.
+        """
+        width = self.width
+        block = b''.join(int(c).to_bytes(width, 'big') for c in ciphertexts)
+
+        meta = b''
+        flags = 0
+        if metadata is not None:
+            meta = json.dumps(metadata, separators=(',', ':')).encode('utf-8')
+            if self.compress:
+                meta = zlib.compress(meta)
+                flags |= COMPRESSED
+
+        self.stream.write(CHUNK_HEADER.pack(len(ciphertexts), flags, len(meta)))
+        self.stream.write(block)
+        self.stream.write(meta)
+
+    def close(self):
+        """Ends the message. The stream is left open."""
+        self.stream.write(CHUNK_HEADER.pack(END, 0, 0))
+
+
+####################
+# Read a message
+####################
+class WireReader(object):
+    """Reads a message from a binary stream, a chunk at a time.
+
+    Attributes:
+        kind: QUERY or RESULTS.
+        header: The header (dict), with the key id and parameters.
+        public_key: The public key of the ciphertexts.
+        exponent: The exponent of every ciphertext.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        magic, version, self.kind, header_len = PREAMBLE.unpack(self._read(PREAMBLE.size))
+        if magic != MAGIC:
+            raise ValueError('not a GEMstone wire message')
+        if version > VERSION:
+            raise ValueError('wire format version %d is newer than %d' % (version, VERSION))
+
+        self.header = json.loads(self._read(header_len).decode('utf-8'))
+        self.public_key = paillier.PaillierPublicKey(int(self.header['n'], 16))
+        self.exponent = self.header['exponent']
+        self.width = self.header['width']
+
+    def _read(self, n):
+        data = self.stream.read(n)
+        if len(data) != n:
+            raise EOFError('wire message ended early')
+        return data
+
+    def __iter__(self):
+        """Yields (ciphertexts, metadata) for each chunk, the ciphertexts as
+        a list of ints.
+        """
+        width = self.width
+        while True:
+            count, flags, meta_len = CHUNK_HEADER.unpack(self._read(CHUNK_HEADER.size))
+            if count == END:
+                return
+
+            block = memoryview(self._read(count * width))
+            ciphertexts = [int.from_bytes(block[i:i + width], 'big')
+                           for i in range(0, count * width, width)]
+
+            metadata = None
+            if meta_len:
+                meta = self._read(meta_len)
+                if flags & COMPRESSED:
+                    meta = zlib.decompress(meta)
+                metadata = json.loads(meta.decode('utf-8'))
+            yield ciphertexts, metadata
+
+    def encrypted(self, ciphertexts):
+        """Wraps raw ciphertexts as EncryptedNumber."""
+        return [paillier.EncryptedNumber(self.public_key, c, self.exponent) for c in ciphertexts]
+
+
+####################
+# Encrypted queries
+####################
+def dump_query(enc_vector, stream, chunk_size=CHUNK_SIZE):
+    """Writes an encrypted query (list of EncryptedNumber, all with the same
+    public key and exponent).
+    """
+    writer = WireWriter(stream, enc_vector[0].public_key, QUERY, enc_vector[0].exponent,
+                        count=len(enc_vector))
+    for start in range(0, len(enc_vector), chunk_size):
+        writer.write_chunk([x.ciphertext() for x in enc_vector[start:start + chunk_size]])
+    writer.close()
+
+
+def load_query(stream):
+    """Reads an encrypted query written by dump_query.
+
+    Returns:
+        The encrypted query (list of EncryptedNumber).
+    """
+    reader = WireReader(stream)
+    if reader.kind != QUERY:
+        raise ValueError('expected a query message')
+
+    query = []
+    for ciphertexts, _ in reader:
+        query.extend(reader.encrypted(ciphertexts))
+    return query
+
+
+####################
+# Search results
+####################
+def _strip(scores):
+    """Splits results into their encrypted intersections and the other
+    fields, with None in place of each intersection.
+    """
+    values = []
+    stripped = []
+    for score in scores:
+        windows = score if isinstance(score, list) else [score]
+        rows = []
+        for window in windows:
+            if isinstance(window[0], paillier.EncryptedNumber):
+                values.append(window[0])
+                rows.append([None] + list(window[1:]))
+            else:
+                rows.append(list(window))
+        stripped.append(rows if isinstance(score, list) else rows[0])
+    return values, stripped
+
+
+def _restore(stripped, values):
+    """Puts intersections back in place of None, making tuples of the
+    results again (and lists of tuples for windowed results).
+    """
+    values = iter(values or ())
+
+    def row(window):
+        if window[0] is None:
+            return (next(values, None),) + tuple(window[1:])
+        return tuple(window)
+
+    # Windowed results are lists of rows; a row starts with a number or None.
+    return [[row(w) for w in score] if not score or isinstance(score[0], list) else row(score)
+            for score in stripped]
+
+
+def dump_results(chunks, stream, public_key, compress=True):
+    """Writes search results, a chunk at a time.
+
+    Args:
+        chunks: An iterable of result chunks, each a list of results or a
+            PackedScores (as from search_stream or pass_results).
+        stream: A writable binary file object.
+        public_key: The public key of the intersections.
+        compress: Compress the metadata of the chunks with zlib.
+    """
+    writer = WireWriter(stream, public_key, RESULTS, compress=compress)
+    for chunk in chunks:
+        if isinstance(chunk, PackedScores):
+            writer.write_chunk([x.ciphertext() for x in chunk.ciphertexts],
+                               {'packed': True, 'slot_bits': chunk.slot_bits, 'count': chunk.count,
+                                'scores': _strip(chunk.scores)[1]})
+        else:
+            values, stripped = _strip(chunk)
+            exponent = values[0].exponent if values else 0
+            if any(x.exponent != exponent for x in values):
+                raise ValueError('encrypted intersections must share an exponent')
+            writer.write_chunk([x.ciphertext() for x in values],
+                               {'packed': False, 'exponent': exponent, 'scores': stripped})
+    writer.close()
+
+
+def load_results(stream):
+    """Reads search results written by dump_results.
+
+    Yields:
+        The result chunks, as given to dump_results.
+    """
+    reader = WireReader(stream)
+    if reader.kind != RESULTS:
+        raise ValueError('expected a results message')
+
+    for ciphertexts, meta in reader:
+        if meta['packed']:
+            yield PackedScores(reader.encrypted(ciphertexts), meta['slot_bits'], meta['count'],
+                               _restore(meta['scores'], None))
+        else:
+            values = [paillier.EncryptedNumber(reader.public_key, c, meta['exponent'])
+                      for c in ciphertexts]
+            yield _restore(meta['scores'], values)
+
+
+####################
+# Whole messages as bytes
+####################
+def dumps_query(enc_vector):
+    """An encrypted query as bytes, see dump_query."""
+    out = BytesIO()
+    dump_query(enc_vector, out)
+    return out.getvalue()
+
+
+def loads_query(data):
+    """The encrypted query of bytes from dumps_query."""
+    return load_query(BytesIO(data))
+
+
+def dumps_results(results, public_key, compress=True):
+    """One chunk of results (list or PackedScores) as bytes."""
+    out = BytesIO()
+    dump_results([results], out, public_key, compress)
+    return out.getvalue()
+
+
+def loads_results(data):
+    """The results of bytes from dumps_results."""
+    return next(load_results(BytesIO(data)))
@@ -1,17 +1,163 @@
 """Bloom filter for genetic sequences. Stored as unsigned character array."""
 
+import math
 import sys
 
 from array import array
 from collections import defaultdict
 
+import numpy as np
+
 #BLOOM FILTER DEFAULTS
 K = 16
-H = hash
 HASH_MAX = sys.maxsize + 1
 SIZE = 12000
+NUM_HASHES = 1
+
+# Seed of the k-mer hash. Every process hashing with the same seed builds the
+# same filter, unlike the builtin hash which is salted per interpreter.
+SEED = 0
+
+# 2-bit code of each nucleotide. Every other character maps to INVALID_BASE.
+INVALID_BASE = 4
+BASE_CODES = np.full(256, INVALID_BASE, dtype=np.uint8)
+for _code, _bases in enumerate(('Aa', 'Cc', 'Gg', 'Tt')):
+    for _base in _bases:
+        BASE_CODES[ord(_base)] = _code
+
+MASK_64 = (1 << 64) - 1
+MAX_HASHED_K = 32           # A k-mer must fit in 64 bits at 2 bits per base.
+
+
+def _mix64(x):
+    """ Murmur3 finalizer. Scrambles a 64-bit integer (python int or uint64
+    numpy array) so nearby k-mer codes land far apart in the filter.
+    """
+    if isinstance(x, np.ndarray):
+        x = x ^ (x >> np.uint64(33))
+        x = x * np.uint64(0xff51afd7ed558ccd)
+        x = x ^ (x >> np.uint64(33))
+        x = x * np.uint64(0xc4ceb9fe1a85ec53)
+        return x ^ (x >> np.uint64(33))
+
+    x ^= x >> 33
+    x = (x * 0xff51afd7ed558ccd) & MASK_64
+    x ^= x >> 33
+    x = (x * 0xc4ceb9fe1a85ec53) & MASK_64
+    return x ^ (x >> 33)
+
+
+def kmer_hash(k_mer, seed=SEED):
+    """ Seeded, process-independent hash of a k-mer.
+
+    Matches the signature of the builtin hash, returning a signed 64-bit
+    value, so it drops into encode's 'h' argument. encode recognises it and
+    hashes every k-mer of the gene at once with numpy instead of calling it
+    per position.
+
+    Args:
+        k_mer: A string of at most MAX_HASHED_K nucleotides.
+        seed: The seed of the hash.
+
+    Returns:
+        The hash of the k-mer, or None if the k-mer holds a character other
+        than A, C, G or T (such as 'N'). Those k-mers are left out of filters.
+    """
+    code = 0
+    for base in k_mer.encode('ascii', 'replace'):
+        base_code = BASE_CODES[base]
+        if base_code == INVALID_BASE:
+            return None
+        code = (code << 2) | int(base_code)
+
+    return _mix64((code ^ seed) & MASK_64) - (1 << 63)
+
+H = kmer_hash
+
+
+def kmer_codes(gene, k=K):
+    """ Packs every k-mer of a gene into a 2-bit per base integer code.
+
+    Args:
+        gene: A string holding all or part of a DNA sequence.
+        k: The size of the k-mer.
+
+    Returns:
+        A uint64 array with the code of every k-mer that is made only of
+        A, C, G and T, in order of position.
+    """
+    if k > MAX_HASHED_K:
+        raise ValueError('k-mers longer than %d cannot be hashed' % MAX_HASHED_K)
+
+    bases = BASE_CODES[np.frombuffer(gene.encode('ascii', 'replace'), dtype=np.uint8)]
+    n_kmers = len(bases) - k + 1
+    if n_kmers <= 0:
+        return np.zeros(0, dtype=np.uint64)
+
+    # Shift in one base of every k-mer at a time.
+    codes = np.zeros(n_kmers, dtype=np.uint64)
+    for j in range(k):
+        codes <<= np.uint64(2)
+        codes |= bases[j:j + n_kmers].astype(np.uint64)
+
+    # Drop k-mers covering an invalid base.
+    invalid = np.concatenate(([0], np.cumsum(bases == INVALID_BASE)))
+    return codes[invalid[k:] == invalid[:n_kmers]]
+
+
+def kmer_positions(gene, size=SIZE, k=K, HASH_MAX=HASH_MAX, seed=SEED,
+                   num_hashes=NUM_HASHES):
+    """ Filter positions of every k-mer in a gene under kmer_hash.
+
+    Args:
+        gene: A string holding all or part of a DNA sequence.
+        size: The size of the bloom filter.
+        k: The size of the k-mer.
+        HASH_MAX: Offset making hashes positive, as in encode.
+        seed: The seed of the hash.
+        num_hashes: The number of filter positions set per k-mer.
+
+    Returns:
+        A uint64 array holding, for every valid k-mer and every i below
+        num_hashes, the index hash_position(kmer_hash(k_mer), i, size, HASH_MAX).
+    """
+    hashes = _mix64(kmer_codes(gene, k) ^ np.uint64(seed & MASK_64))
+
+    # kmer_hash subtracts 2**63 to be signed; fold that and HASH_MAX into
+    # one offset so the unsigned numpy hash can be reduced directly.
+    offset = np.uint64((HASH_MAX - (1 << 63)) % size)
+    base = (hashes % np.uint64(size) + offset) % np.uint64(size)
+    if num_hashes == 1:
+        return base
+
+    step = ((hashes >> np.uint64(32)) | np.uint64(1)) % np.uint64(size)
+    return np.concatenate([(base + step * np.uint64(i)) % np.uint64(size)
+                           for i in range(num_hashes)])
+
 
-def encode(gene, size=SIZE, k=K, h=H):
+def hash_position(k_hash, i, size=SIZE, HASH_MAX=HASH_MAX):
+    """ Filter position of the i-th hash function for a hashed k-mer.
+
+    The hash functions are derived from the one k-mer hash by double hashing,
+    (h + i * step) % size with the step taken from the high 32 bits of h. The
+    first (i = 0) is (h + HASH_MAX) % size, the single position of a filter
+    with one hash.
+
+    Args:
+        k_hash: The signed 64-bit hash of the k-mer.
+        i: The index of the hash function.
+        size: The size of the bloom filter.
+        HASH_MAX: Offset making hashes positive.
+    """
+    base = (k_hash + HASH_MAX) % size
+    if i == 0:
+        return base
+    step = ((((k_hash + (1 << 63)) & MASK_64) >> 32) | 1) % size
+    return (base + step * i) % size
+
+
+def encode(gene, size=SIZE, k=K, h=H, vectorized=True, packed=False,
+           num_hashes=NUM_HASHES):
     """Creates a bloom filter. Used to encode a genetic sequence.
 
     Args:
@@ -23,6 +169,11 @@ def encode(gene, size=SIZE, k=K, h=H):
             k is given.
         h: The hash used to encode each k-mer entered in the bloom filter.
             Set to the default hash if no hash is given.
+        vectorized: If h is kmer_hash, hash all k-mers at once with numpy.
+            Set to False to run the per k-mer loop, which any other h uses.
+        packed: Return a PackedBloomFilter instead of an array.
+        num_hashes: The number of filter entries set per k-mer. Each is a
+            separate hash function derived from h (see hash_position).
 
     Returns:
         The corresponding bloom filter. An array where each each entry a hashed
@@ -30,21 +181,186 @@ def encode(gene, size=SIZE, k=K, h=H):
 
         The number of of unique k-mers in the gene.
     """
+    if vectorized and h is kmer_hash:
+        positions = kmer_positions(gene, size, k, num_hashes=num_hashes)
+        if packed:
+            return PackedBloomFilter.from_positions(positions, size)
+        bf = np.zeros(size, dtype=np.int8)
+        bf[positions] = 1
+        return array('b', bf.tobytes())
+
     bf = initialize_bloom_filter(size)
     gene = gene.upper()                         # Make gene all uppercase.
 
     # Loop through all k-mers for gene.
     for n in range(0, len(gene)-k + 1):
         # Get k-mer of length k and hash it.
-        k_mer = gene[n:n + k]                   # TODO: ignore case, 'N's?
-        k_hash = (h(k_mer) + HASH_MAX) % size   # Make hash positive and within
-                                                # size of filter.
+        k_mer = gene[n:n + k]
+        k_hash = h(k_mer)
+        if k_hash is None:                      # k-mer holds an 'N' or other
+            continue                            # base the hash skips.
 
-        # Set entry the bloom filter corresponding to the hashed k-mer to one.
-        bf[k_hash] = 1
+        # Set the entries in the bloom filter corresponding to the hashed k-mer
+        # to one. Positions are made positive and within size of filter.
+        for i in range(num_hashes):
+            bf[hash_position(k_hash, i, size, HASH_MAX)] = 1
 
+    if packed:
+        return PackedBloomFilter.from_array(bf)
     return bf
 
+def _popcount(words):
+    """ Number of set bits in a uint64 array. """
+    if hasattr(np, 'bitwise_count'):
+        return int(np.bitwise_count(words).sum())
+    return int(np.unpackbits(words.view(np.uint8)).sum())
+
+
+class PackedBloomFilter(object):
+    """ Bloom filter stored as bits packed into uint64 words.
+
+    Takes one bit per filter entry instead of the one byte of the array from
+    initialize_bloom_filter, and counts bits a word at a time. Indexing,
+    len() and iteration behave like that array, so the packed filter can be
+    passed wherever an unpacked one is expected.
+
+    Attributes:
+        size: The number of entries (bits) in the filter.
+        words: uint64 array holding entry i at bit i % 64 of word i // 64.
+    """
+    def __init__(self, size=SIZE, words=None):
+        self.size = size
+        if words is None:
+            words = np.zeros((size + 63) // 64, dtype='<u8')
+        self.words = words
+
+    @classmethod
+    def from_positions(cls, positions, size=SIZE):
+        """ Creates a filter with the given entries set to one.
+
+        Args:
+            positions: Iterable or array of entry indices, may repeat.
+            size: The size of the bloom filter.
+        """
+        bits = np.zeros(((size + 63) // 64) * 64, dtype=np.uint8)
+        bits[np.asarray(positions, dtype=np.int64)] = 1
+        return cls(size, np.packbits(bits, bitorder='little').view('<u8'))
+
+    @classmethod
+    def from_array(cls, bf):
+        """ Packs an unpacked (one entry per element) bloom filter. """
+        return cls.from_positions(np.flatnonzero(np.asarray(bf)), len(bf))
+
+    def positions(self):
+        """ Sorted int64 array of the entries set to one. """
+        bits = np.unpackbits(self.words.view(np.uint8), bitorder='little')
+        return np.flatnonzero(bits[:self.size])
+
+    def iter_set_bits(self):
+        """ Iterates over the indices of entries set to one, in order. """
+        for i in self.positions():
+            yield int(i)
+
+    def magnitude(self):
+        """ Number of entries set to one. """
+        return _popcount(self.words)
+
+    def intersection(self, other):
+        """ Number of entries set to one in both this and another packed
+        filter of the same size.
+        """
+        if self.size != other.size:
+            raise ValueError('Bloom filters have different sizes (%d, %d)'
+                             % (self.size, other.size))
+        return _popcount(self.words & other.words)
+
+    def to_array(self):
+        """ Unpacks the filter into the array format of initialize_bloom_filter. """
+        bits = np.unpackbits(self.words.view(np.uint8), bitorder='little')
+        return array('b', bits[:self.size].astype(np.int8).tobytes())
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.size
+        if not 0 <= i < self.size:
+            raise IndexError('bloom filter index out of range')
+        return int(self.words[i >> 6] >> np.uint64(i & 63)) & 1
+
+    def __setitem__(self, i, value):
+        if i < 0:
+            i += self.size
+        if not 0 <= i < self.size:
+            raise IndexError('bloom filter index out of range')
+        bit = np.uint64(1 << (i & 63))
+        if value:
+            self.words[i >> 6] |= bit
+        else:
+            self.words[i >> 6] &= ~bit
+
+    def __iter__(self):
+        return iter(self.to_array())
+
+    def __eq__(self, other):
+        if isinstance(other, PackedBloomFilter):
+            return self.size == other.size and np.array_equal(self.words, other.words)
+        return NotImplemented
+
+    def __getstate__(self):
+        return {'size': self.size, 'words': self.words.tobytes()}
+
+    def __setstate__(self, state):
+        self.size = state['size']
+        self.words = np.frombuffer(state['words'], dtype='<u8').copy()
+
+
+def filter_parameters(seq_len, error=0.01, target='fpr', max_hashes=8):
+    """ Smallest bloom filter meeting an error budget for a sequence length.
+
+    Every filter entry costs one encryption and one ciphertext in the
+    encrypted search, so the size is minimised. The sequence is modelled as
+    seq_len - k + 1 distinct k-mers hashed uniformly.
+
+    Args:
+        seq_len: The expected length of the encoded sequences.
+        error: The error budget, between 0 and 1.
+        target: 'fpr' bounds the false-positive rate of a k-mer lookup,
+            (1 - exp(-h * n / size)) ** h. 'iou' bounds the IOU that two
+            filters of unrelated sequences reach through hash collisions
+            alone, p / (2 - p) for a filter with a fraction p of entries set.
+        max_hashes: The largest number of hashes per k-mer considered.
+
+    Returns:
+        The tuple (size, k, num_hashes). k is the smallest k-mer size for which
+        a k-mer matches by chance somewhere in a random sequence of seq_len
+        bases with probability at most error. Among filters of equal size the
+        one with fewer hashes is returned.
+    """
+    if not 0 < error < 1:
+        raise ValueError('error must be between 0 and 1')
+    if target not in ('fpr', 'iou'):
+        raise ValueError("target must be 'fpr' or 'iou'")
+
+    k = int(math.ceil(math.log(seq_len / error, 4)))
+    k = min(max(k, 1), MAX_HASHED_K)
+    n_kmers = max(seq_len - k + 1, 1)
+
+    best = None
+    for num_hashes in range(1, max_hashes + 1):
+        # Largest fraction of set entries meeting the budget.
+        if target == 'fpr':
+            fill = error ** (1 / num_hashes)
+        else:
+            fill = 2 * error / (1 + error)
+        size = int(math.ceil(-num_hashes * n_kmers / math.log(1 - fill)))
+        if best is None or size < best[0]:
+            best = (size, k, num_hashes)
+
+    return best
+
+
 def initialize_bloom_filter(size=SIZE):
     """ Creates empty bloom filter.
 
@@ -8,7 +8,7 @@ from collections import defaultdict, namedtuple
 import time
 import sys
 
-from bloom_filter import encode
+from bloom_filter import encode, PackedBloomFilter
 
 # Type of sequence used in database
 SEQUENCE_TYPE = "public_addgene_full_sequences"
@@ -60,8 +60,10 @@ def iou(data, query, query_mag):
     """Finds the IOU for two bloom filters.
 
     Args:
-        data: The bloom filter (array) of a particular gene from the database.
-        query: The bloom filter (array) of the gene being searched for.
+        data: The bloom filter (array or PackedBloomFilter) of a particular
+            gene from the database.
+        query: The bloom filter (array or PackedBloomFilter) of the gene being
+            searched for.
         query_mag: The magnitude of the gene being searched for. (Since this
             remains constant in all IOU calcutlations in the search)
 
@@ -70,19 +72,25 @@ def iou(data, query, query_mag):
     """
     intersection = dotproduct(data, query)
     union = magnitude(data) + query_mag - intersection
-    return intersection/union
+    # Sequences of only 'N' bases set no bits.
+    return intersection/union if union else 0
 
 def dotproduct(v1, v2):
     """Finds the dot product of two vectors (arrays). The first vector must
     be binary.
 
     Args:
-        v1: A binary vector (array).
-        v2: A vector (array).
+        v1: A binary vector (array or PackedBloomFilter).
+        v2: A vector (array or PackedBloomFilter).
 
     Returns:
         The dot product of the two vectors.
     """
+    if isinstance(v1, PackedBloomFilter):
+        if isinstance(v2, PackedBloomFilter):
+            return v1.intersection(v2)
+        return sum(v2[i] for i in v1.iter_set_bits())
+
     dot = 0
     for i in range(0, len(v1)):
         if v1[i] == 1:
@@ -93,11 +101,14 @@ def magnitude(v):
     """Finds the magnitude of a binary vector (array).
 
     Args:
-        v: A binary vector (array).
+        v: A binary vector (array or PackedBloomFilter).
 
     Returns:
         The magnitude of the vector.
     """
+    if isinstance(v, PackedBloomFilter):
+        return v.magnitude()
+
     sum = 0
     for x in v:
         sum += x
@@ -133,7 +144,7 @@ def encode_data():
             pi = k['pi'][0]
             if k['sequences']["public_addgene_full_sequences"]:
                 sequence = k['sequences'][SEQUENCE_TYPE][0]
-                bf = encode(sequence)
+                bf = encode(sequence, packed=True)
                 gene = Gene(name = name, pi = pi, sequence = sequence, bloom = bf)
                 data[id_] = gene
                 id_ += 1
@@ -55,7 +55,7 @@ def query(query_sequence):
     """
 
     print("encoding query...")
-    query = encode(query_sequence)
+    query = encode(query_sequence, packed=True)
     print("...query complete")
 
     print("performing search...")